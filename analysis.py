@@ -1,10 +1,20 @@
 import logging
 import os
+import sys
 import time
 
+import numpy as np
+import psycopg2 as db
+from scipy.sparse import vstack
+
 import database
+import local_backends
+from cfganomaly.corpus import Corpus
 from manager import GplayManager, AndrozooManager, FDroidManager
-from utility.convenience import VERBOSE, STATUS
+from scoring import load_model
+from utility.convenience import VERBOSE, STATUS, MAX_RETRIES, log_psycopg2_exception
+from utility import analytics, export, method_records, size_store
+from utility.exceptions import DatabaseRetry
 from vt_manager import Active
 
 
@@ -35,6 +45,8 @@ def init_logging(arguments):
         root.addHandler(file_handler)
     if arguments.db:
         database.db_string = arguments.db
+        database.backend = local_backends.open_backend(arguments.db,
+                                                       arguments.db_batch)
     else:
         database.db_string = 'dbname=malware user=postgres host=0.0.0.0'
     logging.getLogger('postgreSQL').info(
@@ -56,6 +68,152 @@ def fdroid_analysis(args):
     manager.run(args)
 
 
+def rescore(args):
+    """Scores the vectors of a feature sink with a (new) model and replaces the anomalies.
+
+    Apks are scored together in batches of about batch_rows vectors. Sampled apks only
+    have the vectors of their sample, so their anomaly counts cover the sample and their
+    estimated counts are cleared.
+    """
+    logger = logging.getLogger('Rescore')
+    logger.setLevel(logging.NOTSET)
+    store = Corpus.open(args.store)
+    # Training corpora are extracted without the method names anomalies are stored by
+    first = next((name for name, (rows, _) in store.completed().items() if rows), None)
+    if first is not None and store.read_methods(first) is None:
+        logger.fatal(f'{args.store} has no method names, only the vectors written with'
+                     f' --feature-sink can be rescored.')
+        sys.exit(1)
+    model, _ = load_model(logger, path=args.model)
+    vocabulary = getattr(model, 'ngram_vocabulary_', None)
+    db_connection = db.connect(database.db_string)
+    start = time.time()
+    apks = 0
+    rows = 0
+    anomalies = 0
+    batch = []
+    shards = store.shards()
+    while True:
+        shard = next(shards, None)
+        if shard is not None:
+            batch.append(shard)
+            if sum(matrix.shape[0] for _, matrix, _ in batch) < args.batch_rows:
+                continue
+        if not batch:
+            break
+        matrix = vstack([matrix for _, matrix, _ in batch], format='csr')
+        if vocabulary is not None:
+            matrix = matrix[:, vocabulary]
+        scores = model.score_samples(matrix)
+        entries = []
+        offset = 0
+        for sha256, shard_matrix, _ in batch:
+            shard_scores = scores[offset:offset + shard_matrix.shape[0]]
+            offset += shard_matrix.shape[0]
+            methods = store.read_methods(sha256)
+            entries.append((sha256, {
+                str(methods[idx]): float(shard_scores[idx])
+                for idx in np.flatnonzero(shard_scores < args.cutoff)
+            }))
+        store_rescored(entries, db_connection, logger)
+        apks += len(batch)
+        rows += matrix.shape[0]
+        anomalies += sum(len(apk_anomalies) for _, apk_anomalies in entries)
+        batch = []
+        logger.log(
+            STATUS, f'Rescored {rows} methods of {apks} apks, found {anomalies}'
+            f' anomalies ({rows / (time.time() - start):.0f} methods/s).')
+    db_connection.close()
+
+
+def store_rescored(entries, db_connection, logger):
+    for count in range(MAX_RETRIES + 1):
+        try:
+            database.replace_anomalies(entries,
+                                       db_connection if count == 0 else None)
+            return
+        except DatabaseRetry as error:
+            log_psycopg2_exception(error.error, logger)
+            time.sleep(10)
+    logger.fatal(f'Failed to store the anomalies of {len(entries)} apks.')
+    sys.exit(1)
+
+
+def rethreshold(args):
+    """Counts the anomalies of every apk with method records for each of the given cutoffs.
+
+    The counts are written as CSV, one row per apk and one column per cutoff. With
+    --store, the anomalies found with the first cutoff replace the stored ones. Records
+    scored with a cascade only support cutoffs up to that of the cascade.
+    """
+    logger = logging.getLogger('Rethreshold')
+    logger.setLevel(logging.NOTSET)
+    for segment in method_records.segments(args.records):
+        cascade_cutoff = segment.params['cascade_cutoff']
+        if cascade_cutoff is not None and max(args.cutoffs) > cascade_cutoff:
+            logger.fatal(
+                f'{segment.path} was scored with a cascade, which only scores methods'
+                f' exactly if they might fall below {cascade_cutoff}. Cannot count'
+                f' anomalies below {max(args.cutoffs)}.')
+            sys.exit(1)
+    db_connection = db.connect(database.db_string) if args.store else None
+    output = open(args.output, 'w') if args.output else sys.stdout
+    output.write(','.join(['sha256'] + [str(cutoff) for cutoff in args.cutoffs]) +
+                 '\n')
+    start = time.time()
+    apks = 0
+    methods = 0
+    totals = np.zeros(len(args.cutoffs), dtype=np.int64)
+    for segment in method_records.segments(args.records):
+        names = None
+        counts = []
+        for cutoff in args.cutoffs:
+            names, cutoff_counts = segment.anomaly_counts(cutoff)
+            counts.append(cutoff_counts)
+        counts = np.column_stack(counts)
+        output.writelines(','.join([sha256] + [str(count) for count in row]) + '\n'
+                          for sha256, row in zip(names, counts.tolist()))
+        if args.store:
+            entries = []
+            for sha256 in names:
+                scores, _, method_names = segment.records(sha256)
+                entries.append((sha256, {
+                    method_names[idx]: float(scores[idx])
+                    for idx in np.flatnonzero(scores < args.cutoffs[0])
+                }))
+            store_rescored(entries, db_connection, logger)
+        apks += len(names)
+        methods += segment.length
+        totals += counts.sum(axis=0)
+        logger.log(
+            STATUS, f'Counted anomalies among {methods} methods of {apks} apks'
+            f' ({methods / (time.time() - start):.0f} methods/s).')
+    for cutoff, total in zip(args.cutoffs, totals):
+        logger.info(f'{total} anomalies in {apks} apks below {cutoff}.')
+    if args.output:
+        output.close()
+    if db_connection is not None:
+        db_connection.close()
+
+
+def convert_sizes(args):
+    logger = logging.getLogger('Converter')
+    logger.setLevel(logging.NOTSET)
+    converted = size_store.convert(args.out, remove=args.remove)
+    logger.info(f'Moved the method sizes of {converted} apks to'
+                f' {os.path.join(args.out, "sizes")}.')
+
+
+def size_analytics(args):
+    analytics.run(os.path.join(args.out, 'sizes'), args.output, args.worker,
+                  args.chunk_apks, not args.no_join)
+
+
+def export_tables(args):
+    export.run(args.output, args.tables, args.format, args.worker, args.ranges,
+               args.row_group)
+
+
 def vt_queries(args):
     manager = Active(args.vt, args.quota)
     logger = logging.getLogger('VirusTotal')
@@ -1,18 +1,31 @@
 import os
+import select
 import shlex
 import tempfile
+from queue import Empty
 from subprocess import check_output, CalledProcessError
 
+import psycopg2 as db
+
 from utility import clean
 import database
 from apk_managers.abstract import ApkManager
 from utility.exceptions import NoMoreApks, DownloadFailed
 from utility.convenience import VERBOSE
+from utility.membership import BloomFilter
 
 
 class AndrozooApkManager(ApkManager):
 
-    def __init__(self, api_key, queries, queue, workers, repeat):
+    def __init__(self,
+                 api_key,
+                 queries,
+                 queue,
+                 workers,
+                 repeat,
+                 fetch_size=database.FETCH_SIZE,
+                 finished=None,
+                 listen=False):
         super().__init__(queue, workers)
         with open(api_key, 'r') as key:
             self.key = key.read().strip()
@@ -23,13 +36,29 @@ class AndrozooApkManager(ApkManager):
         self.apks = iter([])
         self.query_yield = 0
         self.repeat = repeat
+        self.fetch_size = fetch_size
+        # Hashes reported by the workers once they are done with an apk
+        self.finished = finished
+        self.done = BloomFilter()
+        # Downloads of already analyzed apks avoided by the queries and by the bloom filter
+        self.excluded = 0
+        self.avoided = 0
+        self.query_excluded = 0
+        self.query_avoided = 0
+        self.db_connection = None
+        # Range of sequence numbers of androzoo_apks the current query covers in repeat mode
+        self.low = None
+        self.watermark = None
+        self.listen = listen
+        self.listener = None
 
     def next_apk(self):
         """Retrieves the next apk from the androzoo dataset.
 
-        Queries the database for a set of apks, which is then cached and iterated upon
-        until all apks are exhausted. Then, a new query will automatically be constructed
-        so the process of apk retrieval can continue seemlessly.
+        Queries the database for a set of apks not analyzed yet, which is then streamed in
+        batches of fetch_size through a server-side cursor until all apks are exhausted.
+        Then, a new query will automatically be constructed so the process of apk retrieval
+        can continue seemlessly.
 
         Returns
         -------
@@ -43,18 +72,55 @@ class AndrozooApkManager(ApkManager):
             The function to execute after the analysis in order to clean any
             unnecessary overhead from disk.
         """
-        try:
-            sha256 = next(self.apks)
-            if not sha256:
-                return self.next_apk()
+        while True:
+            try:
+                sha256 = next(self.apks)
+            except StopIteration:
+                self.next_query()
+                continue
+            if not sha256 or self.is_done(sha256):
+                continue
             self.query_yield += 1
-            directory = self.download(sha256)
+            try:
+                directory = self.download(sha256)
+            except DownloadFailed:
+                continue
             return sha256, directory, None, clean.androzoo_remnants
-        except StopIteration:
-            self.next_query()
-            return self.next_apk()
-        except DownloadFailed:
-            return self.next_apk()
+
+    def is_done(self, sha256):
+        """Checks whether an apk was already analyzed since the current query started.
+
+        Apks that were done before are removed by the query itself, see database.exclude_processed.
+        Only hits of the bloom filter are verified against the database,
+        so the common case of a new apk does not cost an additional round trip.
+
+        Parameters
+        ----------
+        sha256: str
+            The sha256 identifier of the application.
+
+        Returns
+        -------
+        bool
+            True if the apk can be skipped.
+        """
+        if self.finished is not None:
+            while True:
+                try:
+                    self.done.add(self.finished.get_nowait())
+                except Empty:
+                    break
+        if sha256 not in self.done:
+            return False
+        if not database.is_processed(sha256, self.connection()):
+            return False
+        self.avoided += 1
+        self.query_avoided += 1
+        self.logger.log(
+            VERBOSE,
+            f'Skipping {sha256} as it was already analyzed, avoided'
+            f' {self.excluded + self.avoided} downloads so far.')
+        return True
 
     def next_query(self):
         """Upon the exhaustion of the apk list returned by the previous query,
@@ -66,25 +132,84 @@ class AndrozooApkManager(ApkManager):
         if self.query:
             self.logger.info(
                 f'Finished processing the following query:\n\t{self.query}')
+            self.logger.info(
+                f'Avoided {self.query_excluded + self.query_avoided} downloads of already'
+                f' analyzed apks with this query, {self.query_excluded} excluded by the'
+                f' query and {self.query_avoided} skipped while streaming its results.'
+                f' Avoided {self.excluded + self.avoided} downloads so far.')
+            if self.watermark is not None:
+                # Apks still being analyzed, or whose results were lost, are not done yet
+                # and have to be considered again by the next iteration
+                seq = database.pending_watermark(self.query, self.low,
+                                                 self.watermark,
+                                                 self.connection())
+                database.store_watermark(self.query, seq, self.connection())
+                self.watermark = None
+        if self.repeat and self.listen and self.listener is None:
+            self.listener = database.listen(database.ANDROZOO_CHANNEL)
         try:
             self.query = next(self.queries)
             self.logger.info(
                 f'Previous query had no more apks, continuing with the following query:\n\t{self.query}'
             )
-            self.apks = iter([row[0] for row in database.access(self.query)])
+            query = self.query
+            if self.repeat:
+                # Only consider apks added or changed since this query was last exhausted
+                self.low = database.get_watermark(self.query, self.connection())
+                self.watermark = database.current_watermark(self.connection())
+                query = database.after_watermark(query, self.low, self.watermark)
+            candidates, self.query_excluded = database.count_processed(
+                query, self.connection())
+            self.excluded += self.query_excluded
+            self.query_avoided = 0
+            self.logger.info(
+                f'Query yields {candidates} apks, {self.query_excluded} of them were'
+                f' already analyzed.')
+            self.apks = (row[0] for row in database.access(
+                database.exclude_processed(query),
+                name='androzoo_apks',
+                fetch_size=self.fetch_size))
             return
         except StopIteration:
-            if not self.repeat or self.query_yield == 0:
+            if not self.repeat:
                 raise NoMoreApks
             if self.query_yield == 0:
-                self.logger.info(
-                    'Previous iteration had no new apks, stopping loop.')
-                raise NoMoreApks
+                if self.listener is None:
+                    self.logger.info(
+                        'Previous iteration had no new apks, stopping loop.')
+                    raise NoMoreApks
+                self.wait_for_update()
         self.logger.info('Rerunning all queries to look for new results.')
+        if self.listener is not None:
+            # The rerun covers everything announced so far
+            self.listener.poll()
+            self.listener.notifies.clear()
         with open(self.query_file, 'r') as q:
             self.queries = iter(q.read().strip().split(os.linesep))
         self.query_yield = 0
 
+    def wait_for_update(self):
+        """Blocks until the database announces new androzoo apks, see database.populate.
+
+        Notifications that arrived while the previous iteration was still running
+        end the wait immediately.
+        """
+        self.logger.info(
+            'Previous iteration had no new apks, waiting for the database to be updated.'
+        )
+        while True:
+            self.listener.poll()
+            if self.listener.notifies:
+                self.listener.notifies.clear()
+                self.logger.info('Database was updated.')
+                return
+            select.select([self.listener], [], [], 60)
+
+    def connection(self):
+        if self.db_connection is None:
+            self.db_connection = db.connect(database.db_string)
+        return self.db_connection
+
     def download(self, sha256):
         """Given an apk identifier, downloads the apk from the androzoo dataset.
 
@@ -109,5 +234,6 @@ class AndrozooApkManager(ApkManager):
             database.full_error(
                 sha256,
                 f'Failed downloading with code {e.returncode}: {e.stderr}')
+            self.done.add(sha256)
             raise DownloadFailed
         return tmpdir
@@ -9,6 +9,22 @@ from compatibility.stores import store_gplay_apk_info, store_fdroid_apk_info
 from utility import clean
 from utility.convenience import sha256sum
 from utility.exceptions import NoMoreApks
+from utility.membership import DigestSet
+
+
+def processed_apks():
+    """Loads the identifiers of all apks already present in "results" or "errors".
+
+    The identifiers are streamed from the database and stored as a compact DigestSet,
+    see utility.membership.
+    """
+    if database.backend is not None:
+        rows = ((sha256, ) for sha256 in database.backend.processed())
+    else:
+        rows = database.access(
+            'SELECT sha256 from results UNION SELECT sha256 from errors;',
+            name='processed_apks')
+    return DigestSet.from_rows(rows)
 
 
 class GplayApkManager(ApkManager):
@@ -32,13 +48,14 @@ class GplayApkManager(ApkManager):
                                     '**'),
                        recursive=True), '*.apk')
         # Build set of already processed apks (in case the analysis was interrupted
-        done = set(e[0] for e in database.access(
-            'SELECT sha256 from results UNION SELECT sha256 from errors;'))
+        done = processed_apks()
         self.logger.info(f'Found {len(done)} already processed apks.')
         # Compute directories for each apk. This has to be a list as order matters
         dirs = [os.path.dirname(apk) for apk in apks]
         # Compute sha256 identifier for each apk. This has to be a list as order matters
         hashes = [sha256sum(apk) for apk in apks]
+        # Look up all identifiers at once, True marks the ones already processed
+        processed = done.contains(hashes)
         apks = []
         # Build a list of tuples, each of them containing (in order)
         # - sha265 identifier of the apk (str)
@@ -48,10 +65,10 @@ class GplayApkManager(ApkManager):
         # - function to execute after the analysis of the apk (function)
         #   -> In our case, this removes obsolete data (e.g. from decompiling) to save on disk space
         #
-        # You should use the previously computed set (done) as a filter to avoid repeat work
-        for h, d, c, r in zip(hashes, dirs, repeat(store_gplay_apk_info),
-                              repeat(clean.google_play_remnants)):
-            if h not in done:
+        # You should use the previously computed mask (processed) as a filter to avoid repeat work
+        for h, d, c, r, p in zip(hashes, dirs, repeat(store_gplay_apk_info),
+                                 repeat(clean.google_play_remnants), processed):
+            if not p:
                 apks.append((h, d, c, r))
         self.logger.info(f'Initialized with {len(apks)} apks.')
         # Initialize the list of apks with the precomputed list of tuples.
@@ -91,15 +108,17 @@ class FDroidApkManager(ApkManager):
             glob.iglob(os.path.join(os.path.expanduser(os.path.abspath(path)),
                                     '**'),
                        recursive=True), '*.apk')
-        done = set(e[0] for e in database.access(
-            'SELECT sha256 from results UNION SELECT sha256 from errors;'))
+        done = processed_apks()
         self.logger.info(f'Found {len(done)} already processed apks.')
         dirs = [os.path.dirname(apk) for apk in apk_paths]
         hashes = [sha256sum(apk) for apk in apk_paths]
+        processed = done.contains(hashes)
         apks = []
-        for h, d, c, r, p in zip(hashes, dirs, repeat(store_fdroid_apk_info),
-                                 repeat(clean.fdroid_remnants), apk_paths):
-            if h not in done:
+        for h, d, c, r, p, skip in zip(hashes, dirs,
+                                       repeat(store_fdroid_apk_info),
+                                       repeat(clean.fdroid_remnants),
+                                       apk_paths, processed):
+            if not skip:
                 apks.append((h, d, c, r))
                 with open(os.path.join(os.path.dirname(p), h), 'w') as file:
                     file.write(p.split('/')[-1].split('.apk')[0] + '\n')
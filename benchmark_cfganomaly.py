@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import os
+import pickle
+import random
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.sparse import csr_matrix, load_npz, random as sparse_random, vstack
+from scipy.stats import spearmanr
+from sklearn.ensemble import IsolationForest
+
+from cfganomaly import cfganomaly
+from cfganomaly.cfganomaly import BasicBlock, ControlFlowGraph
+from cfganomaly.corpus import Corpus, Deduplicator
+from cfganomaly.subforests import train_subforests
+from cfganomaly.forest import CascadedForest, FlatForest, fit_distinct, flatten_forest, is_forest
+from utility.convenience import CUTOFF_SCORE
+
+EXIT_TYPES = "CGIRST"
+
+
+def random_cfg(rng, size, max_edges=4, exception_rate=0.2, empty_rate=0.05):
+    """Generates a random CFG resembling the ones built by cfganomaly.build_cfg.
+
+    Blocks without exit instruction only get regular edges and are never the target of
+    exception edges, like the "-pre" blocks inserted for self loops.
+    """
+    exits = [
+        None if rng.random() < empty_rate else rng.choice(EXIT_TYPES)
+        for _ in range(size)
+    ]
+    exits[0] = rng.choice(EXIT_TYPES)
+    with_exit = [idx for idx in range(size) if exits[idx] is not None]
+    cfg = []
+    for idx in range(size):
+        edges = [rng.randrange(size) for _ in range(rng.randint(0, max_edges))]
+        exceptions = []
+        if exits[idx] is not None and rng.random() < exception_rate:
+            exceptions = [
+                rng.choice(with_exit) for _ in range(rng.randint(1, 3))
+            ]
+        cfg.append(BasicBlock(idx, edges, exceptions, exits[idx]))
+    return cfg
+
+
+def switch_cfg(size, fan_out):
+    """Generates a CFG dominated by dense switch tables, the worst case for the DFS."""
+    cfg = []
+    for idx in range(size):
+        if idx % 4 == 0:
+            edges = [(idx + k) % (size - 1) + 1 for k in range(1, fan_out + 1)]
+            cfg.append(BasicBlock(idx, edges, [], 'S'))
+        else:
+            cfg.append(BasicBlock(idx, [(idx + 1) % (size - 1) + 1], [], 'C'))
+    return cfg
+
+
+def traverse_blocks(cfg, visitor, start_node=0):
+    """Traversal over a list of BasicBlock objects, as done before ControlFlowGraph existed."""
+    if len(cfg) == 0:
+        return
+
+    class StackEntry:
+
+        def __init__(self, idx, is_exception=False):
+            self.bb_idx = idx
+            self.edge_idx = 0
+            self.exception_idx = 0
+            self.is_exception = is_exception
+
+    stack = [StackEntry(start_node)]
+
+    while stack:
+        entry = stack[-1]
+        bb = cfg[entry.bb_idx]
+
+        if entry.edge_idx == 0 and entry.exception_idx == 0:
+            visitor.enter(entry.bb_idx)
+            visitor.process(entry.bb_idx, entry.is_exception)
+
+        next_bb = None
+        is_exception_edge = False
+        if entry.edge_idx < len(bb.edges):
+            next_bb = bb.edges[entry.edge_idx]
+            entry.edge_idx += 1
+        elif entry.exception_idx < len(bb.exceptions):
+            next_bb = bb.exceptions[entry.exception_idx]
+            is_exception_edge = True
+            entry.exception_idx += 1
+
+        if next_bb and visitor.do_traverse(next_bb):
+            stack.append(StackEntry(next_bb, is_exception_edge))
+        else:
+            visitor.exit(entry.bb_idx)
+            stack.pop()
+
+
+def traverse_all(cfg, traverse, max_n):
+    """The traversals done by count_ngrams_dfs: one DFS, and a depth limited one per block it reaches."""
+    visitor = cfganomaly.StartVisitor(cfg)
+    traverse(cfg, visitor)
+    for idx in visitor.nodes:
+        traverse(cfg, cfganomaly.DepthLimitVisitor(cfg, max_n), idx)
+    return visitor.nodes
+
+
+def measure(build, specs):
+    """Returns the mean retained and peak memory in bytes of building one CFG per spec."""
+    retained = peak = 0
+    tracemalloc.start()
+    for spec in specs:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        cfg = build(spec)
+        current, spec_peak = tracemalloc.get_traced_memory()
+        retained += current - start
+        peak += spec_peak - start
+        del cfg
+    tracemalloc.stop()
+    return retained / len(specs), peak / len(specs)
+
+
+def check_ngrams(arguments):
+    rng = random.Random(arguments.seed)
+    for i in range(arguments.cfgs):
+        blocks = random_cfg(rng, rng.randint(1, arguments.max_size))
+        cfg = ControlFlowGraph.from_blocks(blocks)
+        for max_n in range(1, arguments.max_n + 1):
+            expected = cfganomaly.count_ngrams_dfs(cfg, max_n)
+            actual = cfganomaly.count_ngrams(cfg, max_n)
+            if expected != actual:
+                raise SystemExit(
+                    f'Mismatch for CFG #{i} with max_n={max_n}:\n'
+                    f'{[str(bb) for bb in blocks]}\n{expected}\n{actual}')
+    print(f'Counts of {arguments.cfgs} random CFGs are identical for max_n'
+          f' up to {arguments.max_n}.')
+    print(f'\n{"blocks":>8} {"fan-out":>8} {"dfs":>12} {"dp":>12} {"speedup":>8}')
+    for fan_out in (2, 4, 8, 16, 32):
+        cfg = ControlFlowGraph.from_blocks(switch_cfg(arguments.blocks, fan_out))
+        start = time.perf_counter()
+        expected = cfganomaly.count_ngrams_dfs(cfg, arguments.max_n)
+        dfs = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = cfganomaly.count_ngrams(cfg, arguments.max_n)
+        dp = time.perf_counter() - start
+        assert expected == actual
+        print(f'{len(cfg):>8} {fan_out:>8} {dfs:>11.4f}s {dp:>11.4f}s'
+              f' {dfs / dp:>7.1f}x')
+
+
+def compare_cfgs(arguments):
+    rng = random.Random(arguments.seed)
+    print(f'{"blocks":>8} {"objects":>10} {"peak":>10} {"arrays":>10} {"peak":>10}'
+          f' {"objects":>12} {"arrays":>12} {"speedup":>8}')
+    for size in arguments.sizes:
+        specs = [[(bb.edges, bb.exceptions, bb.exit)
+                  for bb in random_cfg(rng, size)]
+                 for _ in range(arguments.cfgs)]
+        objects = measure(
+            lambda spec: [
+                BasicBlock(idx, list(edges), list(exceptions), exit)
+                for idx, (edges, exceptions, exit) in enumerate(spec)
+            ], specs)
+        arrays = measure(ControlFlowGraph.build, specs)
+
+        block_cfgs = [[
+            BasicBlock(idx, edges, exceptions, exit)
+            for idx, (edges, exceptions, exit) in enumerate(spec)
+        ] for spec in specs]
+        array_cfgs = [ControlFlowGraph.build(spec) for spec in specs]
+        start = time.perf_counter()
+        expected = [
+            traverse_all(cfg, traverse_blocks, arguments.max_n)
+            for cfg in block_cfgs
+        ]
+        old = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = [
+            traverse_all(cfg, cfganomaly.traverse_cfg, arguments.max_n)
+            for cfg in array_cfgs
+        ]
+        new = time.perf_counter() - start
+        assert expected == actual
+        print(f'{size:>8} {objects[0]:>9.0f}B {objects[1]:>9.0f}B'
+              f' {arrays[0]:>9.0f}B {arrays[1]:>9.0f}B'
+              f' {size * len(specs) / old:>8.0f}bb/s'
+              f' {size * len(specs) / new:>8.0f}bb/s {old / new:>7.1f}x')
+
+
+def load_forest(path):
+    if is_forest(path):
+        return FlatForest.load(path)
+    with gzip.open(path, 'rb') as f:
+        return flatten_forest(pickle.load(f))
+
+
+def validate_cascade(arguments):
+    forest = load_forest(os.path.abspath(arguments.model))
+    if arguments.vectors:
+        samples = load_npz(arguments.vectors).tocsr().astype(np.float32)
+    else:
+        samples = sparse_random(arguments.samples,
+                                forest.n_features,
+                                density=arguments.density,
+                                format='csr',
+                                dtype=np.float32,
+                                random_state=arguments.seed)
+    start = time.perf_counter()
+    expected = forest.score_samples(samples)
+    full = time.perf_counter() - start
+    anomalous = expected < arguments.cutoff
+    print(f'{samples.shape[0]} samples, {anomalous.sum()} anomalous with all'
+          f' {len(forest)} trees ({full:.3f}s).')
+    print(f'\n{"trees":>6} {"confidence":>10} {"stopped":>8} {"saved":>8}'
+          f' {"differing":>9} {"max error":>10} {"time":>8}')
+    for trees in arguments.trees:
+        for confidence in arguments.confidence:
+            cascade = CascadedForest(forest, arguments.cutoff, trees,
+                                     confidence)
+            start = time.perf_counter()
+            actual = cascade.score_samples(samples)
+            elapsed = time.perf_counter() - start
+            differing = ((actual < arguments.cutoff) != anomalous).sum()
+            print(f'{trees:>6} {confidence:>10} {cascade.exits:>8}'
+                  f' {cascade.saved_evaluations() * 100:>7.2f}% {differing:>9}'
+                  f' {np.abs(actual - expected).max():>10.6f} {elapsed:>7.3f}s')
+
+
+def random_corpus(rng, count, max_size, max_n):
+    """N-gram counts and block counts of random CFGs."""
+    corpus = []
+    for _ in range(count):
+        blocks = random_cfg(rng, rng.randint(30, max_size))
+        for bb in blocks:
+            # Like in real methods, nothing follows a return
+            if bb.exit == 'R':
+                bb.edges, bb.exceptions = [], []
+        cfg = ControlFlowGraph.from_blocks(blocks)
+        corpus.append((cfganomaly.count_ngrams(cfg, max_n), len(cfg)))
+    return corpus
+
+
+def vectorize_corpus(vectorizer, corpus):
+    rows = [vectorizer.vectorize_sparse(ngrams, size) for ngrams, size in corpus]
+    indptr = np.cumsum([0] + [len(columns) for columns, _ in rows])
+    return csr_matrix((np.concatenate([values for _, values in rows]),
+                       np.concatenate([columns for columns, _ in rows]), indptr),
+                      shape=(len(rows), vectorizer.width))
+
+
+def train_and_score(train, test, arguments, seed):
+    model = IsolationForest(n_estimators=arguments.estimators,
+                            max_samples=1.0,
+                            random_state=seed)
+    model.fit(train)
+    start = time.perf_counter()
+    scores = model.score_samples(test)
+    return scores, time.perf_counter() - start, len(pickle.dumps(model))
+
+
+def compare_vocabularies(arguments):
+    rng = random.Random(arguments.seed)
+    corpus = random_corpus(rng, arguments.cfgs, arguments.max_size,
+                           arguments.max_n)
+    full = cfganomaly.NgramVectorizer(arguments.max_n)
+    if arguments.vectors:
+        vectors = load_npz(arguments.vectors).tocsr().astype(np.float32)
+    else:
+        vectors = vectorize_corpus(full, corpus)
+    train, test = vectors[::2], vectors[1::2]
+    support = train.getnnz(axis=0)
+
+    expected, expected_time, expected_size = train_and_score(
+        train, test, arguments, arguments.seed)
+    anomalies = set(np.argsort(expected)[:arguments.top])
+    print(f'{train.shape[0]} training and {test.shape[0]} test vectors,'
+          f' {(support > 0).sum()} of {full.width} columns are ever non-zero.')
+    print(f'\n{"support":>8} {"columns":>8} {"vector":>8} {"model":>9}'
+          f' {"vectorize":>10} {"scoring":>8} {"spearman":>8} {"top":>6}')
+
+    def report(label, vectorizer, scores, scoring_time, model_size):
+        start = time.perf_counter()
+        for ngrams, size in corpus:
+            vectorizer.vectorize(ngrams, size)
+        vectorize_time = time.perf_counter() - start
+        top = len(anomalies & set(np.argsort(scores)[:arguments.top]))
+        print(f'{label:>8} {vectorizer.width:>8} {vectorizer.width * 4:>7}B'
+              f' {model_size:>8}B {len(corpus) / vectorize_time:>8.0f}/s'
+              f' {scoring_time:>7.3f}s {spearmanr(expected, scores)[0]:>8.4f}'
+              f' {top / max(1, len(anomalies)) * 100:>5.1f}%')
+
+    report('all', full, expected, expected_time, expected_size)
+    # Retraining with another seed shows how much rankings change without pruning
+    report('reseed', full,
+           *train_and_score(train, test, arguments, arguments.seed + 1))
+    for min_support in arguments.support:
+        vocabulary = cfganomaly.prune_vocabulary(support, min_support)
+        report(min_support,
+               cfganomaly.NgramVectorizer(arguments.max_n, vocabulary),
+               *train_and_score(train[:, vocabulary], test[:, vocabulary],
+                                arguments, arguments.seed))
+
+
+def random_apks(rng, arguments):
+    """Vectors and size bins of random apks, which share methods of a few random libraries."""
+    vectorizer = cfganomaly.NgramVectorizer(arguments.max_n)
+    library = vectorize_corpus(
+        vectorizer,
+        random_corpus(rng, arguments.library, arguments.max_size,
+                      arguments.max_n))
+    library_bins = [rng.randint(8, 11) for _ in range(arguments.library)]
+    for _ in range(arguments.apks):
+        own = rng.randint(1, arguments.methods)
+        matrix = vectorize_corpus(
+            vectorizer, random_corpus(rng, own, arguments.max_size,
+                                      arguments.max_n))
+        # Popular library methods are shared by most apks
+        shared = sorted({
+            min(int(rng.paretovariate(1.0)) - 1, arguments.library - 1)
+            for _ in range(arguments.methods)
+        })
+        yield (vstack([matrix, library[shared]], format='csr'),
+               np.array([rng.randint(8, 11) for _ in range(own)] +
+                        [library_bins[idx] for idx in shared]))
+
+
+def fit(matrix, weights, arguments, counts=None):
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = IsolationForest(n_estimators=arguments.estimators,
+                            max_samples=1.0,
+                            random_state=arguments.seed)
+    if counts is None:
+        model.fit(matrix.tocsc(), sample_weight=weights)
+    else:
+        fit_distinct(model, matrix.tocsc(), counts, weights)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return model, elapsed, peak
+
+
+def compare_deduplication(arguments):
+    if arguments.corpus:
+        apks = [(matrix, bins)
+                for _, matrix, bins in Corpus.open(arguments.corpus).shards()]
+    else:
+        apks = list(random_apks(random.Random(arguments.seed), arguments))
+    # Whole apks are held out, like new apps scored with the trained model
+    step = max(2, round(1 / arguments.holdout))
+    test = vstack([matrix for matrix, _ in apks[::step]], format='csr')
+    train = [apk for idx, apk in enumerate(apks) if idx % step]
+    matrix = vstack([matrix for matrix, _ in train], format='csr')
+    bins = np.concatenate([bins for _, bins in train])
+
+    start = time.perf_counter()
+    deduplicator = Deduplicator()
+    keep = deduplicator.add(matrix, bins)
+    hashing = time.perf_counter() - start
+    counts = np.array(deduplicator.counts)
+    print(f'{matrix.shape[0]} training vectors of {len(train)} apps, {len(deduplicator)}'
+          f' distinct ({matrix.shape[0] / len(deduplicator):.2f}x deduplication,'
+          f' hashed in {hashing:.3f}s), {test.shape[0]} held-out vectors.')
+
+    all_model, all_time, all_peak = fit(matrix, 1 / bins, arguments)
+    unique_model, unique_time, unique_peak = fit(matrix[keep],
+                                                 counts / bins[keep],
+                                                 arguments, counts)
+    # Retraining with another seed shows how much scores change anyway
+    arguments.seed += 1
+    reseed_model, reseed_time, reseed_peak = fit(matrix, 1 / bins, arguments)
+    expected = all_model.score_samples(test)
+    print(f'\n{"training":>9} {"fit":>8} {"peak":>10} {"anomalous":>9}'
+          f' {"spearman":>8} {"differing":>9}')
+    for label, model, elapsed, peak in (
+        ('all', all_model, all_time, all_peak),
+        ('reseed', reseed_model, reseed_time, reseed_peak),
+        ('distinct', unique_model, unique_time, unique_peak),
+    ):
+        scores = model.score_samples(test)
+        # Held-out vectors are normal, so fewer of them scoring as anomalous is better
+        differing = ((expected < arguments.cutoff) !=
+                     (scores < arguments.cutoff)).sum()
+        print(f'{label:>9} {elapsed:>7.3f}s {peak / 2**20:>8.1f}MB'
+              f' {(scores < arguments.cutoff).mean() * 100:>8.3f}%'
+              f' {spearmanr(expected, scores)[0]:>8.4f} {differing:>9}')
+
+
+def compare_subforests(arguments):
+    with tempfile.TemporaryDirectory() as directory:
+        if arguments.corpus:
+            corpus = Corpus.open(arguments.corpus)
+        else:
+            corpus = Corpus(directory, {'max_n': arguments.max_n})
+            for idx, (matrix, bins) in enumerate(
+                    random_apks(random.Random(arguments.seed), arguments)):
+                corpus.write_shard(f'random-{idx}', matrix, bins)
+                corpus.commit(f'random-{idx}', matrix.shape[0], 0)
+        names = [name for name, (rows, _) in corpus.completed().items() if rows]
+        # Whole apks are held out, like new apps scored with the trained model
+        step = max(2, round(1 / arguments.holdout))
+        held_out = set(names[::step])
+        test = vstack([
+            matrix for name, matrix, _ in corpus.shards() if name in held_out
+        ], format='csr')
+        train = [(matrix, bins)
+                 for name, matrix, bins in corpus.shards()
+                 if name not in held_out]
+        matrix = vstack([matrix for matrix, _ in train], format='csr')
+        bins = np.concatenate([bins for _, bins in train])
+        print(f'{matrix.shape[0]} training vectors of {len(train)} apps,'
+              f' {test.shape[0]} held-out vectors.')
+
+        full, full_time, full_peak = fit(matrix, 1 / bins, arguments)
+        expected = full.score_samples(test)
+        start = time.perf_counter()
+        merged, subforests = train_subforests(
+            corpus, arguments.parts, arguments.samples, arguments.estimators,
+            seed=arguments.seed, names=set(names) - held_out)
+        merged_time = time.perf_counter() - start
+        actual = merged.score_samples(test)
+        flat = flatten_forest(merged).score_samples(test)
+
+    print(f'\n{"training":>9} {"samples":>8} {"fit":>8} {"peak":>10} {"anomalous":>9}'
+          f' {"spearman":>8} {"differing":>9}')
+    for label, model, elapsed, peak in (
+        ('all', full, full_time, full_peak),
+        (f'{len(subforests)} parts', merged, merged_time,
+         max(peak for _, peak in subforests)),
+    ):
+        scores = model.score_samples(test)
+        differing = ((expected < arguments.cutoff) !=
+                     (scores < arguments.cutoff)).sum()
+        print(f'{label:>9} {model._max_samples:>8} {elapsed:>7.3f}s'
+              f' {peak / 2**20:>8.1f}MB'
+              f' {(scores < arguments.cutoff).mean() * 100:>8.3f}%'
+              f' {spearmanr(expected, scores)[0]:>8.4f} {differing:>9}')
+    print(f'\nSlowest sub-forest took {max(elapsed for elapsed, _ in subforests):.3f}s,'
+          f' the exported merged forest differs by {np.abs(flat - actual).max()}.')
+
+
+parser = argparse.ArgumentParser(
+    'Tool for checking and benchmarking the CFG anomaly detector.')
+subparsers = parser.add_subparsers(required=True)
+ngrams = subparsers.add_parser(
+    'ngrams',
+    help='Checks count_ngrams against the DFS reference on random CFGs and'
+    ' compares their run time on CFGs with dense switch tables.')
+ngrams.add_argument('--cfgs',
+                    type=int,
+                    default=1000,
+                    help='number of random CFGs to check')
+ngrams.add_argument('--max_size',
+                    type=int,
+                    default=40,
+                    help='maximum number of blocks of a random CFG')
+ngrams.add_argument('--blocks',
+                    type=int,
+                    default=200,
+                    help='number of blocks of the benchmark CFGs')
+ngrams.add_argument('--max_n', type=int, default=5, help='maximum n-gram size')
+ngrams.add_argument('--seed', type=int, default=0, help='random seed')
+ngrams.set_defaults(func=check_ngrams)
+cfgs = subparsers.add_parser(
+    'cfg',
+    help='Compares memory per method and traversal throughput of the array'
+    ' based ControlFlowGraph with lists of BasicBlock objects.')
+cfgs.add_argument('--cfgs',
+                  type=int,
+                  default=200,
+                  help='number of random CFGs per size')
+cfgs.add_argument('--sizes',
+                  type=int,
+                  nargs='+',
+                  default=[30, 100, 1000],
+                  help='numbers of blocks of the random CFGs')
+cfgs.add_argument('--max_n', type=int, default=5, help='maximum n-gram size')
+cfgs.add_argument('--seed', type=int, default=0, help='random seed')
+cfgs.set_defaults(func=compare_cfgs)
+cascade = subparsers.add_parser(
+    'cascade',
+    help='Compares anomaly decisions and tree evaluations of cascaded scoring'
+    ' with scoring on all trees.')
+cascade.add_argument(
+    'model',
+    help='trained model (.pickle.gz) or forest exported by export_cfganomaly.py')
+cascade.add_argument(
+    '--vectors',
+    help='validation corpus, a sparse matrix of feature vectors stored with'
+    ' scipy.sparse.save_npz. Random vectors are used if omitted.')
+cascade.add_argument('--samples',
+                     type=int,
+                     default=10000,
+                     help='number of random vectors')
+cascade.add_argument('--density',
+                     type=float,
+                     default=0.02,
+                     help='fraction of non-zero features of random vectors')
+cascade.add_argument('--cutoff',
+                     type=float,
+                     default=CUTOFF_SCORE,
+                     help='scores below this are anomalous')
+cascade.add_argument('--trees',
+                     type=int,
+                     nargs='+',
+                     default=[10, 30, 100],
+                     help='numbers of trees evaluated before stopping early')
+cascade.add_argument('--confidence',
+                     type=float,
+                     nargs='+',
+                     default=[1.0, 0.999, 0.99],
+                     help='confidences of the bounds used for stopping early')
+cascade.add_argument('--seed', type=int, default=0, help='random seed')
+cascade.set_defaults(func=validate_cascade)
+vocabulary = subparsers.add_parser(
+    'vocabulary',
+    help='Compares vector width, model size, vectorization and scoring speed and'
+    ' the ranking of anomalies of models trained on pruned vocabularies with a'
+    ' model trained on all columns.')
+vocabulary.add_argument(
+    '--vectors',
+    help='corpus of full width feature vectors stored with'
+    ' scipy.sparse.save_npz, half of it is used for training. Vectors of random'
+    ' CFGs are used if omitted.')
+vocabulary.add_argument('--cfgs',
+                        type=int,
+                        default=4000,
+                        help='number of random CFGs')
+vocabulary.add_argument('--max_size',
+                        type=int,
+                        default=200,
+                        help='maximum number of blocks of a random CFG')
+vocabulary.add_argument('--max_n', type=int, default=5, help='maximum n-gram size')
+vocabulary.add_argument('--support',
+                        type=int,
+                        nargs='+',
+                        default=[1, 5, 20, 100],
+                        help='minimum supports to prune the vocabulary with')
+vocabulary.add_argument('--estimators',
+                        type=int,
+                        default=100,
+                        help='number of trees of the trained models')
+vocabulary.add_argument('--top',
+                        type=int,
+                        default=50,
+                        help='number of most anomalous test vectors to compare')
+vocabulary.add_argument('--seed', type=int, default=0, help='random seed')
+vocabulary.set_defaults(func=compare_vocabularies)
+deduplication = subparsers.add_parser(
+    'dedup',
+    help='Compares fit time, peak memory and held-out scores of models trained'
+    ' on all training vectors and on distinct vectors weighted by their count.')
+deduplication.add_argument(
+    '--corpus',
+    help='corpus directory written by train_cfganomaly.py. Random apps are used'
+    ' if omitted.')
+deduplication.add_argument('--holdout',
+                           type=float,
+                           default=0.2,
+                           help='fraction of apps held out for scoring')
+deduplication.add_argument('--apks',
+                           type=int,
+                           default=100,
+                           help='number of random apps')
+deduplication.add_argument('--methods',
+                           type=int,
+                           default=40,
+                           help='maximum number of own and of library methods'
+                           ' of a random app')
+deduplication.add_argument('--library',
+                           type=int,
+                           default=200,
+                           help='number of random library methods')
+deduplication.add_argument('--max_size',
+                           type=int,
+                           default=100,
+                           help='maximum number of blocks of a random CFG')
+deduplication.add_argument('--max_n',
+                           type=int,
+                           default=5,
+                           help='maximum n-gram size')
+deduplication.add_argument('--estimators',
+                           type=int,
+                           default=100,
+                           help='number of trees of the trained models')
+deduplication.add_argument('--cutoff',
+                           type=float,
+                           default=CUTOFF_SCORE,
+                           help='scores below this are anomalous')
+deduplication.add_argument('--seed', type=int, default=0, help='random seed')
+deduplication.set_defaults(func=compare_deduplication)
+subforests = subparsers.add_parser(
+    'subforests',
+    help='Compares fit time, peak memory and held-out scores of a forest merged'
+    ' from sub-forests fitted in parallel with one fitted on all vectors.')
+subforests.add_argument(
+    '--corpus',
+    help='corpus directory written by train_cfganomaly.py. Random apps are used'
+    ' if omitted.')
+subforests.add_argument('--parts',
+                        type=int,
+                        default=4,
+                        help='number of sub-forests')
+subforests.add_argument('--samples',
+                        type=int,
+                        default=1000,
+                        help='number of vectors per sub-forest')
+subforests.add_argument('--holdout',
+                        type=float,
+                        default=0.2,
+                        help='fraction of apps held out for scoring')
+subforests.add_argument('--apks',
+                        type=int,
+                        default=200,
+                        help='number of random apps')
+subforests.add_argument('--methods',
+                        type=int,
+                        default=40,
+                        help='maximum number of own and of library methods'
+                        ' of a random app')
+subforests.add_argument('--library',
+                        type=int,
+                        default=200,
+                        help='number of random library methods')
+subforests.add_argument('--max_size',
+                        type=int,
+                        default=100,
+                        help='maximum number of blocks of a random CFG')
+subforests.add_argument('--max_n', type=int, default=5, help='maximum n-gram size')
+subforests.add_argument('--estimators',
+                        type=int,
+                        default=100,
+                        help='total number of trees of the trained models')
+subforests.add_argument('--cutoff',
+                        type=float,
+                        default=CUTOFF_SCORE,
+                        help='scores below this are anomalous')
+subforests.add_argument('--seed', type=int, default=0, help='random seed')
+subforests.set_defaults(func=compare_subforests)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -1,35 +1,100 @@
-import json
 import logging
-import operator
+from bisect import bisect_right
 from collections import Counter
-from itertools import product
+from hashlib import sha256
+from itertools import chain, product
 
 import numpy as np
+from scipy.sparse import csr_matrix
 
-from compatibility.androguard import method2json_direct
 from utility.exceptions import CfgAnomalyError
 
+EXIT_TYPES = "CEGIRST"
+EXIT_CODES = {exit: code for code, exit in enumerate(EXIT_TYPES, 1)}
+EXCEPTION = EXIT_CODES['E']
+# Columns of invalid n-grams and of n-grams dropped from a pruned vocabulary
+INVALID = -1
+PRUNED = -2
+
 
 class BasicBlock:
 
-    def __init__(self, bb, mapping):
-        self.idx = mapping[bb['BasicBlockId']]
-        self.edges = [mapping[bb_id] for bb_id in bb['Edge']]
-        # self.edges = list(set([mapping[bb_id] for bb_id in bb['Edge']]))
-        self.exit = instruction_shorthand(
+    def __init__(self, idx, edges, exceptions, exit):
+        self.idx = idx
+        self.edges = edges
+        self.exceptions = exceptions
+        self.exit = exit
+
+    @classmethod
+    def from_json(cls, bb, mapping):
+        edges = [mapping[bb_id] for bb_id in bb['Edge']]
+        # edges = list(set([mapping[bb_id] for bb_id in bb['Edge']]))
+        exit = instruction_shorthand(
             bb['instructions'][-1]['name']) if bb['instructions'] else None
         if 'Exceptions' in bb:
-            self.exceptions = [
-                mapping[e['bb']] for e in bb['Exceptions']['list']
-            ]
+            exceptions = [mapping[e['bb']] for e in bb['Exceptions']['list']]
         else:
-            self.exceptions = []
+            exceptions = []
+        return cls(mapping[bb['BasicBlockId']], edges, exceptions, exit)
 
     def __str__(self):
         return "BB #{}: Edges: {}, Exceptions: {}, Exit instruction: {}".format(
             self.idx, self.edges, self.exceptions, self.exit)
 
 
+class ControlFlowGraph:
+    """
+   Compact, array-backed control flow graph of a method.
+
+   Edges are stored in CSR form: the regular successors of block i are
+   edges[edge_offsets[i]:edge_offsets[i + 1]] and its exception handlers are
+   exceptions[exception_offsets[i]:exception_offsets[i + 1]]. exits holds the exit
+   type of each block as digit of EXIT_CODES, or 0 for blocks without instructions.
+   """
+
+    __slots__ = ('exits', 'edge_offsets', 'edges', 'exception_offsets',
+                 'exceptions')
+
+    def __init__(self, exits, edge_offsets, edges, exception_offsets,
+                 exceptions):
+        self.exits = exits
+        self.edge_offsets = edge_offsets
+        self.edges = edges
+        self.exception_offsets = exception_offsets
+        self.exceptions = exceptions
+
+    @classmethod
+    def build(cls, blocks):
+        """
+      Builds the graph from an iterable of (edges, exceptions, exit) triples, one per block
+      in index order, where exit is the shorthand of the exit instruction or None.
+      """
+        exits = bytearray()
+        edge_offsets = [0]
+        edges = []
+        exception_offsets = [0]
+        exceptions = []
+        for block_edges, block_exceptions, exit in blocks:
+            exits.append(EXIT_CODES[exit] if exit else 0)
+            edges += block_edges
+            edge_offsets.append(len(edges))
+            exceptions += block_exceptions
+            exception_offsets.append(len(exceptions))
+        return cls(np.frombuffer(exits, dtype=np.uint8),
+                   np.array(edge_offsets, dtype=np.int32),
+                   np.array(edges, dtype=np.int32),
+                   np.array(exception_offsets, dtype=np.int32),
+                   np.array(exceptions, dtype=np.int32))
+
+    @classmethod
+    def from_blocks(cls, basic_blocks):
+        return cls.build((bb.edges, bb.exceptions, bb.exit)
+                         for bb in sorted(basic_blocks, key=lambda bb: bb.idx))
+
+    def __len__(self):
+        return len(self.exits)
+
+
 class DepthLimitVisitor:
 
     def __init__(self, cfg, limit):
@@ -75,12 +140,14 @@ class LocalNgramVisitor(DepthLimitVisitor):
         super().__init__(cfg, n)
         self.n = n
         self.ngrams = Counter()
+        self.exits = memoryview(cfg.exits)
+        # Codes of the window's prefixes, the last one encodes the entire window
         self.window = []
 
     def process(self, idx, is_exception):
-        instr = self.cfg[idx].exit
+        code = self.exits[idx]
 
-        if instr is None:
+        if not code:
             return
 
         # If we got here through an exception edge, we need to remove the
@@ -89,18 +156,18 @@ class LocalNgramVisitor(DepthLimitVisitor):
         # exception edges after all regular edges.
         if is_exception:
             self.window.pop()
-            self.window.append('E')
+            self.window.append((self.window[-1] if self.window else 0) << 3
+                               | EXCEPTION)
 
-        self.window.append(instr)
+        self.window.append((self.window[-1] if self.window else 0) << 3
+                           | code)
         assert len(self.window) <= self.limit
-        for i in range(len(self.window)):
-            ngram = ''.join(list(self.window)[i:])
-            self.ngrams[ngram] += 1
+        count_suffixes(self.ngrams, self.window[-1], 1)
 
     def exit(self, idx):
         super().exit(idx)
         # If exit instruction is None, we haven't pushed anything, skip pop
-        if self.cfg[idx].exit is not None:
+        if self.exits[idx]:
             self.window.pop()
 
     def get_ngrams(self):
@@ -120,29 +187,160 @@ class GlobalNgramVisitor(DFSVisitor):
         self.ngrams += visitor.get_ngrams()
 
 
+class StartVisitor(DFSVisitor):
+    """Collects the nodes GlobalNgramVisitor starts a local traversal from."""
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.nodes = []
+
+    def process(self, idx, is_exception):
+        self.nodes.append(idx)
+
+
 class NgramVectorizer:
+    """
+   Turns n-gram counts into feature vectors, one column per valid n-gram.
 
-    def __init__(self, max_n=5):
-        exit_types = "CEGIRST"
+   If the model was trained on a pruned vocabulary, only the columns listed in it are
+   kept, in the same order, and n-grams of dropped columns are ignored.
+   """
+
+    def __init__(self, max_n=5, vocabulary=None):
         exit_combinations = []
         # Generate all valid exit type combinations, taking into account that
         # we cannot have multiple returns along a path in the CFG.
         for i in range(1, max_n + 1):
             exit_combinations += [
-                ''.join(n) for n in product(exit_types, repeat=i)
+                ''.join(n) for n in product(EXIT_TYPES, repeat=i)
                 if 'R' not in n[:-1]
             ]
-        self._vectorizer = {n: 0 for n in exit_combinations}
+        # Columns are ordered by n-gram, as expected by the trained model.
+        # Codes of invalid n-grams map to INVALID.
+        self.columns = np.full(8**max_n, INVALID, dtype=np.intp)
+        for column, ngram in enumerate(sorted(exit_combinations)):
+            self.columns[encode_ngram(ngram)] = column
+        self.width = len(exit_combinations)
+        self.vocabulary = None
+        if vocabulary is not None:
+            self.vocabulary = np.asarray(vocabulary, dtype=np.intp)
+            # Maps columns of the full vocabulary to the retained ones
+            self.retained = np.full(self.width, PRUNED, dtype=np.intp)
+            self.retained[self.vocabulary] = np.arange(len(self.vocabulary))
+            valid = self.columns != INVALID
+            self.columns[valid] = self.retained[self.columns[valid]]
+            self.width = len(self.vocabulary)
 
     def vectorize(self, ngrams, bb_count):
-        vector = Counter(self._vectorizer)
-        vector.update(ngrams)
+        columns, values = self.vectorize_sparse(ngrams, bb_count)
+        vector = np.zeros(self.width, dtype=np.float32)
+        vector[columns] = values
+        return vector
+
+    def vectorize_sparse(self, ngrams, bb_count):
+        """
+      Sparse form of vectorize, only a few hundred of the columns are non-zero.
+
+      Returns
+      -------
+      The sorted non-zero columns and their float32 values, i.e., a CSR row.
+      """
+        codes = np.fromiter(ngrams.keys(), dtype=np.intp, count=len(ngrams))
+        counts = np.fromiter(ngrams.values(),
+                             dtype=np.float64,
+                             count=len(ngrams))
+        columns = self.columns[codes]
         # Sanity check that we didn't get any invalid ngrams added
-        assert len(vector) == len(self._vectorizer)
-        return np.array([
-            v / bb_count
-            for k, v in sorted(vector.items(), key=operator.itemgetter(0))
-        ], dtype=np.float32)
+        assert (columns != INVALID).all()
+        if self.vocabulary is not None:
+            retained = columns >= 0
+            columns = columns[retained]
+            counts = counts[retained]
+        order = np.argsort(columns)
+        return columns[order], (counts[order] / bb_count).astype(np.float32)
+
+    def prune(self, columns, values):
+        """Maps a row vectorized with the full vocabulary to the columns of this one."""
+        if self.vocabulary is None:
+            return columns, values
+        columns = self.retained[columns]
+        retained = columns >= 0
+        columns = columns[retained]
+        values = values[retained]
+        order = np.argsort(columns)
+        return columns[order], values[order]
+
+
+def prune_vocabulary(support, min_support):
+    """
+   Columns of the full feature vectors worth keeping, for NgramVectorizer's vocabulary.
+
+   Parameters
+   ----------
+   support: Number of training samples in which each column is non-zero.
+   min_support: Columns that are non-zero in fewer samples are dropped.
+   """
+    return np.flatnonzero(np.asarray(support) >= min_support)
+
+
+def encode_ngram(ngram):
+    """
+   Encode an n-gram of exit types as integer.
+
+   Each exit type is a digit from 1 to 7 in base 8, see EXIT_CODES. As there is no
+   digit 0, every code is unique and the code of an n-gram's suffix of length k is
+   its code modulo 8^k.
+   """
+    code = 0
+    for exit in ngram:
+        code = code << 3 | EXIT_CODES[exit]
+    return code
+
+
+def decode_ngram(code):
+    ngram = []
+    while code:
+        ngram.append(EXIT_TYPES[(code & 7) - 1])
+        code >>= 3
+    return ''.join(reversed(ngram))
+
+
+def count_suffixes(ngrams, window, count):
+    """Adds count occurrences of every suffix of the encoded window to ngrams."""
+    modulus = 8
+    while True:
+        ngrams[window % modulus] += count
+        if window < modulus:
+            return
+        modulus <<= 3
+
+
+def method_digest(dalvik_code):
+    """
+   Digest of everything that determines the CFG of a method: its instructions, try
+   blocks and exception handlers. Identical library methods in different apks share it.
+   """
+    digest = sha256(dalvik_code.get_bc().get_insn())
+    if dalvik_code.get_tries():
+        for try_item in dalvik_code.get_tries():
+            digest.update(try_item.get_raw())
+        digest.update(dalvik_code.get_handlers().get_raw())
+    return digest.hexdigest()
+
+
+def code_size(method_analysis):
+    """Length of the bytecode of a method, 0 for methods without code."""
+    dalvik_code = method_analysis.method.get_code()
+    return dalvik_code.get_bc().get_length() if dalvik_code else 0
+
+
+def size_bin(size):
+    """
+   Training weight bin of a method with size code units, the binary logarithm of its
+   size in bytes. All methods of 2^11 bytes or more share a bin to avoid very small bins,
+   which might lead to overfitting.
+   """
+    return min(11, int(np.log2(2 * size)))
 
 
 def instruction_shorthand(instr):
@@ -171,69 +369,265 @@ def build_cfg(basic_blocks):
     # Make basic block objects
     result = []
     for bb in basic_blocks:
-        result.append(BasicBlock(bb, id_mapping))
+        result.append(BasicBlock.from_json(bb, id_mapping))
 
-    return result
+    return ControlFlowGraph.from_blocks(result)
 
 
-def traverse_cfg(cfg, visitor, start_node=0):
-    if len(cfg) == 0:
-        return
+def build_cfg_direct(method_analysis, min_bb_count=0):
+    """Builds the CFG of a method straight from its Androguard basic blocks.
+
+    The result is identical to build_cfg applied to the basic blocks produced by
+    compatibility.androguard.method2json_direct, but instructions are neither
+    serialized nor decoded, only the exit instruction of each block is looked up.
 
-    class StackEntry:
+    Parameters
+    ----------
+    method_analysis: Androguard MethodAnalysis object.
+    min_bb_count: Minimum number of basic blocks the CFG needs to have.
 
-        def __init__(self, idx, is_exception=False):
-            self.bb_idx = idx
-            self.edge_idx = 0
-            self.exception_idx = 0
-            self.is_exception = is_exception
+    Returns
+    -------
+    A ControlFlowGraph, or None if the CFG has fewer than min_bb_count blocks.
+    In that case, no per-instruction work is done at all.
+    """
+    blocks = method_analysis.basic_blocks.gets()
+
+    # Blocks looping back to themselves get an additional empty "-pre" block that
+    # replaces them as the target of their parents' edges, see method2json_direct.
+    names = [str(block.get_name()) for block in blocks]
+    pre_blocks = []
+    hooks = {}
+    for block, name in zip(blocks, names):
+        for child in block.childs:
+            if name != str(child[-1].get_name()):
+                continue
+            pre_blocks.append((name + '-pre', name))
+            for parent in block.fathers:
+                parent_block = parent[-1]
+                hooks[str(parent_block.get_name())] = (name + '-pre', [
+                    c[-1] for c in parent_block.childs
+                    if str(c[-1].get_name()) == name
+                ])
+
+    if len(blocks) + len(pre_blocks) < min_bb_count:
+        return None
+
+    # Build [ID: index] mapping, pre-blocks are appended after all regular blocks
+    id_mapping = {}
+    for idx, name in enumerate(names + [pre for pre, _ in pre_blocks]):
+        id_mapping[name] = idx
+
+    # Find the exit instruction of each block in a single pass over the method
+    order = sorted(range(len(blocks)), key=lambda i: blocks[i].start)
+    starts = [blocks[i].start for i in order]
+    exits = [None] * len(blocks)
+    offset = 0
+    for instruction in method_analysis.get_method().get_instructions():
+        position = bisect_right(starts, offset) - 1
+        if position >= 0 and offset < blocks[order[position]].end:
+            exits[order[position]] = instruction.get_name()
+        offset += instruction.get_length()
+
+    return ControlFlowGraph.build(
+        chain(_direct_blocks(blocks, names, exits, hooks, id_mapping),
+              (([id_mapping[name]], [], None) for _, name in pre_blocks)))
+
+
+def _direct_blocks(blocks, names, exits, hooks, id_mapping):
+    for block, name, exit_name in zip(blocks, names, exits):
+        edges = []
+        for child in block.childs:
+            if name in hooks and child[-1] in hooks[name][1]:
+                edges.append(id_mapping[hooks[name][0]])
+            else:
+                edges.append(id_mapping[str(child[-1].get_name())])
+        exception_analysis = block.get_exception_analysis()
+        if exception_analysis:
+            exceptions = [
+                id_mapping[str(e['bb'])]
+                for e in exception_analysis.get()['list']
+            ]
+        else:
+            exceptions = []
+        exit = instruction_shorthand(exit_name) if exit_name else None
+        yield edges, exceptions, exit
 
-    stack = [StackEntry(start_node)]
 
-    while stack:
-        entry = stack[-1]
-        bb = cfg[entry.bb_idx]
+def traverse_cfg(cfg, visitor, start_node=0):
+    if len(cfg) == 0:
+        return
 
-        if entry.edge_idx == 0 and entry.exception_idx == 0:  # Check if we've been here before
-            visitor.enter(entry.bb_idx)
-            visitor.process(entry.bb_idx, entry.is_exception)
+    edge_offsets = memoryview(cfg.edge_offsets)
+    edges = memoryview(cfg.edges)
+    exception_offsets = memoryview(cfg.exception_offsets)
+    exceptions = memoryview(cfg.exceptions)
+
+    # Preallocated explicit stack of blocks and the position of the next edge to
+    # follow, exception edges are numbered after the regular ones. Visitors that do
+    # not stop at visited blocks may need to grow it.
+    nodes = [0] * (len(cfg) + 1)
+    positions = [0] * (len(cfg) + 1)
+    top = 0
+    nodes[0] = start_node
+    visitor.enter(start_node)
+    visitor.process(start_node, False)
+
+    while top >= 0:
+        idx = nodes[top]
+        position = positions[top]
+        positions[top] = position + 1
 
         next_bb = None
         is_exception_edge = False
-        if entry.edge_idx < len(bb.edges):
-            next_bb = bb.edges[entry.edge_idx]
-            entry.edge_idx += 1
-        elif entry.exception_idx < len(bb.exceptions):
-            next_bb = bb.exceptions[entry.exception_idx]
+        regular = edge_offsets[idx + 1] - edge_offsets[idx]
+        if position < regular:
+            next_bb = edges[edge_offsets[idx] + position]
+        elif position - regular < exception_offsets[idx + 1] - exception_offsets[idx]:
+            next_bb = exceptions[exception_offsets[idx] + position - regular]
             is_exception_edge = True
-            entry.exception_idx += 1
 
         if next_bb and visitor.do_traverse(next_bb):
-            stack.append(StackEntry(next_bb, is_exception_edge))
+            top += 1
+            if top == len(nodes):
+                nodes.append(0)
+                positions.append(0)
+            nodes[top] = next_bb
+            positions[top] = 0
+            visitor.enter(next_bb)
+            visitor.process(next_bb, is_exception_edge)
         else:
-            visitor.exit(entry.bb_idx)
-            stack.pop()
+            visitor.exit(idx)
+            top -= 1
 
 
 def extract_ngrams(basic_blocks, max_n=5):
-    cfg = build_cfg(basic_blocks)
+    return count_ngrams(build_cfg(basic_blocks), max_n)
+
+
+def count_ngrams_dfs(cfg, max_n=5):
+    """Reference implementation of count_ngrams, enumerating every path with a separate DFS."""
     visitor = GlobalNgramVisitor(cfg, max_n)
     traverse_cfg(cfg, visitor)
     return visitor.ngrams
 
 
+def count_ngrams(cfg, max_n=5):
+    """
+   Count the n-grams of exit types along all paths of up to max_n basic blocks.
+
+   Produces exactly the same counts as count_ngrams_dfs, but instead of enumerating
+   every path separately, paths are merged level by level while they end in the same
+   node with the same window of exit types, so the work grows with the number of
+   distinct (node, window) states rather than the number of paths.
+
+   Parameters
+   ----------
+   cfg: ControlFlowGraph.
+   max_n: Maximum n-gram length, i.e., the maximum number of blocks along a path.
+
+   Returns
+   -------
+   A Counter mapping the code of each n-gram (see encode_ngram) to its number of occurrences.
+   """
+    if len(cfg) == 0:
+        return Counter()
+
+    # traverse_cfg abandons the remaining edges of a block once it meets an edge to
+    # block 0, and handles exception edges only after all regular ones.
+    codes = cfg.exits.tolist()
+    edge_offsets = cfg.edge_offsets.tolist()
+    edges = cfg.edges.tolist()
+    exception_offsets = cfg.exception_offsets.tolist()
+    exceptions = cfg.exceptions.tolist()
+    successors = []
+    for idx, code in enumerate(codes):
+        targets = []
+        for target, is_exception in chain(
+            ((edge, False)
+             for edge in edges[edge_offsets[idx]:edge_offsets[idx + 1]]),
+            ((edge, True) for edge in
+             exceptions[exception_offsets[idx]:exception_offsets[idx + 1]])):
+            if not target:
+                break
+            if is_exception and not (code and codes[target]):
+                # The 'E' substitution then affects blocks further up the path,
+                # which is not representable by the windows below.
+                return count_ngrams_dfs(cfg, max_n)
+            targets.append((target, is_exception))
+        successors.append(targets)
+
+    visitor = StartVisitor(cfg)
+    traverse_cfg(cfg, visitor)
+
+    ngrams = Counter()
+    # Number of paths of the current length ending in a block with a given
+    # encoded window, see encode_ngram.
+    # Following an exception edge replaces the predecessor's exit type with 'E'.
+    paths = Counter((idx, codes[idx]) for idx in visitor.nodes)
+    for depth in range(1, max_n + 1):
+        next_paths = Counter()
+        for (idx, window), count in paths.items():
+            if codes[idx]:
+                count_suffixes(ngrams, window, count)
+            if depth == max_n:
+                continue
+            for target, is_exception in successors[idx]:
+                code = codes[target]
+                if is_exception:
+                    next_paths[(target, (window >> 3 << 3 | EXCEPTION) << 3
+                                | code)] += count
+                elif code:
+                    next_paths[(target, window << 3 | code)] += count
+                else:
+                    next_paths[(target, window)] += count
+        paths = next_paths
+    return ngrams
+
+
 class CfgAnomaly:
     """
    Wrapper around a scikit-learn IsolationForest anomaly detector.
    Parameters should be set to the same that was used when training the model.
+   If a cache (see utility.score_cache.ScoreCache) and an identifier of the model are
+   given, scores of methods with known bytecode are looked up instead of recomputed.
+   With keep_features set, the vectors of all scored methods are kept in features.
    """
 
-    def __init__(self, model, max_n=5, min_size=600, min_bb_count=30):
+    def __init__(self,
+                 model,
+                 max_n=5,
+                 min_size=600,
+                 min_bb_count=30,
+                 model_id=None,
+                 cache=None,
+                 chunk_size=1000,
+                 keep_features=False):
         self.model = model
         self.max_n = max_n
-        self.vectorizer = NgramVectorizer(max_n)
+        # Number of methods scored at once, bounds the memory needed for scoring
+        self.chunk_size = chunk_size
+        # Models trained on a pruned vocabulary carry the columns they were trained on
+        self.vectorizer = NgramVectorizer(
+            max_n, getattr(model, 'ngram_vocabulary_', None))
         self.min_bb_count = min_bb_count
         self.min_size = min_size
+        self.cache = cache if model_id else None
+        self.model_id = f'{model_id}:{max_n}:{min_size}:{min_bb_count}'
+        # Statistics of the last call to get_anomaly_scores
+        self.lookups = 0
+        self.hits = 0
+        # Vectors of the last call to get_anomaly_scores, kept in the full vocabulary
+        # so they stay usable for models trained on another one
+        self.keep_features = keep_features
+        self.features = None
+        self.full_vectorizer = (NgramVectorizer(max_n) if
+                                self.vectorizer.vocabulary is not None else
+                                self.vectorizer)
+
+    def is_eligible(self, size):
+        """Whether methods of the given code size are scored, or skipped for their size alone."""
+        return size != 0 and size >= self.min_size
 
     def get_anomaly_scores(self, method_analyses):
         """
@@ -248,41 +642,96 @@ class CfgAnomaly:
       A list of anomaly scores. Skipped methods get a score of 1.0.
       Otherwise, scores are between -1 and 0, where lower means more anomalous.
       """
-        to_analyze = []
-        vectors = []
+        candidates = []
 
         idx = 0
         for method in method_analyses:
-            dalvik_code = method.method.get_code()
-            code_size = dalvik_code.get_bc().get_length() if dalvik_code else 0
-
-            if code_size != 0:
-                g = json.loads(method2json_direct(method))
-                basic_blocks = g['reports']
-
-                bb_count = len(basic_blocks)
-
-                # Skip methods with very simple control flow.
-                # Also skip methods that have very small BBs to avoid too small bins.
-                if bb_count >= self.min_bb_count and code_size >= self.min_size:
-                    ngrams = extract_ngrams(basic_blocks, self.max_n)
-                    vectors.append(self.vectorizer.vectorize(ngrams, bb_count))
-                    to_analyze.append(idx)
+            # Skip methods with very simple control flow.
+            if self.is_eligible(code_size(method)):
+                dalvik_code = method.method.get_code()
+                digest = method_digest(dalvik_code) if self.cache else None
+                candidates.append((idx, method, digest))
             idx += 1
 
-        scores = None
-        try:
-            vectors = np.array(vectors)
-            scores = self.model.score_samples(vectors)
-        except ValueError as error:
-            if len(to_analyze) != 0:
-                logging.getLogger('cfgAnomaly').error(repr(error))
-                raise CfgAnomalyError(error)
+        cached = {}
+        if self.cache:
+            cached = self.cache.lookup(
+                self.model_id, [digest for _, _, digest in candidates])
+        self.lookups = len(candidates)
+        self.hits = 0
 
         # Create an array filled with 1.0, and then insert "real" scores for
         # those methods that needed analysis
         results = np.full(idx, 1.0)
-        if scores is not None:
-            results[to_analyze] = scores
+        new_scores = {}
+        chunk = Chunk()
+        self.features = Chunk() if self.keep_features else None
+        for position, method, digest in candidates:
+            if digest in cached:
+                results[position] = cached[digest]
+                self.hits += 1
+                if self.features is None:
+                    continue
+            # Also skip methods that have very small BBs to avoid too small bins.
+            cfg = build_cfg_direct(method, self.min_bb_count)
+            if cfg is None:
+                if digest is not None and digest not in cached:
+                    new_scores[digest] = 1.0
+                continue
+            ngrams = count_ngrams(cfg, self.max_n)
+            if self.features is None:
+                row = self.vectorizer.vectorize_sparse(ngrams, len(cfg))
+            else:
+                row = self.full_vectorizer.vectorize_sparse(ngrams, len(cfg))
+                self.features.append(position, digest, *row)
+                if digest in cached:
+                    continue
+                row = self.vectorizer.prune(*row)
+            chunk.append(position, digest, *row)
+            if len(chunk) == self.chunk_size:
+                self.score_chunk(chunk, results, new_scores)
+                chunk = Chunk()
+        if len(chunk):
+            self.score_chunk(chunk, results, new_scores)
+
+        if self.cache:
+            self.cache.store(self.model_id, new_scores)
 
         return results
+
+    def score_chunk(self, chunk, results, new_scores):
+        try:
+            scores = self.model.score_samples(chunk.matrix(self.vectorizer.width))
+        except ValueError as error:
+            logging.getLogger('cfgAnomaly').error(repr(error))
+            raise CfgAnomalyError(error)
+        results[chunk.positions] = scores
+        if self.cache:
+            new_scores.update(zip(chunk.digests, scores))
+
+
+class Chunk:
+    """Sparse feature vectors of methods scored together, built up row by row."""
+
+    def __init__(self):
+        self.positions = []
+        self.digests = []
+        self.indptr = [0]
+        self.indices = []
+        self.data = []
+
+    def append(self, position, digest, columns, values):
+        self.positions.append(position)
+        self.digests.append(digest)
+        self.indices.append(columns)
+        self.data.append(values)
+        self.indptr.append(self.indptr[-1] + len(columns))
+
+    def matrix(self, width):
+        return csr_matrix(
+            (np.concatenate(self.data), np.concatenate(self.indices),
+             np.array(self.indptr)),
+            shape=(len(self.positions), width))
+
+    def __len__(self):
+        return len(self.positions)
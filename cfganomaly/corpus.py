@@ -0,0 +1,325 @@
+import json
+import os
+from hashlib import blake2b
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.sparse import csc_matrix, csr_matrix, vstack
+
+META_FILE = 'corpus.json'
+MANIFEST = 'manifest.tsv'
+SHARDS = 'shards'
+MATRIX = 'matrix'
+
+
+class Deduplicator:
+    """
+   Finds rows that are exact duplicates of earlier ones, across any number of matrices.
+
+   Rows count as duplicates if their vectors and size bins are identical, so collapsing
+   them into one row weighted by their count keeps the weights of all size bins.
+   """
+
+    def __init__(self):
+        self.keys = {}
+        self.counts = []
+
+    def add(self, matrix, bins):
+        """
+      Returns a mask of the rows of the CSR matrix that were not seen before, and counts
+      the others towards the rows they duplicate.
+      """
+        keep = np.zeros(matrix.shape[0], dtype=bool)
+        data = matrix.data.astype(np.float32)
+        indices = matrix.indices.astype(np.int32)
+        for row in range(matrix.shape[0]):
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            key = blake2b(indices[start:end].tobytes(), digest_size=16)
+            key.update(data[start:end].tobytes())
+            key.update(int(bins[row]).to_bytes(4, 'little'))
+            key = key.digest()
+            unique = self.keys.get(key)
+            if unique is None:
+                self.keys[key] = len(self.counts)
+                self.counts.append(1)
+                keep[row] = True
+            else:
+                self.counts[unique] += 1
+        return keep
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class Corpus:
+    """
+   Training vectors extracted by train_cfganomaly.py, stored on disk as they are extracted.
+   The analysis workers write the vectors of the apks they analyze to a corpus as well,
+   see the --feature-sink option.
+
+   Each apk's sparse n-gram vectors and size bins are written to a compressed shard of
+   their own, and the apk is added to the manifest once its shard is complete. Apks in
+   the manifest are skipped when extraction is resumed, so an interrupted run only loses
+   the apks that were in progress. For training, the shards are consolidated into a
+   memory-mapped CSC matrix, so the corpus size is limited by disk rather than RAM.
+
+   Parameters
+   ----------
+   directory: Directory of the corpus.
+   params: Extraction parameters, must match those of the existing shards when resuming.
+   """
+
+    def __init__(self, directory, params):
+        self.directory = directory
+        self.params = params
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                existing = json.load(f)
+            if existing != params:
+                raise ValueError(f'Corpus at {directory} was extracted with'
+                                 f' {existing}, not {params}.')
+        else:
+            os.makedirs(os.path.join(directory, SHARDS), exist_ok=True)
+            # Workers of the analysis may create the same corpus concurrently
+            temporary = f'{meta_path}.{os.getpid()}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(params, f)
+            os.replace(temporary, meta_path)
+
+    @classmethod
+    def open(cls, directory):
+        """Opens an existing corpus with the parameters it was extracted with."""
+        with open(os.path.join(directory, META_FILE)) as f:
+            return cls(directory, json.load(f))
+
+    def shard_path(self, name):
+        return os.path.join(self.directory, SHARDS, f'{name}.npz')
+
+    def completed(self):
+        """Maps the names of all apks in the manifest to their number of vectors and skipped methods."""
+        completed = {}
+        path = os.path.join(self.directory, MANIFEST)
+        if not os.path.isfile(path):
+            return completed
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # A line cut off by an interrupted run is extracted again
+                if len(fields) == 3:
+                    completed[fields[0]] = (int(fields[1]), int(fields[2]))
+        return completed
+
+    def write_shard(self, name, matrix, bins, methods=None):
+        """
+      Writes the vectors (a CSR matrix) and size bins of an apk, and optionally the names
+      of their methods. Safe to call from workers.
+      """
+        path = self.shard_path(name)
+        # np.savez_compressed appends .npz to names without it
+        temporary = f'{path}.{os.getpid()}.tmp.npz'
+        arrays = {
+            'data': matrix.data.astype(np.float32),
+            'indices': matrix.indices.astype(np.int32),
+            'indptr': matrix.indptr.astype(np.int64),
+            'shape': np.array(matrix.shape),
+            'bins': np.asarray(bins, dtype=np.int32),
+        }
+        if methods is not None:
+            arrays['methods'] = np.array(methods, dtype=str)
+        np.savez_compressed(temporary, **arrays)
+        os.replace(temporary, path)
+
+    def commit(self, name, rows, skipped):
+        """Adds an apk to the manifest, after its shard was written if it has any vectors."""
+        # A single short write, so lines of concurrent workers do not interleave
+        with open(os.path.join(self.directory, MANIFEST), 'a') as f:
+            f.write(f'{name}\t{rows}\t{skipped}\n')
+
+    def read_shard(self, name):
+        with np.load(self.shard_path(name)) as shard:
+            matrix = csr_matrix(
+                (shard['data'], shard['indices'], shard['indptr']),
+                shape=tuple(shard['shape']))
+            return matrix, shard['bins']
+
+    def read_methods(self, name):
+        """Names of the methods of an apk's vectors, if they were written with the shard."""
+        with np.load(self.shard_path(name)) as shard:
+            return shard['methods'] if 'methods' in shard else None
+
+    def shards(self):
+        """Yields the name, vectors and size bins of every apk with vectors, in manifest order."""
+        for name, (rows, _) in self.completed().items():
+            if rows:
+                yield (name, *self.read_shard(name))
+
+    def support(self):
+        """Number of vectors each column is non-zero in, counted shard by shard."""
+        support = 0
+        for _, matrix, _ in self.shards():
+            support = support + np.bincount(matrix.indices,
+                                            minlength=matrix.shape[1])
+        return support
+
+    def partition(self, parts, names=None):
+        """
+      Splits the apks with vectors into up to parts groups of consecutive apks with
+      roughly the same number of vectors each.
+
+      Returns
+      -------
+      A list of groups, each a list of the names and numbers of vectors of its apks. Empty
+      if none of the apks have vectors.
+      """
+        apks = [(name, rows) for name, (rows, _) in self.completed().items()
+                if rows and (names is None or name in names)]
+        if not apks:
+            return []
+        total = sum(rows for _, rows in apks)
+        groups = [[] for _ in range(parts)]
+        seen = 0
+        for name, rows in apks:
+            groups[min(parts - 1, seen * parts // total)].append((name, rows))
+            seen += rows
+        return [group for group in groups if group]
+
+    def sample(self, apks, size, rng):
+        """
+      Draws size distinct vectors of the given apks at random, only reading the shards
+      of apks with vectors in the sample.
+
+      Parameters
+      ----------
+      apks: Names and numbers of vectors of the apks, as returned by partition.
+      size: Number of vectors to draw, at most their total number.
+      rng: numpy.random.Generator
+
+      Returns
+      -------
+      The vectors as CSR matrix, and their size bins.
+      """
+        offsets = np.cumsum([0] + [rows for _, rows in apks])
+        chosen = np.sort(rng.choice(offsets[-1], size, replace=False))
+        matrices = []
+        bins = []
+        for (name, rows), start in zip(apks, offsets):
+            first, last = np.searchsorted(chosen, [start, start + rows])
+            if first == last:
+                continue
+            matrix, shard_bins = self.read_shard(name)
+            local = chosen[first:last] - start
+            matrices.append(matrix[local])
+            bins.append(shard_bins[local])
+        return vstack(matrices, format='csr'), np.concatenate(bins)
+
+    def load(self, deduplicate=False):
+        """
+      Consolidates all shards into a memory-mapped CSC matrix, as IsolationForest.fit
+      expects it, and returns it along with the size bins of its rows and how many
+      vectors each row stands for. The consolidated arrays are kept and reused as long
+      as no apks are added.
+
+      If deduplicate is set, identical vectors of the same size bin are collapsed into a
+      single row, so the matrix grows with the number of distinct vectors only.
+      """
+        completed = self.completed()
+        directory = os.path.join(self.directory,
+                                 MATRIX + ('-unique' if deduplicate else ''))
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['apks'] == len(completed):
+                return self.open_matrix(directory, meta)
+
+        # First pass: the size of the matrix and of each column
+        deduplicator = Deduplicator() if deduplicate else None
+        masks = []
+        vectors = 0
+        rows = 0
+        width = None
+        column_sizes = None
+        for _, matrix, shard_bins in self.shards():
+            vectors += matrix.shape[0]
+            if deduplicator is not None:
+                keep = deduplicator.add(matrix, shard_bins)
+                masks.append(keep)
+                matrix = matrix[keep]
+            rows += matrix.shape[0]
+            width = matrix.shape[1]
+            sizes = np.bincount(matrix.indices, minlength=width)
+            column_sizes = sizes if column_sizes is None else column_sizes + sizes
+        if width is None:
+            raise ValueError(f'Corpus at {self.directory} has no vectors.')
+        nnz = int(column_sizes.sum())
+        if nnz >= 2**31:
+            raise ValueError('Too many non-zero values for a single sparse matrix.')
+
+        # Second pass: copy each shard's columns behind those of the previous shards
+        os.makedirs(directory, exist_ok=True)
+        indptr = open_memmap(os.path.join(directory, 'indptr.npy'),
+                             mode='w+',
+                             dtype=np.int32,
+                             shape=(width + 1,))
+        indptr[0] = 0
+        indptr[1:] = np.cumsum(column_sizes)
+        data = open_memmap(os.path.join(directory, 'data.npy'),
+                           mode='w+',
+                           dtype=np.float32,
+                           shape=(nnz,))
+        indices = open_memmap(os.path.join(directory, 'indices.npy'),
+                              mode='w+',
+                              dtype=np.int32,
+                              shape=(nnz,))
+        bins = open_memmap(os.path.join(directory, 'bins.npy'),
+                           mode='w+',
+                           dtype=np.int32,
+                           shape=(rows,))
+        counts = open_memmap(os.path.join(directory, 'counts.npy'),
+                             mode='w+',
+                             dtype=np.int64,
+                             shape=(rows,))
+        counts[:] = deduplicator.counts if deduplicator is not None else 1
+        ends = np.array(indptr[:-1], dtype=np.int64)
+        row = 0
+        for shard, (_, matrix, shard_bins) in enumerate(self.shards()):
+            if deduplicator is not None:
+                matrix = matrix[masks[shard]]
+                shard_bins = shard_bins[masks[shard]]
+            matrix = matrix.tocsc()
+            matrix.sort_indices()
+            shard_counts = np.diff(matrix.indptr)
+            positions = (np.repeat(ends - matrix.indptr[:-1], shard_counts) +
+                         np.arange(matrix.nnz))
+            data[positions] = matrix.data
+            indices[positions] = matrix.indices + row
+            ends += shard_counts
+            bins[row:row + matrix.shape[0]] = shard_bins
+            row += matrix.shape[0]
+        for array in (indptr, data, indices, bins, counts):
+            array.flush()
+        del indptr, data, indices, bins, counts
+
+        meta = {
+            'apks': len(completed),
+            'vectors': vectors,
+            'rows': rows,
+            'width': width
+        }
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return self.open_matrix(directory, meta)
+
+    @staticmethod
+    def open_matrix(directory, meta):
+        arrays = {
+            name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+            for name in ('data', 'indices', 'indptr', 'bins', 'counts')
+        }
+        matrix = csc_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(meta['rows'], meta['width']))
+        # Rows were copied in order, which spares IsolationForest.fit from sorting them
+        matrix.has_sorted_indices = True
+        return matrix, arrays['bins'], arrays['counts']
@@ -0,0 +1,390 @@
+import json
+import os
+from copy import copy
+
+import numpy as np
+from scipy.stats import norm
+from sklearn.ensemble import IsolationForest
+
+ARRAYS = ('roots', 'feature', 'threshold', 'left', 'right', 'path_length')
+META_FILE = 'forest.json'
+
+
+def average_path_length(n_samples):
+    """
+   Average path length of an unsuccessful search in a binary search tree of n_samples
+   nodes, computed exactly like sklearn's IsolationForest does.
+   """
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    result = np.zeros(n_samples.shape)
+    result[n_samples == 2] = 1.0
+    larger = n_samples > 2
+    result[larger] = (2.0 * (np.log(n_samples[larger] - 1.0) + np.euler_gamma) -
+                      2.0 * (n_samples[larger] - 1.0) / n_samples[larger])
+    return result
+
+
+class _DistinctIsolationForest(IsolationForest):
+    """Grows trees as deep as IsolationForest does for the total count of the samples."""
+
+    def _make_estimator(self, *args, **kwargs):
+        estimator = super()._make_estimator(*args, **kwargs)
+        estimator.max_depth = self.distinct_depth
+        return estimator
+
+
+def fit_distinct(model, X, counts, sample_weight=None):
+    """
+   Fits an IsolationForest on distinct vectors, so that it scores like one fitted on all
+   their copies.
+
+   IsolationForest ignores sample weights when scoring: copies of a vector cannot be
+   separated, so they end in the same leaf, and it is the number of training samples in
+   a leaf that adds to the path length of samples ending there. Counting each distinct
+   vector as often as it occurred restores that, as well as the depth limit of the trees
+   and the normalization by the number of training samples.
+
+   Parameters
+   ----------
+   model: Unfitted IsolationForest.
+   X: The distinct training vectors, as a CSC or CSR matrix.
+   counts: How often each of the rows of X occurred.
+   sample_weight: Passed on to IsolationForest.fit.
+   """
+    total = int(np.sum(counts))
+    model.__class__ = _DistinctIsolationForest
+    model.distinct_depth = int(np.ceil(np.log2(max(total, 2))))
+    try:
+        model.fit(X, sample_weight=sample_weight)
+    finally:
+        # The fitted model is a plain IsolationForest again
+        model.__class__ = IsolationForest
+        del model.distinct_depth
+
+    X = X.tocsr()
+    per_tree = []
+    for estimator, features in zip(model.estimators_,
+                                   model.estimators_features_):
+        rows = X if len(features) == X.shape[1] else X[:, features]
+        leaves = estimator.apply(rows)
+        samples = np.bincount(leaves,
+                              weights=counts,
+                              minlength=estimator.tree_.node_count)
+        per_tree.append(average_path_length(samples))
+    model._average_path_length_per_tree = tuple(per_tree)
+    model._max_samples = total
+    return model
+
+
+def merge_forests(models):
+    """
+   Merges fitted IsolationForests into one with the trees of all of them.
+
+   The forests must have been fitted on the same number of samples, as scores are
+   normalized by it.
+   """
+    first = models[0]
+    for model in models[1:]:
+        if (model._max_samples != first._max_samples or
+                model.n_features_in_ != first.n_features_in_):
+            raise ValueError('Only forests fitted on the same number of samples'
+                             ' with the same features can be merged.')
+    merged = copy(first)
+    merged.estimators_ = [
+        estimator for model in models for estimator in model.estimators_
+    ]
+    merged.estimators_features_ = [
+        features for model in models for features in model.estimators_features_
+    ]
+    merged._seeds = np.concatenate([model._seeds for model in models])
+    merged._average_path_length_per_tree = tuple(
+        path_lengths for model in models
+        for path_lengths in model._average_path_length_per_tree)
+    merged._decision_path_lengths = tuple(
+        path_lengths for model in models
+        for path_lengths in model._decision_path_lengths)
+    merged.n_estimators = len(merged.estimators_)
+    return merged
+
+
+def flatten_forest(model, model_id=None):
+    """
+   Converts a fitted sklearn IsolationForest into a FlatForest.
+
+   The nodes of all trees are concatenated, roots holds the index of each tree's root.
+   Inner nodes test feature <= threshold to choose between left and right, leaves point
+   to themselves and hold the path length score_samples accumulates for them.
+
+   Parameters
+   ----------
+   model: Fitted IsolationForest.
+   model_id: Identifier of the model, e.g., the digest of its pickle file.
+   """
+    roots = []
+    features = []
+    thresholds = []
+    lefts = []
+    rights = []
+    path_lengths = []
+    offset = 0
+    max_depth = 0
+    per_tree = getattr(model, '_average_path_length_per_tree', None)
+    for idx, (estimator, estimator_features) in enumerate(
+            zip(model.estimators_, model.estimators_features_)):
+        tree = estimator.tree_
+        # Set by sklearn, and by fit_distinct for models fitted on distinct vectors
+        leaf_path_lengths = (per_tree[idx] if per_tree is not None else
+                             average_path_length(tree.n_node_samples))
+        is_leaf = tree.children_left == -1
+        nodes = np.arange(tree.node_count)
+
+        depths = np.zeros(tree.node_count, dtype=np.int64)
+        depths[0] = 1
+        # Children always have larger indices than their parents
+        for node in range(tree.node_count):
+            if not is_leaf[node]:
+                depths[tree.children_left[node]] = depths[node] + 1
+                depths[tree.children_right[node]] = depths[node] + 1
+        max_depth = max(max_depth, int(depths.max()))
+
+        roots.append(offset)
+        features.append(
+            np.where(is_leaf, 0,
+                     np.asarray(estimator_features)[np.maximum(tree.feature,
+                                                               0)]))
+        thresholds.append(np.where(is_leaf, 0.0, tree.threshold))
+        lefts.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+        rights.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+        path_lengths.append(
+            np.where(is_leaf, depths + leaf_path_lengths - 1.0, 0.0))
+        offset += tree.node_count
+
+    arrays = {
+        'roots': np.array(roots, dtype=np.int64),
+        'feature': np.concatenate(features).astype(np.int32),
+        'threshold': np.concatenate(thresholds).astype(np.float64),
+        'left': np.concatenate(lefts).astype(np.int64),
+        'right': np.concatenate(rights).astype(np.int64),
+        'path_length': np.concatenate(path_lengths).astype(np.float64),
+    }
+    meta = {
+        'model_id': model_id,
+        'n_features': int(model.n_features_in_),
+        # Inner nodes on the longest path, i.e., the number of steps to reach all leaves
+        'max_depth': max_depth - 1,
+        'denominator': float(
+            len(model.estimators_) *
+            average_path_length([model._max_samples])[0]),
+    }
+    vocabulary = getattr(model, 'ngram_vocabulary_', None)
+    if vocabulary is not None:
+        # Columns of the full n-gram vectors the model was trained on
+        meta['vocabulary'] = np.asarray(vocabulary).tolist()
+    return FlatForest(arrays, meta)
+
+
+def export_forest(model, directory, model_id=None):
+    """Exports a fitted sklearn IsolationForest into directory, one .npy file per array."""
+    flatten_forest(model, model_id).save(directory)
+
+
+def is_forest(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class FlatForest:
+    """
+   IsolationForest scorer over the arrays of flatten_forest.
+
+   Loaded from the files written by export_forest, the arrays are memory-mapped
+   read-only, so loading takes no time and all processes scoring with the same forest
+   share its pages. All trees are evaluated at once for every sample, advancing one
+   level per step.
+   """
+
+    def __init__(self, arrays, meta, batch_size=64):
+        # Number of samples that are densified and traversed at once
+        self.batch_size = batch_size
+        self.meta = meta
+        self.model_id = meta['model_id']
+        self.n_features = meta['n_features']
+        self.max_depth = meta['max_depth']
+        self.denominator = meta['denominator']
+        # Named like the attribute train_cfganomaly.py sets on pruned models
+        self.ngram_vocabulary_ = meta.get('vocabulary')
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(directory, f'{name}.npy'),
+                          mmap_mode=mmap_mode)
+            for name in ARRAYS
+        }
+        return cls(arrays, meta)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(directory, META_FILE), 'w') as f:
+            json.dump(self.meta, f)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def score_samples(self, X):
+        """
+      Same as IsolationForest.score_samples.
+
+      Parameters
+      ----------
+      X: Dense array or scipy CSR matrix of shape (n_samples, n_features).
+
+      Returns
+      -------
+      The negated anomaly scores of the samples, lower means more anomalous.
+      """
+        self.check_input(X)
+        # Accumulate tree by tree like sklearn, so the sums are identical
+        depths = np.zeros(X.shape[0])
+        for path_lengths in self.path_lengths(X).T:
+            depths += path_lengths
+        return self.scores(depths)
+
+    def check_input(self, X):
+        if X.shape[0] == 0:
+            raise ValueError('Found array with 0 sample(s) while a minimum of 1'
+                             ' is required.')
+        if X.shape[1] != self.n_features:
+            raise ValueError(f'X has {X.shape[1]} features, but the forest is'
+                             f' expecting {self.n_features} features as input.')
+
+    def scores(self, depths):
+        if self.denominator == 0:
+            # Like IsolationForest, which divides the depths into ones in this case
+            return -0.5 * np.ones_like(depths)
+        return -2**(-depths / self.denominator)
+
+    def path_lengths(self, X, trees=slice(None)):
+        """
+      Path lengths of the samples in each of the given trees, i.e., what they contribute
+      to the total depth of the samples.
+
+      Returns
+      -------
+      Array of shape (n_samples, n_trees).
+      """
+        roots = self.roots[trees]
+        result = np.empty((X.shape[0], len(roots)))
+        for batch in range(0, X.shape[0], self.batch_size):
+            rows = X[batch:batch + self.batch_size]
+            # Dense batches stay small, but allow direct indexing of the features
+            rows = rows.toarray() if hasattr(rows, 'toarray') else rows
+            nodes = self.leaves(np.asarray(rows, dtype=np.float32), roots)
+            result[batch:batch + len(rows)] = self.path_length[nodes]
+        return result
+
+    def leaves(self, X, roots):
+        rows = np.arange(X.shape[0])[:, np.newaxis]
+        nodes = np.broadcast_to(roots, (X.shape[0], len(roots)))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return nodes
+
+
+class CascadedForest:
+    """
+   Scores samples on the first trees of a FlatForest, and only continues with the
+   remaining trees for samples that might score below cutoff, i.e., be anomalous.
+
+   Samples stop early once their total depth is bounded from below by a depth that
+   scores above cutoff. With a confidence of 1.0, the bound adds the smallest leaf path
+   length of each remaining tree and holds for certain. Otherwise, the path lengths of
+   a sample in the remaining trees are treated as independent draws from the same
+   distribution as those in the trees evaluated so far, and the bound is the one-sided
+   normal confidence bound of their sum. Samples stopping early are scored with their
+   estimated total depth, so their scores are approximate, but never below cutoff.
+   """
+
+    def __init__(self, forest, cutoff, trees=30, confidence=1.0):
+        self.forest = forest
+        self.cutoff = cutoff
+        self.trees = min(trees, len(forest))
+        self.confidence = confidence
+        self.n_features = forest.n_features
+        self.ngram_vocabulary_ = forest.ngram_vocabulary_
+        self.model_id = self.cascade_id(forest.model_id, cutoff, trees,
+                                        confidence)
+        # Samples with at least this total depth score above cutoff
+        self.normal_depth = -forest.denominator * np.log2(-cutoff)
+
+        ends = np.append(forest.roots[1:], len(forest.left))
+        is_leaf = forest.left == np.arange(len(forest.left))
+        shortest = np.minimum.reduceat(
+            np.where(is_leaf, forest.path_length, np.inf), forest.roots)
+        longest = np.maximum.reduceat(
+            np.where(is_leaf, forest.path_length, -np.inf), forest.roots)
+        assert len(shortest) == len(ends)
+        self.min_rest = shortest[self.trees:].sum()
+        self.max_rest = longest[self.trees:].sum()
+        self.quantile = norm.ppf(confidence) if confidence < 1.0 else None
+        self.reset_statistics()
+
+    @staticmethod
+    def cascade_id(model_id, cutoff, trees, confidence):
+        """Identifier of the scores, which differ from those of the forest for early stops."""
+        return f'{model_id}:cascade:{cutoff}:{trees}:{confidence}'
+
+    def reset_statistics(self):
+        self.samples = 0
+        self.exits = 0
+        self.evaluations = 0
+
+    def saved_evaluations(self):
+        """Fraction of tree evaluations saved compared to scoring on all trees."""
+        total = self.samples * len(self.forest)
+        return 1 - self.evaluations / total if total else 0.0
+
+    def score_samples(self, X):
+        self.forest.check_input(X)
+        remaining = len(self.forest) - self.trees
+        first = self.forest.path_lengths(X, slice(0, self.trees))
+        depths = np.zeros(X.shape[0])
+        for path_lengths in first.T:
+            depths += path_lengths
+
+        lower = depths + self.min_rest
+        estimate = depths + remaining * depths / self.trees
+        if self.quantile is not None and self.trees > 1:
+            # A few trees easily miss the rare short paths of a sample, so its variance
+            # is at least the mean variance of the samples scored together
+            variance = first.var(axis=1, ddof=1)
+            variance = np.maximum(variance, variance.mean())
+            # The remaining sum varies by remaining * variance around remaining times
+            # the true mean, which itself is only known up to variance / trees
+            deviation = np.sqrt(variance *
+                                (remaining + remaining**2 / self.trees))
+            lower = np.maximum(lower, estimate - self.quantile * deviation)
+        estimate = np.clip(estimate, lower, depths + self.max_rest)
+        stop = lower > self.normal_depth
+        if remaining == 0 or self.forest.denominator == 0:
+            stop[:] = False
+
+        rest = np.flatnonzero(~stop)
+        if len(rest) and remaining:
+            rest_depths = depths[rest]
+            for path_lengths in self.forest.path_lengths(
+                    X[rest], slice(self.trees, None)).T:
+                rest_depths += path_lengths
+            depths[rest] = rest_depths
+        depths[stop] = estimate[stop]
+
+        self.samples += X.shape[0]
+        self.exits += int(stop.sum())
+        self.evaluations += X.shape[0] * self.trees + len(rest) * remaining
+        return self.forest.scores(depths)
@@ -0,0 +1,89 @@
+import time
+import tracemalloc
+from multiprocessing import Pool
+
+import numpy as np
+from sklearn.ensemble import IsolationForest
+
+from cfganomaly.corpus import Corpus, Deduplicator
+from cfganomaly.forest import fit_distinct, merge_forests
+
+
+def fit_subforest(task):
+    """
+   Fits a sub-forest on a random sample of the vectors of a group of apks.
+
+   Returns
+   -------
+   The fitted IsolationForest, the fit time and the peak memory traced while fitting.
+   """
+    directory, apks, samples, estimators, vocabulary, deduplicate, seed = task
+    tracemalloc.start()
+    start = time.perf_counter()
+    X, bins = Corpus.open(directory).sample(apks, samples,
+                                            np.random.default_rng(seed))
+    if vocabulary is not None:
+        X = X[:, vocabulary]
+    model = IsolationForest(n_estimators=estimators,
+                            max_samples=1.0,
+                            random_state=seed)
+    if deduplicate:
+        deduplicator = Deduplicator()
+        keep = deduplicator.add(X, bins)
+        counts = np.array(deduplicator.counts)
+        fit_distinct(model, X[keep].tocsc(), counts, counts / bins[keep])
+    else:
+        model.fit(X.tocsc(), sample_weight=1 / bins)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return model, elapsed, peak
+
+
+def train_subforests(corpus,
+                     parts,
+                     samples,
+                     estimators,
+                     processes=None,
+                     vocabulary=None,
+                     deduplicate=False,
+                     seed=0,
+                     names=None):
+    """
+   Trains an IsolationForest on a corpus too large to fit into memory at once.
+
+   The apks of the corpus are split into parts groups, and a sub-forest with its share of
+   the estimators is fitted on samples random vectors of each group, in parallel. As all
+   sub-forests are fitted on the same number of samples, the merged forest scores like an
+   IsolationForest whose trees were fitted on samples vectors each.
+
+   Parameters
+   ----------
+   corpus: Corpus with the extracted vectors.
+   parts: Number of sub-forests.
+   samples: Number of vectors per sub-forest, bounds the memory of each process. Lowered
+      to the number of vectors of the smallest group if that has fewer.
+   estimators: Total number of trees.
+   processes: Number of processes fitting sub-forests, one per CPU if None.
+   vocabulary: Columns to fit on, see NgramVectorizer.
+   deduplicate: Fits each sub-forest on the distinct vectors of its sample.
+   seed: Random seed.
+   names: Apks to train on, all of the corpus if None.
+
+   Returns
+   -------
+   The merged IsolationForest, and the fit time and peak memory of each sub-forest.
+   """
+    groups = corpus.partition(min(parts, estimators), names)
+    if not groups:
+        raise ValueError(f'Corpus at {corpus.directory} has no vectors'
+                         f'{" of the given apks" if names is not None else ""} to train on.')
+    samples = min(samples, min(sum(rows for _, rows in group) for group in groups))
+    tasks = [(corpus.directory, group, samples,
+              estimators // len(groups) + (idx < estimators % len(groups)),
+              vocabulary, deduplicate, seed + idx)
+             for idx, group in enumerate(groups)]
+    with Pool(processes) as pool:
+        results = pool.map(fit_subforest, tasks, 1)
+    model = merge_forests([model for model, _, _ in results])
+    return model, [(elapsed, peak) for _, elapsed, peak in results]
@@ -1,10 +1,10 @@
 import csv
+import functools
 import gzip
 import json
 import logging
 import os
 import pprint
-import random
 import shlex
 import shutil
 import sys
@@ -13,6 +13,8 @@ import time
 from subprocess import check_output, CalledProcessError
 
 import psycopg2 as db
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import execute_values
 
 from compatibility.json import Encoder
 from utility.convenience import convert_time, log_psycopg2_exception
@@ -22,6 +24,23 @@ logger = logging.getLogger('postgreSQL')
 logger.setLevel(logging.NOTSET)
 
 db_string = None
+# Local backend replacing PostgreSQL for the results of the analysis, see local_backends
+backend = None
+
+FETCH_SIZE = 10000
+ANDROZOO_CHANNEL = 'androzoo_apks'
+
+
+def local(func):
+    """Routes calls to the method of the same name of the local backend, if one is selected."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if backend is not None:
+            return getattr(backend, func.__name__)(*args, **kwargs)
+        return func(*args, **kwargs)
+
+    return wrapper
 
 
 def download_csv():
@@ -46,6 +65,8 @@ def populate(filepath, db_connection):
     The intended use is with a description of the AndroZoo dataset (https://androzoo.uni.lu/),
     but any csv file with the correct columns will work.
     Please refer to https://androzoo.uni.lu/lists for a documentation on the format.
+    Existing rows are updated to the contents of the file, and rows of apks missing from
+    it are removed.
 
     Parameters
     ----------
@@ -69,32 +90,48 @@ def populate(filepath, db_connection):
         cursor.execute(
             "CREATE TABLE androzoo_apks (sha256 varchar PRIMARY KEY, dex_date date, apk_size int,"
             " pkg_name varchar, version_code int, vt_detection int, vt_date date, dex_size int,"
-            " markets varchar[]);")
+            " markets varchar[], seq bigserial);")
         db_connection.commit()
         logger.info('Successfully created table "androzoo_apks"')
     except db.Error:
         db_connection.rollback()
-        cursor.execute("SELECT sha256 FROM androzoo_apks;")
-        apks = cursor.rowcount
+        cursor.execute("SELECT count(*) FROM androzoo_apks;")
+        apks = cursor.fetchone()[0]
         logger.info(
             f'Table "androzoo_apks" was already present with {apks} rows but will be updated with new apks.'
         )
-        cursor.execute("DROP TABLE androzoo_apks;")
+        # Tables created by earlier versions lack the sequence column used for watermarks
         cursor.execute(
-            "CREATE TABLE androzoo_apks (sha256 varchar PRIMARY KEY, dex_date date, apk_size int,"
-            " pkg_name varchar, version_code int, vt_detection int, vt_date date, dex_size int,"
-            " markets varchar[]);")
+            "ALTER TABLE androzoo_apks ADD COLUMN IF NOT EXISTS seq bigserial;")
         db_connection.commit()
-        logger.info('Successfully recreated table "androzoo_apks"')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS androzoo_apks_seq ON androzoo_apks (seq);")
+    db_connection.commit()
+    # Apks of the list, rows of apks that were dropped from it are removed afterwards
+    cursor.execute("CREATE TEMPORARY TABLE listed_apks (sha256 varchar PRIMARY KEY);")
     start = time.monotonic_ns()
     with gzip.open(filepath, 'rt') as csv_file:
         count = 0
         for row in csv.DictReader(csv_file, skipinitialspace=True):
             if ',' in row['sha256']:
                 continue
+            cursor.execute(
+                "INSERT INTO listed_apks (sha256) VALUES (%s) ON CONFLICT DO NOTHING;",
+                (row['sha256'], ))
+            # New and changed rows get a fresh sequence number, so they are picked up by
+            # queries rerun in --repeat mode
             cursor.execute(
                 "INSERT INTO androzoo_apks (sha256, dex_date, apk_size, pkg_name, version_code, vt_detection, vt_date,"
-                " dex_size, markets) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING;",
+                " dex_size, markets) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (sha256) DO UPDATE SET"
+                " (dex_date, apk_size, pkg_name, version_code, vt_detection, vt_date, dex_size, markets, seq) ="
+                " (EXCLUDED.dex_date, EXCLUDED.apk_size, EXCLUDED.pkg_name, EXCLUDED.version_code,"
+                " EXCLUDED.vt_detection, EXCLUDED.vt_date, EXCLUDED.dex_size, EXCLUDED.markets,"
+                " nextval(pg_get_serial_sequence('androzoo_apks', 'seq'))) WHERE"
+                " (androzoo_apks.dex_date, androzoo_apks.apk_size, androzoo_apks.pkg_name,"
+                " androzoo_apks.version_code, androzoo_apks.vt_detection, androzoo_apks.vt_date,"
+                " androzoo_apks.dex_size, androzoo_apks.markets) IS DISTINCT FROM"
+                " (EXCLUDED.dex_date, EXCLUDED.apk_size, EXCLUDED.pkg_name, EXCLUDED.version_code,"
+                " EXCLUDED.vt_detection, EXCLUDED.vt_date, EXCLUDED.dex_size, EXCLUDED.markets);",
                 (row['sha256'], row['dex_date'], int(row['apk_size'])
                  if row['apk_size'] else None, row['pkg_name'],
                  int(row['vercode']) if row['vercode'] else None,
@@ -107,9 +144,18 @@ def populate(filepath, db_connection):
                 logger.info(
                     f'Completed {count} rows. Took {convert_time(time.monotonic_ns() - start)}'
                 )
+    cursor.execute(
+        "DELETE FROM androzoo_apks WHERE NOT EXISTS (SELECT 1 FROM listed_apks WHERE"
+        " listed_apks.sha256 = androzoo_apks.sha256);")
+    removed = cursor.rowcount
+    cursor.execute("DROP TABLE listed_apks;")
+    db_connection.commit()
+    logger.info(f'Removed {removed} rows of apks no longer listed.')
+    cursor.execute("SELECT count(*) FROM androzoo_apks;")
+    size = cursor.fetchone()[0]
+    # Wake up analyses waiting for new apks, see AndrozooApkManager
+    cursor.execute(f"NOTIFY {ANDROZOO_CHANNEL};")
     db_connection.commit()
-    cursor.execute("SELECT sha256 FROM androzoo_apks;")
-    size = cursor.rowcount
     cursor.close()
     logger.info(
         f'Successfully populated "androzoo_apks" with {size} rows. Took'
@@ -127,23 +173,67 @@ def populate(filepath, db_connection):
     return size
 
 
-def create_random_sample(file_path, db_connection):
-    sample_size = 250
-    bins = ['>30'] + [f'={num}' for num in range(30, 9, -1)]
+def create_random_sample(file_path,
+                         db_connection,
+                         sample_size=250,
+                         min_detection=10,
+                         max_detection=30):
+    """Draws a stratified random sample of androzoo apks for VirusTotal checking.
+
+    Every detection count from min_detection up to max_detection forms its own stratum,
+    while all apks with more than max_detection detections share a single one.
+    The sample is drawn inside the database in one pass and stored in "vt_samples",
+    its hashes are then streamed to file_path so the client never holds more than one batch.
+
+    Parameters
+    ----------
+    file_path : str
+        The file to write the sampled sha256 identifiers to.
+    db_connection : db.Connection
+    sample_size : int
+        Maximum number of apks drawn from each stratum.
+    min_detection : int
+        Lowest VirusTotal detection count that is sampled.
+    max_detection : int
+        Detection count above which all apks are combined into one stratum.
+
+    Returns
+    -------
+    int
+        Number of apks in the sample.
+    """
+    start = time.monotonic_ns()
     cursor = db_connection.cursor()
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS androzoo_apks_vt_detection ON androzoo_apks (vt_detection);"
+    )
+    db_connection.commit()
+    cursor.close()
+    create_sample_table(db_connection)
+    cursor = db_connection.cursor()
+    cursor.execute(
+        "INSERT INTO vt_samples (sha256) SELECT sha256 FROM (SELECT sha256, row_number() OVER"
+        " (PARTITION BY LEAST(vt_detection, %s) ORDER BY random()) AS rank FROM androzoo_apks"
+        " WHERE vt_detection >= %s) AS strata WHERE rank <= %s;",
+        (max_detection + 1, min_detection, sample_size))
+    size = cursor.rowcount
+    db_connection.commit()
+    cursor.close()
+    logger.info(
+        f'Sampled {size} apks from {max_detection - min_detection + 2} strata. Took'
+        f' {convert_time(time.monotonic_ns() - start)}.')
+    cursor = db_connection.cursor(name='vt_samples')
+    cursor.itersize = FETCH_SIZE
+    cursor.execute("SELECT sha256 FROM vt_samples;")
     with open(file_path, 'w') as file:
-        for cmp in bins:
-            cursor.execute(
-                f"SELECT sha256 FROM androzoo_apks WHERE vt_detection{cmp};")
-            sample = random.sample(
-                k=min(sample_size, cursor.rowcount),
-                population=[row[0] for row in cursor.fetchall()])
-            for s in sample:
-                file.write(f'{s}\n')
+        for row in cursor:
+            file.write(f'{row[0]}\n')
     cursor.close()
+    db_connection.commit()
+    return size
 
 
-def store_random_sample(file_path, db_connection):
+def create_sample_table(db_connection):
     cursor = db_connection.cursor()
     try:
         cursor.execute("CREATE TABLE vt_samples (sha256 varchar PRIMARY KEY);")
@@ -153,16 +243,33 @@ def store_random_sample(file_path, db_connection):
         logger.error(
             f'"vt_samples" already existed with {cursor.rowcount} rows, replacing with new random sample.'
         )
-        cursor.close()
         cursor.execute("DROP TABLE vt_samples;")
         cursor.execute("CREATE TABLE vt_samples (sha256 varchar PRIMARY KEY);")
-        db_connection.commit()
+    db_connection.commit()
+    cursor.close()
+
+
+def store_random_sample(file_path, db_connection):
+    create_sample_table(db_connection)
+    cursor = db_connection.cursor()
     with open(file_path, 'r') as file:
         inserted = 0
+        batch = []
         for line in file:
-            cursor.execute("INSERT INTO vt_samples (sha256) VALUES (%s);",
-                           ((line.strip(), )))
-            inserted += 1
+            batch.append((line.strip(), ))
+            if len(batch) == FETCH_SIZE:
+                execute_values(
+                    cursor,
+                    "INSERT INTO vt_samples (sha256) VALUES %s ON CONFLICT DO NOTHING;",
+                    batch)
+                inserted += len(batch)
+                batch = []
+        if batch:
+            execute_values(
+                cursor,
+                "INSERT INTO vt_samples (sha256) VALUES %s ON CONFLICT DO NOTHING;",
+                batch)
+            inserted += len(batch)
         logger.info(f'Inserted {inserted} rows into "vt_samples"')
     db_connection.commit()
     cursor.close()
@@ -184,11 +291,14 @@ def create_db(args):
     populate(csv_file, db_connection)
     file_path = os.path.abspath(args.file)
     if args.sample:
-        create_random_sample(file_path, db_connection)
-    store_random_sample(file_path, db_connection)
+        create_random_sample(file_path, db_connection, args.sample_size,
+                             args.min_detection, args.max_detection)
+    else:
+        store_random_sample(file_path, db_connection)
     db_connection.close()
 
 
+@local
 def create():
     """Function to create the table underlying the analysis.
 
@@ -233,6 +343,13 @@ def create():
         cursor.execute("SELECT sha256 FROM results;")
         logger.info(
             f'Table "results" was already present with {cursor.rowcount} rows')
+    cursor.execute("ALTER TABLE results ADD COLUMN IF NOT EXISTS cached int;")
+    cursor.execute(
+        "ALTER TABLE results ADD COLUMN IF NOT EXISTS sampled bool DEFAULT false,"
+        " ADD COLUMN IF NOT EXISTS anomalies_estimate double precision,"
+        " ADD COLUMN IF NOT EXISTS anomalies_low double precision,"
+        " ADD COLUMN IF NOT EXISTS anomalies_high double precision;")
+    db_connection.commit()
     try:
         cursor.execute(
             "CREATE TABLE files (sha256 varchar, origin varchar, name varchar, entropy double precision,"
@@ -325,6 +442,31 @@ def create():
         logger.info(
             f'Table "dex_loaders" was already present with {cursor.rowcount} rows'
         )
+    try:
+        cursor.execute(
+            "CREATE TABLE watermarks (query varchar PRIMARY KEY, seq bigint);")
+        db_connection.commit()
+        logger.info('Successfully created table "watermarks"')
+    except db.Error:
+        db_connection.rollback()
+        cursor.execute("SELECT query FROM watermarks;")
+        logger.info(
+            f'Table "watermarks" was already present with {cursor.rowcount} rows'
+        )
+    try:
+        cursor.execute(
+            "CREATE TABLE cfg_scores (model varchar, digest varchar, score double precision,"
+            " last_used timestamp DEFAULT now(), PRIMARY KEY (model, digest));")
+        cursor.execute(
+            "CREATE INDEX cfg_scores_last_used ON cfg_scores (last_used);")
+        db_connection.commit()
+        logger.info('Successfully created table "cfg_scores"')
+    except db.Error:
+        db_connection.rollback()
+        cursor.execute("SELECT digest FROM cfg_scores;")
+        logger.info(
+            f'Table "cfg_scores" was already present with {cursor.rowcount} rows'
+        )
     try:
         cursor.execute(
             "CREATE TABLE fdroid (sha256 varchar PRIMARY KEY, name varchar, version int);"
@@ -340,23 +482,164 @@ def create():
     db_connection.close()
 
 
-def access(query, args=None, db_connection=None):
+def access(query, args=None, db_connection=None, name=None, fetch_size=FETCH_SIZE):
+    """Executes a query and lazily yields its rows.
+
+    Parameters
+    ----------
+    query : str
+        The query to execute.
+    args : tuple
+        Parameters to pass along with the query.
+    db_connection : db.Connection
+        Connection to use, a new one is created (and closed afterwards) if omitted.
+    name : str
+        If set, rows are streamed through a server-side cursor of that name,
+        fetching fetch_size rows per round trip instead of transferring the entire result at once.
+    fetch_size : int
+        Number of rows fetched per round trip by a server-side cursor.
+    """
+    close = False
     if db_connection is None:
         try:
             db_connection = db.connect(db_string)
+            close = True
         except db.Error as error:
             logger.fatal('Could not establish a connection to the database.')
             return
-    cursor = db_connection.cursor()
-    if args:
-        cursor.execute(query, args)
+    if name:
+        cursor = db_connection.cursor(name=name)
+        cursor.itersize = fetch_size
     else:
-        cursor.execute(query)
-    for row in cursor:
-        yield row
+        cursor = db_connection.cursor()
+    try:
+        if args:
+            cursor.execute(query, args)
+        else:
+            cursor.execute(query)
+        for row in cursor:
+            yield row
+        cursor.close()
+        db_connection.commit()
+    finally:
+        if close:
+            db_connection.close()
+
+
+def exclude_processed(query):
+    """Wraps a query yielding sha256 identifiers in its first column in an anti-join
+    that removes all apks already present in "results" or "errors".
+    """
+    return (
+        f'SELECT candidates.* FROM ({query.strip().rstrip(";")}) AS candidates (sha256)'
+        ' WHERE NOT EXISTS (SELECT 1 FROM results WHERE results.sha256 = candidates.sha256)'
+        ' AND NOT EXISTS (SELECT 1 FROM errors WHERE errors.sha256 = candidates.sha256);'
+    )
+
+
+def count_processed(query, db_connection):
+    """Counts the apks a query yields and how many of them exclude_processed removes.
+
+    Returns
+    -------
+    tuple
+        Number of apks of the query, and number of them already in "results" or "errors".
+    """
+    cursor = db_connection.cursor()
+    cursor.execute(
+        f'SELECT count(*), count(*) FILTER (WHERE EXISTS (SELECT 1 FROM results WHERE'
+        ' results.sha256 = candidates.sha256) OR EXISTS (SELECT 1 FROM errors WHERE'
+        ' errors.sha256 = candidates.sha256)) FROM'
+        f' ({query.strip().rstrip(";")}) AS candidates (sha256);')
+    counts = cursor.fetchone()
+    cursor.close()
     db_connection.commit()
+    return counts
 
 
+def after_watermark(query, low, high):
+    """Restricts a query yielding sha256 identifiers in its first column to androzoo apks
+    whose sequence number lies in (low, high], i.e. that were added or changed after low.
+    """
+    return (
+        f'SELECT candidates.* FROM ({query.strip().rstrip(";")}) AS candidates (sha256)'
+        ' JOIN androzoo_apks AS watermark ON watermark.sha256 = candidates.sha256'
+        f' WHERE watermark.seq > {int(low)} AND watermark.seq <= {int(high)}')
+
+
+def pending_watermark(query, low, high, db_connection):
+    """Sequence number up to which all apks of a query in (low, high] are in "results" or
+    "errors", i.e. one below the smallest one still pending. high if none are.
+    """
+    cursor = db_connection.cursor()
+    cursor.execute(
+        f'SELECT COALESCE(min(apks.seq) - 1, %s) FROM'
+        f' ({exclude_processed(after_watermark(query, low, high)).rstrip(";")}) AS pending'
+        ' JOIN androzoo_apks AS apks ON apks.sha256 = pending.sha256;', (high, ))
+    seq = cursor.fetchone()[0]
+    cursor.close()
+    db_connection.commit()
+    return seq
+
+
+def current_watermark(db_connection):
+    cursor = db_connection.cursor()
+    cursor.execute("SELECT COALESCE(max(seq), 0) FROM androzoo_apks;")
+    seq = cursor.fetchone()[0]
+    cursor.close()
+    db_connection.commit()
+    return seq
+
+
+def get_watermark(query, db_connection):
+    cursor = db_connection.cursor()
+    cursor.execute("SELECT seq FROM watermarks WHERE query = %s;", (query, ))
+    row = cursor.fetchone()
+    cursor.close()
+    db_connection.commit()
+    return row[0] if row else 0
+
+
+def store_watermark(query, seq, db_connection):
+    cursor = db_connection.cursor()
+    try:
+        cursor.execute(
+            "INSERT INTO watermarks (query, seq) VALUES (%s, %s) ON CONFLICT (query) DO UPDATE SET"
+            " seq = EXCLUDED.seq;", (query, seq))
+        db_connection.commit()
+        cursor.close()
+    except db.Error as error:
+        db_connection.rollback()
+        cursor.close()
+        raise DatabaseRetry(error, store_watermark, query, seq, db_connection)
+
+
+def listen(channel):
+    """Opens a connection listening for notifications on channel.
+
+    Pending notifications are collected in the connection's notifies list by calling poll,
+    select can be used on the connection to wait for new ones.
+    """
+    db_connection = db.connect(db_string)
+    db_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = db_connection.cursor()
+    cursor.execute(f"LISTEN {channel};")
+    cursor.close()
+    return db_connection
+
+
+def is_processed(sha256, db_connection):
+    cursor = db_connection.cursor()
+    cursor.execute(
+        "SELECT 1 FROM results WHERE sha256 = %s UNION ALL SELECT 1 FROM errors WHERE sha256 = %s"
+        " LIMIT 1;", (sha256, sha256))
+    processed = cursor.fetchone() is not None
+    cursor.close()
+    db_connection.commit()
+    return processed
+
+
+@local
 def store_result(sha256,
                  permissions,
                  libraries,
@@ -441,6 +724,7 @@ def store_vt_error(sha256, error, db_connection=None):
         raise DatabaseRetry(error, store_vt_error, sha256, error)
 
 
+@local
 def store_google_play_app(sha256,
                           dex_date,
                           size,
@@ -478,6 +762,7 @@ def store_google_play_app(sha256,
                             downloads, has_ads)
 
 
+@local
 def store_library_access(sha256, loaded_libs, db_connection=None):
     logger.debug(
         f'{sha256} loads the following libs:\n{pprint.pformat(loaded_libs)}')
@@ -501,6 +786,7 @@ def store_library_access(sha256, loaded_libs, db_connection=None):
         raise DatabaseRetry(error, store_library_access, sha256, loaded_libs)
 
 
+@local
 def store_dex_loader_access(sha256, dex_loaders, db_connection=None):
     logger.debug(
         f'{sha256} uses the following dex_loaders:\n{pprint.pformat(dex_loaders)}'
@@ -531,6 +817,7 @@ def store_dex_loader_access(sha256, dex_loaders, db_connection=None):
                             dex_loaders)
 
 
+@local
 def full_error(sha256, error_str, partial=False, db_connection=None):
     if db_connection is None:
         try:
@@ -551,6 +838,7 @@ def full_error(sha256, error_str, partial=False, db_connection=None):
         raise DatabaseRetry(error, full_error, sha256, error_str, partial)
 
 
+@local
 def store_apkid_result(sha256, apkid, db_connection=None):
     if db_connection is None:
         try:
@@ -571,6 +859,7 @@ def store_apkid_result(sha256, apkid, db_connection=None):
         raise DatabaseRetry(error, store_apkid_result, sha256, apkid)
 
 
+@local
 def apkid_error(sha256, error, error_text, db_connection=None):
     if db_connection is None:
         try:
@@ -595,6 +884,7 @@ def apkid_error(sha256, error, error_text, db_connection=None):
         raise DatabaseRetry(error, apkid_error, sha256, error, error_text)
 
 
+@local
 def store_class_loader_access(sha256, loaded_classes, db_connection=None):
     logger.debug(
         f'{sha256} loads the following classes:\n{pprint.pformat(loaded_classes)}'
@@ -620,6 +910,7 @@ def store_class_loader_access(sha256, loaded_classes, db_connection=None):
                             loaded_classes)
 
 
+@local
 def store_files(sha256, files, db_connection=None):
     if db_connection is None:
         try:
@@ -650,6 +941,7 @@ def partial_error(sha256, error, db_connection=None):
     full_error(sha256, error, True, db_connection)
 
 
+@local
 def store_anomalies(sha256, anomalies, db_connection=None):
     if db_connection is None:
         try:
@@ -670,6 +962,7 @@ def store_anomalies(sha256, anomalies, db_connection=None):
         raise DatabaseRetry(error, store_anomalies, sha256, anomalies)
 
 
+@local
 def store_reflection_information(sha256,
                                  reflected_classes,
                                  reflected_methods,
@@ -700,32 +993,200 @@ def store_reflection_information(sha256,
                             reflected_classes, reflected_methods)
 
 
+@local
 def store_anomaly_overview(sha256,
                            analyzed,
                            anomalies,
                            skipped,
+                           cached=0,
+                           estimate=None,
                            db_connection=None):
+    """Stores the anomaly counts of an apk in its results row.
+
+    If only a sample of its methods was scored, estimate holds the estimated number of
+    anomalies among all of them and the bounds of its confidence interval, and the row is
+    flagged as sampled.
+    """
     if db_connection is None:
         try:
             db_connection = db.connect(db_string)
         except db.Error as error:
             logger.error('Could not establish a connection to the database.')
             raise DatabaseRetry(error, store_anomaly_overview, sha256,
-                                analyzed, anomalies, skipped)
+                                analyzed, anomalies, skipped, cached, estimate)
+    sampled = estimate is not None
+    bounds = estimate if sampled else (None, None, None)
     cursor = db_connection.cursor()
     try:
         cursor.execute(
-            "UPDATE results SET (analyzed, anomalies, skipped) = (%s, %s, %s) WHERE sha256 = %s;",
-            (analyzed, anomalies, skipped, sha256))
+            "UPDATE results SET (analyzed, anomalies, skipped, cached, sampled,"
+            " anomalies_estimate, anomalies_low, anomalies_high) ="
+            " (%s, %s, %s, %s, %s, %s, %s, %s) WHERE sha256 = %s;",
+            (analyzed, anomalies, skipped, cached, sampled, *bounds, sha256))
         db_connection.commit()
         cursor.close()
     except db.Error as error:
         db_connection.rollback()
         cursor.close()
         raise DatabaseRetry(error, store_anomaly_overview, sha256, analyzed,
-                            anomalies, skipped)
+                            anomalies, skipped, cached, estimate)
+
+
+def replace_anomalies(entries, db_connection=None):
+    """Replaces the anomalies of apks and their anomaly counts in results.
+
+    Estimated anomaly counts of sampled apks are cleared, as they were derived from the
+    replaced scores.
+
+    Parameters
+    ----------
+    entries : list
+        Tuples of the sha256 of an apk and a dict mapping the names of its anomalous
+        methods to their scores.
+    db_connection : db.Connection
+    """
+    if db_connection is None:
+        try:
+            db_connection = db.connect(db_string)
+        except db.Error as error:
+            logger.error('Could not establish a connection to the database.')
+            raise DatabaseRetry(error, replace_anomalies, entries)
+    cursor = db_connection.cursor()
+    try:
+        execute_values(
+            cursor,
+            "INSERT INTO anomalies (sha256, anomalies) VALUES %s"
+            " ON CONFLICT (sha256) DO UPDATE SET anomalies = EXCLUDED.anomalies;",
+            [(sha256, json.dumps(anomalies)) for sha256, anomalies in entries])
+        execute_values(
+            cursor, "UPDATE results SET anomalies = v.anomalies, anomalies_estimate = NULL,"
+            " anomalies_low = NULL, anomalies_high = NULL FROM (VALUES %s)"
+            " AS v (sha256, anomalies) WHERE results.sha256 = v.sha256;",
+            [(sha256, len(anomalies)) for sha256, anomalies in entries])
+        db_connection.commit()
+        cursor.close()
+    except db.Error as error:
+        db_connection.rollback()
+        cursor.close()
+        raise DatabaseRetry(error, replace_anomalies, entries, db_connection)
+
+
+@local
+def apk_finished(sha256):
+    """Marks the end of the results of an apk, only local backends write them in batches."""
+
+
+@local
+def close_results():
+    """Writes the results still buffered by a local backend."""
+
+
+def apk_metadata(sha256s, db_connection=None):
+    """Yields the markets and VirusTotal detections of apks from "androzoo_apks", and their
+    analyzed method and anomaly counts from "results". Columns of apks missing from either
+    are None.
+
+    Parameters
+    ----------
+    sha256s : list
+    db_connection : db.Connection
+    """
+    return access(
+        "SELECT s.sha256, a.markets, a.vt_detection, r.analyzed, r.anomalies FROM"
+        " unnest(%s::varchar[]) AS s (sha256)"
+        " LEFT OUTER JOIN androzoo_apks AS a ON a.sha256 = s.sha256"
+        " LEFT OUTER JOIN results AS r ON r.sha256 = s.sha256;", (sha256s, ),
+        db_connection)
+
+
+def lookup_cfg_scores(model, digests, db_connection):
+    """Looks up cached anomaly scores of methods and marks the hits as recently used.
+
+    Parameters
+    ----------
+    model : str
+        Identifier of the model and parameters the scores were computed with.
+    digests : list
+        Digests of the methods' bytecode, see cfganomaly.method_digest.
+    db_connection : db.Connection
+
+    Returns
+    -------
+    dict
+        Maps the digests found in the cache to their score.
+    """
+    cursor = db_connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT digest, score FROM cfg_scores WHERE model = %s AND digest = ANY(%s);",
+            (model, digests))
+        scores = dict(cursor.fetchall())
+        # Rows other workers are touching right now are recent enough already
+        cursor.execute(
+            "UPDATE cfg_scores SET last_used = now() WHERE (model, digest) IN (SELECT model, digest"
+            " FROM cfg_scores WHERE model = %s AND digest = ANY(%s) AND last_used < now() -"
+            " interval '1 hour' FOR UPDATE SKIP LOCKED);", (model, list(scores)))
+        db_connection.commit()
+        cursor.close()
+        return scores
+    except db.Error as error:
+        db_connection.rollback()
+        cursor.close()
+        raise DatabaseRetry(error, lookup_cfg_scores, model, digests,
+                            db_connection)
+
+
+def store_cfg_scores(model, scores, db_connection):
+    cursor = db_connection.cursor()
+    try:
+        # Inserting in a fixed order keeps concurrent workers from deadlocking
+        execute_values(
+            cursor,
+            "INSERT INTO cfg_scores (model, digest, score) VALUES %s ON CONFLICT DO NOTHING;",
+            [(model, digest, float(score))
+             for digest, score in sorted(scores.items())])
+        db_connection.commit()
+        cursor.close()
+    except db.Error as error:
+        db_connection.rollback()
+        cursor.close()
+        raise DatabaseRetry(error, store_cfg_scores, model, scores,
+                            db_connection)
+
+
+def evict_cfg_scores(capacity, db_connection):
+    """Removes the least recently used cached scores exceeding capacity.
+
+    The size of the table is taken from the planner statistics, so the bound is approximate.
+
+    Returns
+    -------
+    int
+        Number of removed scores.
+    """
+    cursor = db_connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE relname = 'cfg_scores';")
+        row = cursor.fetchone()
+        excess = max(0, row[0] if row else 0) - capacity
+        removed = 0
+        if excess > 0:
+            cursor.execute(
+                "DELETE FROM cfg_scores WHERE (model, digest) IN (SELECT model, digest FROM"
+                " cfg_scores ORDER BY last_used LIMIT %s FOR UPDATE SKIP LOCKED);",
+                (excess, ))
+            removed = cursor.rowcount
+        db_connection.commit()
+        cursor.close()
+        return removed
+    except db.Error as error:
+        db_connection.rollback()
+        cursor.close()
+        raise DatabaseRetry(error, evict_cfg_scores, capacity, db_connection)
 
 
+@local
 def store_fdroid_app(sha256, package_name, version, db_connection=None):
     if db_connection is None:
         try:
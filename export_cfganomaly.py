@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import pickle
+import time
+from hashlib import sha256
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from cfganomaly.forest import FlatForest, export_forest
+
+parser = argparse.ArgumentParser(
+    'Tool for exporting a trained CFG anomaly detector into memory-mappable arrays.')
+parser.add_argument('model', help='path of the trained model (.pickle.gz)')
+parser.add_argument('output', help='directory to write the arrays to')
+parser.add_argument('--samples',
+                    type=int,
+                    default=1000,
+                    help='number of random samples to compare scores on')
+parser.add_argument('--density',
+                    type=float,
+                    default=0.02,
+                    help='fraction of non-zero features of the random samples')
+parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+args = parser.parse_args()
+
+start_time = time.time()
+with open(args.model, 'rb') as f:
+    model_id = sha256(f.read()).hexdigest()
+with gzip.open(args.model, 'rb') as f:
+    model = pickle.load(f)
+pickle_time = time.time() - start_time
+
+print(f"Exporting {len(model.estimators_)} trees to {args.output}")
+export_forest(model, args.output, model_id)
+
+start_time = time.time()
+forest = FlatForest.load(args.output)
+load_time = time.time() - start_time
+
+print("\nComparing scores...")
+samples = sparse_random(args.samples,
+                        model.n_features_in_,
+                        density=args.density,
+                        format='csr',
+                        dtype=np.float32,
+                        random_state=args.seed)
+start_time = time.time()
+expected = model.score_samples(samples)
+sklearn_time = time.time() - start_time
+start_time = time.time()
+actual = forest.score_samples(samples)
+flat_time = time.time() - start_time
+
+print("   Maximum difference: {}.".format(np.abs(expected - actual).max()))
+print("   Load time: {:.4f}s (pickle: {:.4f}s).".format(load_time, pickle_time))
+print("   Scoring time: {:.4f}s (sklearn: {:.4f}s).".format(
+    flat_time, sklearn_time))
+
+if not np.allclose(expected, actual, rtol=0, atol=1e-9):
+    raise SystemExit("Scores of the exported forest differ from the model.")
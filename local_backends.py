@@ -0,0 +1,421 @@
+"""Local alternatives to PostgreSQL for the results of the analysis, selected with --db.
+
+Both backends keep the logical tables of database.create, but only support what local
+analyses (gplay and fdroid) write. Results are buffered per worker process and written
+every batch apks, so the cost of storing them can be measured apart from the analysis.
+"""
+import glob
+import json
+import logging
+import os
+import sqlite3
+import uuid
+from abc import ABC, abstractmethod
+
+from compatibility.json import Encoder
+
+logger = logging.getLogger('LocalBackend')
+logger.setLevel(logging.NOTSET)
+
+SQLITE = 'sqlite:'
+PARQUET = 'parquet:'
+
+# Columns of the tables written by the analysis, the first ones form the primary key
+TABLES = {
+    'results': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('permissions', 'text[]'),
+                    ('libs', 'int'), ('dex_loader', 'int'),
+                    ('class_loader', 'int'), ('reflection', 'int'),
+                    ('reflection_invocation', 'int'), ('methods_total', 'int'),
+                    ('methods_success', 'int'),
+                    ('methods_decompiler_fail', 'int'),
+                    ('methods_parser_fail', 'int'), ('analyzed', 'int'),
+                    ('anomalies', 'int'), ('skipped', 'int'), ('cached', 'int'),
+                    ('sampled', 'bool'), ('anomalies_estimate', 'float'),
+                    ('anomalies_low', 'float'), ('anomalies_high', 'float')]
+    },
+    'errors': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('error', 'text'), ('partial', 'bool')]
+    },
+    'apkid': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('apkid', 'json'), ('error', 'text')]
+    },
+    'accessed_classes': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('libraries', 'json'),
+                    ('loaded_classes', 'json')]
+    },
+    'dex_loaders': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('basedex', 'int'), ('dex', 'int'),
+                    ('inmemory', 'int'), ('path', 'int'),
+                    ('delegatelast', 'int')]
+    },
+    'reflection': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('reflected_classes', 'json'),
+                    ('reflected_methods', 'json')]
+    },
+    'files': {
+        'key': ('sha256', 'origin'),
+        'columns': [('sha256', 'text'), ('origin', 'text'), ('name', 'text'),
+                    ('entropy', 'float'), ('magic', 'text'), ('size', 'int')]
+    },
+    'anomalies': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('anomalies', 'json')]
+    },
+    'google_play_apks': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('dex_date', 'text'),
+                    ('apk_size', 'int'), ('pkg_name', 'text'),
+                    ('version_code', 'int'), ('author', 'text'),
+                    ('category', 'text'), ('stars', 'float'),
+                    ('downloads', 'text'), ('has_ads', 'bool')]
+    },
+    'fdroid': {
+        'key': ('sha256', ),
+        'columns': [('sha256', 'text'), ('name', 'text'), ('version', 'int')]
+    },
+}
+
+
+def open_backend(db, batch):
+    """Returns the local backend selected by a --db value, or None for PostgreSQL connection strings."""
+    if db.startswith(SQLITE):
+        return SqliteBackend(db[len(SQLITE):], batch)
+    if db.startswith(PARQUET):
+        return ParquetBackend(db[len(PARQUET):], batch)
+    return None
+
+
+class LocalBackend(ABC):
+    """Buffers the rows written for each apk and hands them to flush every batch apks.
+
+    Rows of the apk being analyzed are only added to the batch once apk_finished is
+    called, so the results of an apk whose analysis is cut off are never written. Updates
+    of rows still in the buffer are applied to them directly. The methods mirror the
+    functions of database they replace, including their unused db_connection.
+    """
+
+    def __init__(self, path, batch):
+        self.path = os.path.abspath(path)
+        self.batch = batch
+        self.pending = {table: {} for table in TABLES}
+        self.updates = []
+        self.current = {table: {} for table in TABLES}
+        self.current_updates = []
+        self.apks = 0
+
+    def insert(self, table, **values):
+        key = tuple(values[column] for column in TABLES[table]['key'])
+        # Like ON CONFLICT DO NOTHING
+        if key not in self.pending[table]:
+            self.current[table].setdefault(key, values)
+
+    def update(self, table, sha256, **values):
+        row = self.current[table].get((sha256, ),
+                                      self.pending[table].get((sha256, )))
+        if row is not None:
+            row.update(values)
+        else:
+            self.current_updates.append((table, sha256, values))
+
+    def apk_finished(self, sha256):
+        for table, rows in self.current.items():
+            self.pending[table].update(rows)
+        self.updates.extend(self.current_updates)
+        self.current = {table: {} for table in TABLES}
+        self.current_updates = []
+        self.apks += 1
+        if self.apks >= self.batch:
+            self.flush_pending()
+
+    def close_results(self):
+        """Writes the rows of all finished apks, those of an unfinished one are dropped."""
+        self.current = {table: {} for table in TABLES}
+        self.current_updates = []
+        self.flush_pending()
+
+    def flush_pending(self):
+        if self.apks or self.updates or any(self.pending.values()):
+            self.flush({
+                table: list(rows.values())
+                for table, rows in self.pending.items() if rows
+            }, self.updates)
+        self.pending = {table: {} for table in TABLES}
+        self.updates = []
+        self.apks = 0
+
+    @abstractmethod
+    def flush(self, rows, updates):
+        """Writes the buffered rows, grouped by table, and the updates of rows written before."""
+
+    @abstractmethod
+    def create(self):
+        """Creates the tables, if they do not exist yet."""
+
+    @abstractmethod
+    def processed(self):
+        """Yields the sha256 of all apks in "results" or "errors"."""
+
+    def store_result(self,
+                     sha256,
+                     permissions,
+                     libraries,
+                     dex_loaders,
+                     class_loaders,
+                     reflection_access,
+                     reflection_invocations,
+                     method_count,
+                     methods_success,
+                     method_parser_failed,
+                     method_decompiler_failed,
+                     db_connection=None):
+        self.insert('results',
+                    sha256=sha256,
+                    permissions=list(permissions)
+                    if permissions is not None else None,
+                    libs=libraries,
+                    dex_loader=dex_loaders,
+                    class_loader=class_loaders,
+                    reflection=reflection_access,
+                    reflection_invocation=reflection_invocations,
+                    methods_total=method_count,
+                    methods_success=methods_success,
+                    methods_decompiler_fail=method_decompiler_failed,
+                    methods_parser_fail=method_parser_failed)
+
+    def store_google_play_app(self,
+                              sha256,
+                              dex_date,
+                              size,
+                              pkg_name,
+                              version,
+                              author,
+                              category,
+                              stars,
+                              downloads,
+                              has_ads,
+                              db_connection=None):
+        self.insert('google_play_apks',
+                    sha256=sha256,
+                    dex_date=str(dex_date) if dex_date is not None else None,
+                    apk_size=size,
+                    pkg_name=pkg_name,
+                    version_code=version,
+                    author=author,
+                    category=category,
+                    stars=stars,
+                    downloads=downloads,
+                    has_ads=has_ads)
+
+    def store_library_access(self, sha256, loaded_libs, db_connection=None):
+        self.insert('accessed_classes',
+                    sha256=sha256,
+                    libraries=json.dumps(loaded_libs))
+
+    def store_dex_loader_access(self, sha256, dex_loaders, db_connection=None):
+        self.insert(
+            'dex_loaders',
+            sha256=sha256,
+            basedex=dex_loaders["Ldalvik/system/BaseDexClassLoader;"],
+            dex=dex_loaders["Ldalvik/system/DexClassLoader;"],
+            inmemory=dex_loaders["Ldalvik/system/InMemoryDexClassLoader;"],
+            path=dex_loaders["Ldalvik/system/PathClassLoader;"],
+            delegatelast=dex_loaders["Ldalvik/system/DelegateLastClassLoader;"])
+
+    def full_error(self, sha256, error_str, partial=False, db_connection=None):
+        self.insert('errors', sha256=sha256, error=error_str, partial=partial)
+
+    def store_apkid_result(self, sha256, apkid, db_connection=None):
+        self.insert('apkid', sha256=sha256, apkid=apkid)
+
+    def apkid_error(self, sha256, error, error_text, db_connection=None):
+        error_str = error + ':\t' + error_text if error_text else error
+        self.insert('apkid', sha256=sha256, error=error_str)
+
+    def store_class_loader_access(self,
+                                  sha256,
+                                  loaded_classes,
+                                  db_connection=None):
+        self.update('accessed_classes',
+                    sha256,
+                    loaded_classes=json.dumps(loaded_classes))
+
+    def store_files(self, sha256, files, db_connection=None):
+        for file_sha256, file_name, entropy, magic, size in files:
+            self.insert('files',
+                        sha256=file_sha256,
+                        origin=sha256,
+                        name=file_name,
+                        entropy=entropy,
+                        magic=magic,
+                        size=size)
+
+    def store_anomalies(self, sha256, anomalies, db_connection=None):
+        self.insert('anomalies', sha256=sha256, anomalies=json.dumps(anomalies))
+
+    def store_reflection_information(self,
+                                     sha256,
+                                     reflected_classes,
+                                     reflected_methods,
+                                     db_connection=None):
+        self.insert('reflection',
+                    sha256=sha256,
+                    reflected_classes=json.dumps(reflected_classes,
+                                                 cls=Encoder),
+                    reflected_methods=json.dumps(reflected_methods,
+                                                 cls=Encoder))
+
+    def store_anomaly_overview(self,
+                               sha256,
+                               analyzed,
+                               anomalies,
+                               skipped,
+                               cached=0,
+                               estimate=None,
+                               db_connection=None):
+        sampled = estimate is not None
+        bounds = estimate if sampled else (None, None, None)
+        self.update('results',
+                    sha256,
+                    analyzed=analyzed,
+                    anomalies=anomalies,
+                    skipped=skipped,
+                    cached=cached,
+                    sampled=sampled,
+                    anomalies_estimate=bounds[0],
+                    anomalies_low=bounds[1],
+                    anomalies_high=bounds[2])
+
+    def store_fdroid_app(self, sha256, package_name, version, db_connection=None):
+        self.insert('fdroid',
+                    sha256=sha256,
+                    name=package_name,
+                    version=int(version) if version is not None else None)
+
+
+class SqliteBackend(LocalBackend):
+    """SQLite database in WAL mode, so readers and the workers' batched writes do not block each other.
+
+    Each batch is written in a single transaction, which only holds the write lock for
+    as long as it takes to insert the buffered rows.
+    """
+
+    def __init__(self, path, batch):
+        super().__init__(path, batch)
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # Forked workers must not share the connection of their parent
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL;')
+            self.connection.execute('PRAGMA synchronous=NORMAL;')
+            self.pid = os.getpid()
+        return self.connection
+
+    def create(self):
+        connection = self.connect()
+        for table, schema in TABLES.items():
+            columns = ', '.join(f'{column} {sqlite_type(column_type)}'
+                                for column, column_type in schema['columns'])
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} ({columns},'
+                f' PRIMARY KEY ({", ".join(schema["key"])}));')
+        connection.commit()
+        logger.info(f'Storing results in {self.path}.')
+
+    def processed(self):
+        return (row[0] for row in self.connect().execute(
+            'SELECT sha256 FROM results UNION SELECT sha256 FROM errors;'))
+
+    def flush(self, rows, updates):
+        connection = self.connect()
+        with connection:
+            for table, table_rows in rows.items():
+                columns = [column for column, _ in TABLES[table]['columns']]
+                types = dict(TABLES[table]['columns'])
+                connection.executemany(
+                    f'INSERT OR IGNORE INTO {table} ({", ".join(columns)}) VALUES'
+                    f' ({", ".join("?" * len(columns))});',
+                    [[
+                        json.dumps(row.get(column)) if types[column] == 'text[]'
+                        and row.get(column) is not None else row.get(column)
+                        for column in columns
+                    ] for row in table_rows])
+            for table, sha256, values in updates:
+                assignments = ', '.join(f'{column} = ?' for column in values)
+                connection.execute(
+                    f'UPDATE {table} SET {assignments} WHERE sha256 = ?;',
+                    (*values.values(), sha256))
+
+    def close_results(self):
+        super().close_results()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def sqlite_type(column_type):
+    return {
+        'int': 'INTEGER',
+        'float': 'REAL',
+        'bool': 'INTEGER'
+    }.get(column_type, 'TEXT')
+
+
+class ParquetBackend(LocalBackend):
+    """Append-only directory of Parquet files, one subdirectory per table.
+
+    Every batch of a worker becomes one file per table it has rows for, written to a
+    temporary name first, so a crash only loses the apks of unwritten batches. Rows are
+    never changed once written, updates of rows of earlier batches are dropped.
+    Requires pyarrow.
+    """
+
+    def __init__(self, path, batch):
+        super().__init__(path, batch)
+        # Fails early if pyarrow is missing, rather than in the workers
+        import pyarrow
+
+    def create(self):
+        for table in TABLES:
+            os.makedirs(os.path.join(self.path, table), exist_ok=True)
+        logger.info(f'Storing results in {self.path}.')
+
+    def processed(self):
+        import pyarrow.parquet as pq
+        for table in ('results', 'errors'):
+            for path in glob.glob(os.path.join(self.path, table, '*.parquet')):
+                yield from pq.read_table(path, columns=['sha256'])['sha256'].to_pylist()
+
+    def flush(self, rows, updates):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        for table, sha256, _ in updates:
+            logger.warning(f'Dropped update of {sha256} in "{table}", its row'
+                           f' was written with an earlier batch.')
+        for table, table_rows in rows.items():
+            schema = pa.schema([(column, parquet_type(column_type))
+                                for column, column_type in TABLES[table]['columns']])
+            path = os.path.join(self.path, table, f'part-{uuid.uuid4().hex}.parquet')
+            temporary = f'{path}.tmp'
+            pq.write_table(pa.Table.from_pylist(table_rows, schema=schema),
+                           temporary)
+            os.replace(temporary, path)
+
+
+def parquet_type(column_type):
+    import pyarrow as pa
+    return {
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'bool': pa.bool_(),
+        'text[]': pa.list_(pa.string())
+    }.get(column_type, pa.string())
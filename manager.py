@@ -9,6 +9,7 @@ import database
 from apk_managers.androzoo import AndrozooApkManager
 from apk_managers.local import GplayApkManager, FDroidApkManager
 from utility.convenience import convert_time, VERBOSE, STATUS
+from scoring import ScoringServer
 from vt_manager import Dummy, Active
 from worker import Worker
 
@@ -34,6 +35,14 @@ class Manager:
         self.start_time = self.vm.Value(int, monotonic_ns())
         self.worker_count = 0
         self.out_dir = None
+        self.finished = None
+        self.score_cache = 0
+        self.scoring_server = None
+        self.scoring_requests = None
+        self.scoring_responses = {}
+        self.cascade = None
+        self.sampling = None
+        self.feature_sink = None
 
     def init(self, _):
         self.logger.fatal(
@@ -41,9 +50,36 @@ class Manager:
         )
         sys.exit(1)
 
+    def init_scoring(self, args):
+        self.score_cache = args.score_cache
+        if database.backend is not None and self.score_cache:
+            self.logger.info('The score cache needs PostgreSQL, disabled it.')
+            self.score_cache = 0
+        if args.cascade:
+            self.cascade = (args.cascade, args.cascade_confidence)
+        if args.sample_above:
+            self.sampling = (args.sample_above, args.method_sample_size)
+        self.feature_sink = args.feature_sink
+        if not args.scoring_server:
+            return
+        self.scoring_requests = Queue()
+        for i in range(self.worker_count):
+            self.scoring_responses[self.worker_name(i)] = Queue()
+        self.scoring_server = ScoringServer(self.scoring_requests,
+                                            self.scoring_responses,
+                                            args.batch_rows,
+                                            args.batch_latency / 1000,
+                                            self.cascade)
+        self.scoring_server.start()
+        self.logger.log(VERBOSE, 'Started ScoringServer')
+
+    @staticmethod
+    def worker_name(i):
+        return f'Worker {"0" if i < 10 else ""}{i}'
+
     def start_workers(self):
         for i in range(self.worker_count):
-            name = f'Worker {"0" if i < 10 else ""}{i}'
+            name = self.worker_name(i)
             worker = Worker(name, self.apk_manager.queue, self, self.out_dir)
             self.workers[name] = worker
             worker.start()
@@ -68,6 +104,10 @@ class Manager:
         )
         for w in self.workers:
             self.workers[w].join()
+        if self.scoring_server:
+            self.scoring_server.terminate()
+            self.scoring_server.join()
+            self.logger.info('Stopped ScoringServer.')
         self.verbose_status()
         self.logger.info('All done, exiting now.')
         sys.exit(0)
@@ -116,6 +156,10 @@ class Manager:
         self.total.set(self.total.get() + 1)
         self.log_status()
 
+    def report_finished(self, sha256):
+        if self.finished is not None:
+            self.finished.put(sha256)
+
     def close(self, name):
         with self.lock:
             self.remove.append(name)
@@ -144,6 +188,17 @@ class Manager:
 
     def restart_dead_processes(self):
         with self.lock:
+            if self.scoring_server and not self.scoring_server.is_alive():
+                dead = self.scoring_server
+                dead.join()
+                dead.close()
+                self.scoring_server = ScoringServer(self.scoring_requests,
+                                                    self.scoring_responses,
+                                                    dead.batch_rows,
+                                                    dead.latency, dead.cascade)
+                self.scoring_server.start()
+                self.logger.info(
+                    f'Restarted ScoringServer with pid {self.scoring_server.pid}')
             while len(self.remove) > 0:
                 name = self.remove.pop()
                 worker = self.workers[name]
@@ -184,6 +239,7 @@ class GplayManager(Manager):
         self.apk_manager = GplayApkManager(os.path.abspath(args.root), queue,
                                            args.worker)
         self.apk_manager.start()
+        self.init_scoring(args)
         self.start_workers()
 
 
@@ -201,6 +257,7 @@ class FDroidManager(Manager):
         self.apk_manager = FDroidApkManager(os.path.abspath(args.root), queue,
                                             args.worker)
         self.apk_manager.start()
+        self.init_scoring(args)
         self.start_workers()
 
 
@@ -210,15 +267,24 @@ class AndrozooManager(Manager):
         super().__init__()
 
     def init(self, args):
+        if database.backend is not None:
+            self.logger.fatal(
+                'The androzoo analysis selects its apks from PostgreSQL, local --db backends'
+                ' are only supported for gplay and fdroid.')
+            sys.exit(1)
         self.worker_count = args.worker
         self.out_dir = args.out
         database.create()
         queue = Queue(args.worker)
+        self.finished = Queue()
         self.apk_manager = AndrozooApkManager(args.key, args.queries, queue,
-                                              args.worker, args.repeat)
+                                              args.worker, args.repeat,
+                                              args.fetch_size, self.finished,
+                                              args.listen)
         if args.vt:
             self.vt_manager = Active(args.vt, args.quota)
         else:
             self.vt_manager = Dummy()
         self.apk_manager.start()
+        self.init_scoring(args)
         self.start_workers()
@@ -0,0 +1,245 @@
+import gzip
+import logging
+import os
+import pickle
+import queue
+import signal
+from collections import namedtuple
+from hashlib import sha256
+from importlib.resources import files, as_file
+from itertools import count
+from multiprocessing import Process
+from time import monotonic
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+import cfganomaly
+from cfganomaly.forest import CascadedForest, FlatForest, flatten_forest, is_forest
+from utility.convenience import CUTOFF_SCORE, STATUS
+
+MODEL = files(cfganomaly).joinpath('cfganomaly-model.pickle.gz')
+FOREST = files(cfganomaly).joinpath('cfganomaly-model.forest')
+RESPONSE_TIMEOUT = 600
+
+Request = namedtuple('Request', 'name request_id submitted data indices indptr shape')
+
+
+def load_model(logger, cascade=None, path=None):
+    """Loads the anomaly detection model.
+
+    The memory-mapped export written by export_cfganomaly.py is preferred over the pickled model.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+    cascade : tuple
+        If set, the number of trees and the confidence of a CascadedForest wrapping the model.
+    path : str
+        If set, the pickled model or exported forest to load instead of the packaged one.
+
+    Returns
+    -------
+    tuple
+        The model and its identifier, based on the digest of the pickled model.
+    """
+    forest_path = os.path.abspath(path or FOREST)
+    if is_forest(forest_path):
+        model = FlatForest.load(forest_path)
+        identifier = model.model_id
+    elif path is not None:
+        with open(path, 'rb') as f:
+            pickled = f.read()
+        model = pickle.loads(gzip.decompress(pickled))
+        identifier = sha256(pickled).hexdigest()
+    else:
+        with as_file(MODEL) as model_path:
+            model_path = os.path.abspath(model_path)
+            if not os.path.isfile(model_path):
+                logger.error(f'Model was not found at path {model_path}.')
+            with gzip.open(MODEL, 'rb') as f:
+                model = pickle.load(f)
+        identifier = sha256(MODEL.read_bytes()).hexdigest()
+    if cascade:
+        if not isinstance(model, FlatForest):
+            model = flatten_forest(model, identifier)
+        model = CascadedForest(model, CUTOFF_SCORE, *cascade)
+        identifier = model.model_id
+    return model, identifier
+
+
+class ScoringServer(Process):
+    """Owns the only copy of the anomaly detection model and scores the requests of all workers.
+
+    Requests arriving within latency seconds of the first one are scored together, as long as
+    they do not exceed batch_rows rows in total, so the per-call overhead of the model is paid
+    once per batch instead of once per apk. Requests without data ask for the vocabulary and
+    identifier of the model instead, so workers never load the model themselves.
+    """
+
+    def __init__(self,
+                 requests,
+                 responses,
+                 batch_rows=4096,
+                 latency=0.02,
+                 cascade=None,
+                 report_interval=60):
+        super(ScoringServer, self).__init__()
+        self.name = 'ScoringServer'
+        self.requests = requests
+        self.responses = responses
+        self.batch_rows = batch_rows
+        self.latency = latency
+        self.cascade = cascade
+        self.model = None
+        self.model_id = None
+        self.report_interval = report_interval
+        self.logger = logging.getLogger(self.name)
+        self.logger.setLevel(logging.NOTSET)
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.batches = 0
+        self.batched_requests = 0
+        self.rows = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.scoring_time = 0.0
+        self.last_report = monotonic()
+
+    def run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        model, self.model_id = load_model(self.logger, self.cascade)
+        self.model = model
+        self.logger.info('Loaded model, accepting requests.')
+        stopped = False
+        while not stopped:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            rows = request.shape[0]
+            deadline = monotonic() + self.latency
+            while rows < self.batch_rows:
+                try:
+                    request = self.requests.get(
+                        timeout=max(0.0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                batch.append(request)
+                rows += request.shape[0]
+            self.score(model, batch)
+            if monotonic() - self.last_report >= self.report_interval:
+                self.report()
+        self.logger.info('Finished.')
+
+    def score(self, model, batch):
+        for request in batch:
+            if request.data is None:
+                self.respond(request, (getattr(model, 'ngram_vocabulary_', None),
+                                       self.model_id), None)
+        batch = [request for request in batch if request.data is not None]
+        if not batch:
+            return
+        start = monotonic()
+        waits = [start - request.submitted for request in batch]
+        matrices = [
+            csr_matrix((request.data, request.indices, request.indptr),
+                       shape=request.shape) for request in batch
+        ]
+        try:
+            scores = model.score_samples(vstack(matrices, format='csr'))
+            offsets = np.cumsum([0] + [m.shape[0] for m in matrices])
+            results = [(scores[offsets[i]:offsets[i + 1]], None)
+                       for i in range(len(batch))]
+        except ValueError:
+            # Score separately, so only the offending requests fail
+            results = []
+            for matrix in matrices:
+                try:
+                    results.append((model.score_samples(matrix), None))
+                except ValueError as error:
+                    results.append((None, repr(error)))
+        self.scoring_time += monotonic() - start
+        for request, (scores, error) in zip(batch, results):
+            self.respond(request, scores, error)
+        self.batches += 1
+        self.batched_requests += len(batch)
+        self.rows += sum(matrix.shape[0] for matrix in matrices)
+        self.wait += sum(waits)
+        self.max_wait = max(self.max_wait, max(waits))
+
+    def respond(self, request, result, error):
+        responses = self.responses.get(request.name)
+        if responses is not None:
+            responses.put((request.request_id, result, error))
+
+    def report(self):
+        batches = max(1, self.batches)
+        self.logger.log(
+            STATUS, f'Scored {self.rows} rows of {self.batched_requests} requests in'
+            f' {self.batches} batches: {self.rows / batches:.1f} rows and'
+            f' {self.batched_requests / batches:.1f} requests per batch, queue wait'
+            f' {self.wait / max(1, self.batched_requests) * 1000:.1f}ms on average and'
+            f' {self.max_wait * 1000:.1f}ms at most,'
+            f' {self.rows / max(self.scoring_time, 1e-9):.0f} rows/s while scoring.')
+        if isinstance(self.model, CascadedForest):
+            self.logger.log(
+                STATUS, f'Cascade stopped early for {self.model.exits} of'
+                f' {self.model.samples} rows, saving'
+                f' {self.model.saved_evaluations() * 100:.2f}% of tree evaluations.')
+            self.model.reset_statistics()
+        self.reset_statistics()
+
+
+class RemoteModel:
+    """Stand-in for the model in CfgAnomaly that has a ScoringServer score the samples.
+
+    Parameters
+    ----------
+    name : str
+        Name of the worker, determines where the server sends its responses.
+    requests : multiprocessing.Queue
+        Request queue of the server.
+    responses : multiprocessing.Queue
+        Queue the server sends this worker's responses to.
+    """
+
+    def __init__(self, name, requests, responses):
+        self.name = name
+        self.ngram_vocabulary_ = None
+        self.requests = requests
+        self.responses = responses
+        self.ids = count()
+
+    def describe(self):
+        """Takes the vocabulary of the server's model, and returns the model's identifier."""
+        self.ngram_vocabulary_, model_id = self.request(None, None, None, (0, 0))
+        return model_id
+
+    def score_samples(self, X):
+        X = csr_matrix(X, dtype=np.float32)
+        return self.request(X.data, X.indices, X.indptr, X.shape)
+
+    def request(self, data, indices, indptr, shape):
+        # Workers restarted under the same name must not take their predecessor's responses
+        request_id = (os.getpid(), next(self.ids))
+        self.requests.put(
+            Request(self.name, request_id, monotonic(), data, indices, indptr,
+                    shape))
+        while True:
+            try:
+                response_id, result, error = self.responses.get(
+                    timeout=RESPONSE_TIMEOUT)
+            except queue.Empty:
+                raise ValueError(
+                    f'No response from the scoring server within {RESPONSE_TIMEOUT}s.'
+                )
+            if response_id != request_id:
+                continue
+            if error:
+                raise ValueError(error)
+            return result
@@ -1,12 +1,9 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from scipy.sparse import csc_matrix, vstack
+from scipy.sparse import csr_matrix
 from sklearn.ensemble import IsolationForest
 from androguard.misc import AnalyzeAPK
-from compatibility.androguard import method2json_direct
-from collections import Counter
-import json
 import os.path
 import glob
 from tqdm import tqdm
@@ -16,16 +13,20 @@ import pickle
 import argparse
 import time
 from cfganomaly import cfganomaly
+from cfganomaly.corpus import Corpus
+from cfganomaly.forest import fit_distinct
+from cfganomaly.subforests import train_subforests
 
 
 def analyze_apk(arguments):
-    apk, max_n, min_size, min_bbs = arguments
+    apk, corpus, max_n, min_size, min_bbs = arguments
 
-    results = []
+    columns = []
+    values = []
+    bins = []
     skipped = 0
 
     vectorizer = cfganomaly.NgramVectorizer(max_n=max_n)
-    bin_sizes = Counter()
 
     a, d, dx = AnalyzeAPK(apk)
     for method in dx.find_methods():
@@ -37,36 +38,44 @@ def analyze_apk(arguments):
             continue
 
         meth_analysis = dx.get_method(method.get_method())
-        g = json.loads(method2json_direct(meth_analysis))
-
-        tot_bbs = len(g['reports'])
-
         # Minimum BB count check
-        if tot_bbs < min_bbs:
+        cfg = cfganomaly.build_cfg_direct(meth_analysis, min_bbs)
+        if cfg is None:
             skipped += 1
             continue
 
-        ngrams = cfganomaly.extract_ngrams(g['reports'], max_n=max_n)
-        vector = vectorizer.vectorize(ngrams, tot_bbs)
-
-        method_name = method.get_method().get_name()
-        code_len = 2 * method.get_method().get_length()
-
-        # Bundle all methods that are >= 2^11 bytes into one bin to avoid
-        # very small bins, which might lead to overfitting.
-        log2_bin = min(11, int(np.log2(code_len)))
-        bin_sizes[log2_bin] += 1
+        tot_bbs = len(cfg)
+        ngrams = cfganomaly.count_ngrams(cfg, max_n=max_n)
+        row_columns, row_values = vectorizer.vectorize_sparse(ngrams, tot_bbs)
+        columns.append(row_columns)
+        values.append(row_values)
 
-        results.append((method_name, log2_bin, tot_bbs, vector))
+        bins.append(cfganomaly.size_bin(method.get_method().get_length()))
 
     filename = os.path.splitext(os.path.basename(apk))[0]
-    return (filename, results, bin_sizes, skipped)
+    if bins:
+        # Only the shard's location goes back to the parent, not the vectors
+        indptr = np.cumsum([0] + [len(row) for row in columns])
+        matrix = csr_matrix(
+            (np.concatenate(values), np.concatenate(columns), indptr),
+            shape=(len(bins), vectorizer.width))
+        corpus.write_shard(filename, matrix, bins)
+    return (filename, len(bins), skipped)
 
 
 parser = argparse.ArgumentParser('Tool for training CFG anomaly detector.')
 
-parser.add_argument('appdir', help='path to directory with apps')
+parser.add_argument(
+    'appdir',
+    nargs='?',
+    help='path to directory with apps. If omitted, the model is trained on the'
+    ' vectors already in the corpus, e.g., those written by the analysis with'
+    ' --feature-sink')
 parser.add_argument('output', help='model-file output path')
+parser.add_argument(
+    '--corpus',
+    help='directory to store the extracted vectors in, extraction resumes from it'
+    ' (default: the output path with .corpus appended)')
 parser.add_argument('--max_n', type=int, default=5, help='maximum n-gram size')
 parser.add_argument('--min_size',
                     type=int,
@@ -84,56 +93,121 @@ parser.add_argument('--n_threads',
                     type=int,
                     default=-1,
                     help='number of threads to use')
+parser.add_argument(
+    '--deduplicate',
+    action='store_true',
+    help='train on distinct vectors only, weighted by how often they occur')
+parser.add_argument(
+    '--subforests',
+    type=int,
+    default=0,
+    help='fit this many sub-forests on samples of disjoint groups of apps in'
+    ' parallel and merge them, instead of fitting on all vectors at once')
+parser.add_argument('--subforest_samples',
+                    type=int,
+                    default=100000,
+                    help='number of vectors per sub-forest')
+parser.add_argument(
+    '--min_support',
+    type=int,
+    default=0,
+    help='drop n-gram columns that are non-zero for fewer training methods')
+parser.add_argument(
+    '--column_stats',
+    help='path to save the number of training methods each column is non-zero for (.npy)')
 
 args = parser.parse_args()
 
-matrices = []
-weights = []
-
-app_mapping = {}
-
-#idx = 0
-
-tot_skipped = 0
-no_methods = 0
+if args.appdir is None:
+    if args.corpus is None:
+        parser.error('either appdir or --corpus is required')
+    corpus = Corpus.open(args.corpus)
+else:
+    corpus = Corpus(args.corpus or args.output + '.corpus', {
+        'max_n': args.max_n,
+        'min_size': args.min_size,
+        'min_bbs': args.min_bbs
+    })
+completed = corpus.completed()
 
 start_time = time.time()
 
 print("Extracting training samples...")
 
-entries = [(path, args.max_n, args.min_size, args.min_bbs)
-           for path in glob.glob(os.path.join(args.appdir, '*.apk'))]
+apks = glob.glob(os.path.join(args.appdir,
+                              '*.apk')) if args.appdir is not None else []
+entries = [(path, corpus, args.max_n, args.min_size, args.min_bbs)
+           for path in apks
+           if os.path.splitext(os.path.basename(path))[0] not in completed]
+print("   Resuming, {} of {} apps were already extracted.".format(
+    len(apks) - len(entries), len(apks)))
 with Pool(args.n_threads if args.n_threads > 0 else None) as pool:
-    for filename, results, bin_sizes, skipped in tqdm(
-            pool.imap_unordered(analyze_apk, entries, 1)):
-        if len(results) == 0:
-            no_methods += 1
-            continue
-
-        tot_skipped += skipped
-
-        vectors = [r[3] for r in results]
-        weights += [1 / r[1] for r in results]
-
-        # app_mapping[filename] = (idx, idx + len(vectors))
-        # idx = len(vectors)
+    for filename, rows, skipped in tqdm(
+            pool.imap_unordered(analyze_apk, entries, 1), total=len(entries)):
+        corpus.commit(filename, rows, skipped)
 
-        matrices.append(csc_matrix(vectors, dtype=np.float32))
-
-full_matrix = vstack(matrices, format='csc')
-weights_arr = np.array(weights)
+completed = corpus.completed()
+tot_skipped = sum(skipped for _, skipped in completed.values())
+no_methods = sum(1 for rows, _ in completed.values() if rows == 0)
 
 print("\nExtraction complete.")
 print("   Time: {}.".format(time.time() - start_time))
 print("   Apps with no methods: {}.".format(no_methods))
 print("   Skipped methods: {}.".format(tot_skipped))
 
+support = None
+if args.subforests:
+    # Sub-forests only read samples of the corpus, never all of it at once
+    if args.min_support or args.column_stats:
+        support = corpus.support()
+else:
+    full_matrix, bins, counts = corpus.load(args.deduplicate)
+    # Distinct vectors stand for all their copies
+    weights_arr = counts / bins
+    if args.deduplicate:
+        print("   Distinct vectors: {} of {} ({:.2f}x deduplication).".format(
+            full_matrix.shape[0], counts.sum(),
+            counts.sum() / full_matrix.shape[0]))
+    if args.min_support or args.column_stats:
+        support = (full_matrix != 0).T @ counts
+
+vocabulary = None
+if support is not None:
+    if args.column_stats:
+        np.save(args.column_stats, support)
+    if args.min_support:
+        vocabulary = cfganomaly.prune_vocabulary(support, args.min_support)
+        if not args.subforests:
+            full_matrix = full_matrix[:, vocabulary]
+        print("\nPruned vocabulary to {} of {} columns.".format(
+            len(vocabulary), len(support)))
+
 print("\nTraining model...")
 
-model = IsolationForest(n_estimators=args.ensemble_size,
-                        n_jobs=args.n_threads,
-                        max_samples=1.0)
-model.fit(full_matrix, sample_weight=weights_arr)
+start_time = time.time()
+if args.subforests:
+    model, subforests = train_subforests(
+        corpus, args.subforests, args.subforest_samples, args.ensemble_size,
+        args.n_threads if args.n_threads > 0 else None, vocabulary,
+        args.deduplicate)
+    print("   Fitted {} sub-forests on {} samples each.".format(
+        len(subforests), model._max_samples))
+    print("   Fit time per sub-forest: {:.1f}s at most.".format(
+        max(elapsed for elapsed, _ in subforests)))
+    print("   Peak memory per sub-forest: {:.1f}MB at most.".format(
+        max(peak for _, peak in subforests) / 2**20))
+else:
+    model = IsolationForest(n_estimators=args.ensemble_size,
+                            n_jobs=args.n_threads,
+                            max_samples=1.0)
+    if args.deduplicate:
+        fit_distinct(model, full_matrix, counts, weights_arr)
+    else:
+        model.fit(full_matrix, sample_weight=weights_arr)
+print("   Time: {}.".format(time.time() - start_time))
+if vocabulary is not None:
+    # Saved with the model, so CfgAnomaly vectorizes into the same columns
+    model.ngram_vocabulary_ = vocabulary
 
 print(f"\nAll done! Saving model to {args.output}")
 
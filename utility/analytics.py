@@ -0,0 +1,220 @@
+import csv
+import logging
+import os
+import time
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import psycopg2 as db
+
+import database
+from utility import size_store
+from utility.convenience import STATUS, bin_name
+
+logger = logging.getLogger('Analytics')
+logger.setLevel(logging.NOTSET)
+
+# Labels of the bins of bin_name, bins_of maps sizes to their position in this list
+BINS = ['bin_empty'] + [f'bin_{idx}' for idx in range(101)]
+QUANTILES = (0.5, 0.9, 0.99)
+# Lowest VirusTotal detection count of each group
+DETECTIONS = (0, 1, 5, 10, 20)
+
+
+def bin_edges():
+    """Smallest size of each bin_{idx} or any higher bin, found by bisection on bin_name."""
+    edges = []
+    for idx in range(101):
+        low, high = 1, 2**31
+        while low < high:
+            middle = (low + high) // 2
+            if int(bin_name(middle)[4:]) >= idx:
+                high = middle
+            else:
+                low = middle + 1
+        edges.append(low)
+    return np.array(edges, dtype=np.int64)
+
+
+EDGES = bin_edges()
+
+
+def bins_of(sizes):
+    """Vectorized bin_name, returns positions in BINS instead of labels."""
+    return np.where(sizes > 0, np.searchsorted(EDGES, sizes, side='right'), 0)
+
+
+def detection_group(detections):
+    if detections is None:
+        return 'unknown'
+    idx = np.searchsorted(DETECTIONS, detections, side='right') - 1
+    if idx == len(DETECTIONS) - 1:
+        return f'{DETECTIONS[idx]}+'
+    low, high = DETECTIONS[idx], DETECTIONS[idx + 1] - 1
+    return str(low) if low == high else f'{low}-{high}'
+
+
+class Groups:
+    """Method size histograms and counts of apks, summed per group of a breakdown."""
+
+    def __init__(self):
+        self.keys = {}
+        self.histograms = []
+        self.counts = []
+
+    def add(self, key, histogram, apks, methods, size, analyzed, anomalies):
+        idx = self.keys.setdefault(key, len(self.keys))
+        if idx == len(self.histograms):
+            self.histograms.append(np.zeros(len(BINS), dtype=np.int64))
+            self.counts.append(np.zeros(5, dtype=np.int64))
+        self.histograms[idx] += histogram
+        self.counts[idx] += (apks, methods, size, analyzed, anomalies)
+
+    def merge(self, other):
+        for key, idx in other.keys.items():
+            self.add(key, other.histograms[idx], *other.counts[idx])
+
+
+_segments = {}
+_db_connection = None
+
+
+def init_process(directory, join):
+    global _db_connection
+    _segments['directory'] = directory
+    if join:
+        _db_connection = db.connect(database.db_string)
+
+
+def segment_data(segment):
+    if segment not in _segments:
+        _segments[segment] = size_store.open_segment(
+            os.path.join(_segments['directory'], segment + size_store.DATA))
+    return _segments[segment]
+
+
+def analyze_chunk(entries):
+    """Computes the statistics of the apks of a chunk of index entries.
+
+    Parameters
+    ----------
+    entries : list
+        sha256, segment and index entry of each apk.
+
+    Returns
+    -------
+    tuple
+        A row of statistics per apk, and the Groups of the chunk.
+    """
+    arrays = [
+        size_store.decode(segment_data(segment), *entry)
+        for _, segment, entry in entries
+    ]
+    counts = np.array([len(array) for array in arrays], dtype=np.int64)
+    sizes = np.concatenate(arrays + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+    apk_ids = np.repeat(np.arange(len(entries)), counts)
+    histograms = np.bincount(apk_ids * len(BINS) + bins_of(sizes),
+                             minlength=len(entries) * len(BINS)).reshape(
+                                 len(entries), len(BINS))
+    totals = np.bincount(apk_ids, weights=sizes, minlength=len(entries))
+    # Sorting by apk first and size second, so each apk's sorted sizes are consecutive.
+    # Apks without methods point behind the last size, hence the padding
+    sizes = np.append(sizes[np.lexsort((sizes, apk_ids))], 0)
+    starts = np.cumsum(counts) - counts
+    last = np.maximum(counts - 1, 0)
+    quantiles = [
+        np.where(counts > 0, sizes[starts + (last * q).astype(np.int64)], 0)
+        for q in QUANTILES + (1.0, )
+    ]
+
+    metadata = {}
+    if _db_connection is not None:
+        for sha256, *row in database.apk_metadata(
+                [sha256 for sha256, _, _ in entries], _db_connection):
+            metadata[sha256] = row
+    groups = Groups()
+    rows = []
+    for idx, (sha256, _, _) in enumerate(entries):
+        markets, detections, analyzed, anomalies = metadata.get(
+            sha256, (None, None, None, None))
+        values = (int(counts[idx]), int(totals[idx]), analyzed or 0, anomalies or 0)
+        groups.add(('all', 'all'), histograms[idx], 1, *values)
+        for market in markets or ['unknown']:
+            groups.add(('market', market), histograms[idx], 1, *values)
+        groups.add(('vt_detection', detection_group(detections)), histograms[idx],
+                   1, *values)
+        rows.append([sha256, int(counts[idx]), int(totals[idx])] +
+                    [int(quantile[idx]) for quantile in quantiles] +
+                    [';'.join(markets or []), detections, analyzed, anomalies])
+    return rows, groups
+
+
+def chunks(directory, chunk_size):
+    """Yields the index entries of all apks in the size store, chunk_size apks at a time."""
+    for segment in size_store.segment_names(directory):
+        index = size_store.read_index(
+            os.path.join(directory, segment + size_store.INDEX))
+        entries = sorted(index.items(), key=lambda entry: entry[1][0])
+        for start in range(0, len(entries), chunk_size):
+            yield [(sha256, segment, entry)
+                   for sha256, entry in entries[start:start + chunk_size]]
+
+
+def run(directory, output, processes, chunk_size=2000, join=True):
+    """Computes method size statistics of all apks in a size store and writes them as CSV.
+
+    Chunks of apks are analyzed by a pool of processes, with at most two chunks per
+    process in flight, so memory stays bounded regardless of the corpus size.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the size store.
+    output : str
+        Directory to write apks.csv, with the statistics of each apk, and groups.csv, with
+        the size histograms and counts of all apks by market and by VirusTotal detections.
+    processes : int
+    chunk_size : int
+        Number of apks analyzed at once.
+    join : bool
+        If set, the statistics are joined with "androzoo_apks" and "results".
+    """
+    os.makedirs(output, exist_ok=True)
+    groups = Groups()
+    apks = 0
+    methods = 0
+    start = time.time()
+    with open(os.path.join(output, 'apks.csv'), 'w', newline='') as f, \
+            Pool(processes, init_process, (directory, join)) as pool:
+        writer = csv.writer(f)
+        writer.writerow(['sha256', 'methods', 'size'] +
+                        [f'p{int(q * 100)}' for q in QUANTILES] +
+                        ['max', 'markets', 'vt_detection', 'analyzed', 'anomalies'])
+        pending = deque()
+        tasks = chunks(directory, chunk_size)
+        while True:
+            while len(pending) < 2 * processes:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending.append(pool.apply_async(analyze_chunk, (task, )))
+            if not pending:
+                break
+            rows, chunk_groups = pending.popleft().get()
+            writer.writerows(rows)
+            groups.merge(chunk_groups)
+            apks += len(rows)
+            methods += sum(row[1] for row in rows)
+            logger.log(
+                STATUS, f'Analyzed {methods} methods of {apks} apks'
+                f' ({apks / (time.time() - start):.0f} apks/s).')
+
+    with open(os.path.join(output, 'groups.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['breakdown', 'group', 'apks', 'methods', 'size', 'analyzed',
+                         'anomalies'] + BINS)
+        for key, idx in sorted(groups.keys.items()):
+            writer.writerow(list(key) + groups.counts[idx].tolist() +
+                            groups.histograms[idx].tolist())
+    logger.info(f'Wrote the statistics of {apks} apks to {output}.')
@@ -1,9 +1,12 @@
 import argparse
 import os
 
-from analysis import androzoo_analysis, gplay_analysis, fdroid_analysis, vt_queries
+from analysis import androzoo_analysis, gplay_analysis, fdroid_analysis, rescore, rethreshold, convert_sizes, \
+    size_analytics, export_tables, vt_queries
 from database import create_db
 from main import VERSION
+from utility.convenience import CUTOFF_SCORE
+from utility.export import DATASETS
 
 
 def parse_args():
@@ -17,13 +20,89 @@ def parse_args():
         '--logfile',
         type=str,
         help='Specifies the logfile to use. Will append, not overwrite')
-    parent.add_argument('--db',
-                        type=str,
-                        help='Changes the default database string')
+    parent.add_argument(
+        '--db',
+        type=str,
+        help='Changes the default database string. "sqlite:<file>" or'
+        ' "parquet:<directory>" store the results of local analyses (gplay,'
+        ' fdroid) there instead of in PostgreSQL.')
+    parent.add_argument(
+        '--db-batch',
+        dest='db_batch',
+        type=int,
+        help='Only used with local --db backends. Number of apks whose results'
+        ' each worker writes at once.',
+        default=100)
     parent.add_argument('--worker',
                         type=int,
                         help='Changes the number of workers used.',
                         default=len(os.sched_getaffinity(0)))
+    analysis = argparse.ArgumentParser(add_help=False)
+    analysis.add_argument(
+        '--score-cache',
+        dest='score_cache',
+        type=int,
+        help='Maximum number of method anomaly scores kept in the database for'
+        ' reuse across apks sharing the same bytecode. 0 disables the cache.',
+        default=1000000)
+    analysis.add_argument(
+        '--scoring-server',
+        dest='scoring_server',
+        action='store_true',
+        help='If set, a single process holds the anomaly detection model and'
+        ' scores the methods of all workers in batches.',
+        default=False)
+    analysis.add_argument(
+        '--batch-rows',
+        dest='batch_rows',
+        type=int,
+        help='Only used with --scoring-server. Maximum number of methods'
+        ' scored in one batch.',
+        default=4096)
+    analysis.add_argument(
+        '--batch-latency',
+        dest='batch_latency',
+        type=float,
+        help='Only used with --scoring-server. Maximum time in milliseconds'
+        ' a request waits for others to join its batch.',
+        default=20)
+    analysis.add_argument(
+        '--cascade',
+        type=int,
+        help='If set, methods are first scored on this many trees of the'
+        ' anomaly detection model, and only on the remaining ones if they'
+        ' might still be anomalous. 0 scores every method on all trees.',
+        default=0)
+    analysis.add_argument(
+        '--cascade-confidence',
+        dest='cascade_confidence',
+        type=float,
+        help='Only used with --cascade. Confidence that methods stopping early'
+        ' are not anomalous. 1.0 only stops methods that provably are not.',
+        default=1.0)
+    analysis.add_argument(
+        '--sample-above',
+        dest='sample_above',
+        type=int,
+        help='If set, apks with more methods than this only get a stratified'
+        ' sample of their methods scored, and their anomaly count is estimated.'
+        ' 0 scores all methods of every apk.',
+        default=0)
+    analysis.add_argument(
+        '--method-sample-size',
+        dest='method_sample_size',
+        type=int,
+        help='Only used with --sample-above. Number of methods scored per apk,'
+        ' spread over strata of similar code size.',
+        default=2000)
+    analysis.add_argument(
+        '--feature-sink',
+        dest='feature_sink',
+        type=str,
+        help='If set, the feature vectors of all scored methods are written to'
+        ' this directory, for the "rescore" command and for training with'
+        ' train_cfganomaly.py --corpus.',
+        default=None)
     parser = argparse.ArgumentParser()
     parser.add_argument('--version',
                         action='store_true',
@@ -46,22 +125,54 @@ def parse_args():
                         help='If set, creates a random sample and saves'
                         ' it to "file". Otherwise the contents of'
                         ' "file" will be read and saved to db.')
+    create.add_argument('--sample-size',
+                        dest='sample_size',
+                        type=int,
+                        default=250,
+                        help='Maximum number of apks sampled per stratum.')
+    create.add_argument(
+        '--min-detection',
+        dest='min_detection',
+        type=int,
+        default=10,
+        help='Lowest VirusTotal detection count to sample. Every count up to'
+        ' "--max-detection" forms its own stratum.')
+    create.add_argument(
+        '--max-detection',
+        dest='max_detection',
+        type=int,
+        default=30,
+        help='Apks with more VirusTotal detections than this are sampled as'
+        ' one combined stratum.')
     create.add_argument(
         'file',
         help='The file to take the samples from / store the samples in.')
     androzoo = subparsers.add_parser(
         'androzoo',
         help='Runs the analysis on apps from the androzoo dataset.',
-        parents=[parent])
+        parents=[parent, analysis])
     androzoo.add_argument(
         '--repeat',
         action='store_true',
         help='If set, the queries read from file will be retried if'
-        ' they have all been processed.\n'
-        'WARNING: Make sure your queries filter out already'
-        'processed applications when using this options,'
-        'otherwise the analysis will run indefinitely',
+        ' they have all been processed. Already processed applications'
+        ' are skipped, the analysis stops once a full iteration yields no'
+        ' new applications. Reruns only consider applications added or'
+        ' changed since a query was last exhausted.',
+        default=False)
+    androzoo.add_argument(
+        '--listen',
+        action='store_true',
+        help='Only used with --repeat. Instead of stopping once an iteration'
+        ' yields no new applications, waits until "createdb" adds new ones.',
         default=False)
+    androzoo.add_argument(
+        '--fetch-size',
+        dest='fetch_size',
+        type=int,
+        help='Specifies how many apks are fetched from the database at once'
+        ' while streaming the results of a query.',
+        default=10000)
     androzoo.add_argument('--vt',
                           type=str,
                           help='Specifies location of VirusTotal API Key',
@@ -89,7 +200,7 @@ def parse_args():
     gplay = subparsers.add_parser(
         'gplay',
         help='Runs the analysis on local apps from the GooglePlay dataset.',
-        parents=[parent])
+        parents=[parent, analysis])
     gplay.add_argument(
         'out',
         type=str,
@@ -101,7 +212,7 @@ def parse_args():
     fdroid = subparsers.add_parser(
         'fdroid',
         help='Runs the analysis on local apps from the GooglePlay dataset.',
-        parents=[parent])
+        parents=[parent, analysis])
     fdroid.add_argument(
         'out',
         type=str,
@@ -110,6 +221,129 @@ def parse_args():
                         type=str,
                         help='Specifies the directory root of all .apk files.')
     fdroid.set_defaults(func=fdroid_analysis)
+    rescore_parser = subparsers.add_parser(
+        'rescore',
+        help='Scores the feature vectors written with --feature-sink with a'
+        ' new model or cutoff, and replaces the stored anomalies.',
+        parents=[parent])
+    rescore_parser.add_argument(
+        'store',
+        type=str,
+        help='The directory the feature vectors were written to.')
+    rescore_parser.add_argument(
+        '--model',
+        type=str,
+        help='The trained model (.pickle.gz) or exported forest to score with.'
+        ' Defaults to the packaged model.',
+        default=None)
+    rescore_parser.add_argument('--cutoff',
+                                type=float,
+                                help='Methods scoring below this are anomalous.',
+                                default=CUTOFF_SCORE)
+    rescore_parser.add_argument(
+        '--batch-rows',
+        dest='batch_rows',
+        type=int,
+        help='Maximum number of methods scored in one batch.',
+        default=4096)
+    rescore_parser.set_defaults(func=rescore)
+    rethreshold_parser = subparsers.add_parser(
+        'rethreshold',
+        help='Recounts the anomalies of all analyzed apks for other cutoffs,'
+        ' from the method scores stored in the output directory.',
+        parents=[parent])
+    rethreshold_parser.add_argument(
+        'records',
+        type=str,
+        help='The records directory within the output directory of an analysis.')
+    rethreshold_parser.add_argument(
+        'cutoffs',
+        type=float,
+        nargs='+',
+        help='Methods scoring below a cutoff are anomalous.')
+    rethreshold_parser.add_argument(
+        '--output',
+        type=str,
+        help='CSV file to write the counts to. Defaults to stdout.',
+        default=None)
+    rethreshold_parser.add_argument(
+        '--store',
+        action='store_true',
+        help='If set, the anomalies below the first cutoff replace the stored'
+        ' anomalies. Their scores are stored rounded to the half precision of the'
+        ' method records.',
+        default=False)
+    rethreshold_parser.set_defaults(func=rethreshold)
+    convert = subparsers.add_parser(
+        'convert-sizes',
+        help='Moves the method sizes of an output directory from one .npy.gz'
+        ' file per apk into the size store used since.',
+        parents=[parent])
+    convert.add_argument(
+        'out',
+        type=str,
+        help='The directory method size information was saved to.')
+    convert.add_argument('--remove',
+                         action='store_true',
+                         help='If set, converted files are deleted.',
+                         default=False)
+    convert.set_defaults(func=convert_sizes)
+    analytics = subparsers.add_parser(
+        'analytics',
+        help='Computes method size histograms and per-apk quantiles of an'
+        ' output directory, broken down by market and VirusTotal detections.',
+        parents=[parent])
+    analytics.add_argument(
+        'out',
+        type=str,
+        help='The directory method size information was saved to.')
+    analytics.add_argument('output',
+                           type=str,
+                           help='The directory to write the statistics to.')
+    analytics.add_argument('--chunk-apks',
+                           dest='chunk_apks',
+                           type=int,
+                           help='Number of apks each process analyzes at once.',
+                           default=2000)
+    analytics.add_argument(
+        '--no-join',
+        dest='no_join',
+        action='store_true',
+        help='If set, the statistics are not joined with the database, e.g.,'
+        ' when analyzing a copy of the output directory elsewhere.',
+        default=False)
+    analytics.set_defaults(func=size_analytics)
+    export = subparsers.add_parser(
+        'export',
+        help='Exports result tables to Parquet or CSV files, with their JSON'
+        ' columns flattened into typed columns.',
+        parents=[parent])
+    export.add_argument('output',
+                        type=str,
+                        help='The directory to export to.')
+    export.add_argument('--tables',
+                        nargs='+',
+                        choices=list(DATASETS),
+                        help='The tables to export.',
+                        default=list(DATASETS))
+    export.add_argument('--format',
+                        choices=['parquet', 'csv'],
+                        help='Parquet requires pyarrow.',
+                        default='parquet')
+    export.add_argument(
+        '--ranges',
+        type=int,
+        help='Number of sha256 ranges each table is split into and exported in'
+        ' parallel, at most 16.',
+        default=4)
+    export.add_argument(
+        '--row-group',
+        dest='row_group',
+        type=int,
+        help='Maximum number of rows per Parquet row group, and per round trip'
+        ' to the database.',
+        default=100000)
+    export.set_defaults(func=export_tables)
     vt = subparsers.add_parser(
         'vt',
         help='Only sends queries to virustotal without additional analysis',
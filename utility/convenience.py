@@ -9,6 +9,7 @@ from subprocess import check_output
 VERBOSE = 15
 STATUS = 30
 TIMEOUT = 900
+CUTOFF_SCORE = -0.30
 MAX_MEM = 5500000000
 MAX_RETRIES = 5
 
@@ -0,0 +1,183 @@
+import csv
+import logging
+import os
+import time
+from multiprocessing import Pool
+
+import psycopg2 as db
+
+import database
+from local_backends import parquet_type
+from utility.convenience import STATUS
+
+logger = logging.getLogger('Export')
+logger.setLevel(logging.NOTSET)
+
+VT_ATTRIBUTES = "t.vt->'data'->'attributes'"
+VT_STATS = f"{VT_ATTRIBUTES}->'last_analysis_stats'"
+
+# Flat datasets exported for each table: the query yielding their rows, the column the
+# sha256 ranges apply to, and the names and types of their columns. JSON columns are
+# flattened by PostgreSQL, which hands out typed values instead of documents to parse
+DATASETS = {
+    'results': {
+        'results': ("SELECT sha256, permissions, libs, dex_loader, class_loader, reflection,"
+                    " reflection_invocation, methods_total, methods_success,"
+                    " methods_decompiler_fail, methods_parser_fail, analyzed, anomalies,"
+                    " skipped, cached, sampled, anomalies_estimate, anomalies_low,"
+                    " anomalies_high FROM results AS t", 't.sha256',
+                    [('sha256', 'text'), ('permissions', 'text[]'), ('libs', 'int'),
+                     ('dex_loader', 'int'), ('class_loader', 'int'),
+                     ('reflection', 'int'), ('reflection_invocation', 'int'),
+                     ('methods_total', 'int'), ('methods_success', 'int'),
+                     ('methods_decompiler_fail', 'int'),
+                     ('methods_parser_fail', 'int'), ('analyzed', 'int'),
+                     ('anomalies', 'int'), ('skipped', 'int'), ('cached', 'int'),
+                     ('sampled', 'bool'), ('anomalies_estimate', 'float'),
+                     ('anomalies_low', 'float'), ('anomalies_high', 'float')]),
+    },
+    'reflection': {
+        'reflected_classes': ("SELECT t.sha256, c.key, c.value::int FROM reflection AS t,"
+                              " json_each_text(t.reflected_classes) AS c", 't.sha256',
+                              [('sha256', 'text'), ('class', 'text'), ('count', 'int')]),
+        'reflected_methods': ("SELECT t.sha256, c.key, m.key, m.value::int FROM reflection AS t,"
+                              " json_each(t.reflected_methods) AS c,"
+                              " json_each_text(c.value) AS m", 't.sha256',
+                              [('sha256', 'text'), ('class', 'text'), ('method', 'text'),
+                               ('count', 'int')]),
+    },
+    'anomalies': {
+        'anomalies': ("SELECT t.sha256, a.key, a.value::double precision FROM anomalies AS t,"
+                      " json_each_text(t.anomalies) AS a", 't.sha256',
+                      [('sha256', 'text'), ('method', 'text'), ('score', 'float')]),
+    },
+    'files': {
+        # Files are identified by their own sha256, ranges apply to the apk they are from
+        'files': ("SELECT sha256, origin, name, entropy, magic, size FROM files AS t",
+                  't.origin',
+                  [('sha256', 'text'), ('origin', 'text'), ('name', 'text'),
+                   ('entropy', 'float'), ('magic', 'text'), ('size', 'int')]),
+    },
+    'vt': {
+        'vt': (f"SELECT t.sha256, ({VT_STATS}->>'malicious')::int,"
+               f" ({VT_STATS}->>'suspicious')::int, ({VT_STATS}->>'undetected')::int,"
+               f" ({VT_STATS}->>'harmless')::int, ({VT_STATS}->>'timeout')::int,"
+               f" ({VT_ATTRIBUTES}->>'last_analysis_date')::bigint,"
+               f" ({VT_ATTRIBUTES}->>'first_submission_date')::bigint,"
+               f" ({VT_ATTRIBUTES}->>'times_submitted')::int, {VT_ATTRIBUTES}->>'type_tag',"
+               f" {VT_ATTRIBUTES}->'popular_threat_classification'->>'suggested_threat_label',"
+               " t.vt->'error'->>'code', t.error FROM vt AS t", 't.sha256',
+               [('sha256', 'text'), ('malicious', 'int'), ('suspicious', 'int'),
+                ('undetected', 'int'), ('harmless', 'int'), ('timeout', 'int'),
+                ('last_analysis_date', 'int'), ('first_submission_date', 'int'),
+                ('times_submitted', 'int'), ('type_tag', 'text'),
+                ('threat_label', 'text'), ('vt_error', 'text'), ('error', 'text')]),
+    },
+}
+
+HEX = '0123456789abcdef'
+
+
+def ranges(count):
+    """Splits the sha256 space into count ranges of leading hex digits, in both cases."""
+    count = max(1, min(count, len(HEX)))
+    groups = [HEX[idx * len(HEX) // count:(idx + 1) * len(HEX) // count]
+              for idx in range(count)]
+    return [sorted(set(group + group.upper())) for group in groups]
+
+
+def export_range(task):
+    """Streams the rows of one dataset within one range of sha256 into a file.
+
+    Returns
+    -------
+    tuple
+        Name of the dataset, index of the range, number of rows and seconds taken.
+    """
+    table, dataset, part, digits, directory, file_format, row_group = task
+    query, column, columns = DATASETS[table][dataset]
+    start = time.time()
+    path = os.path.join(directory, dataset, f'part-{part:02d}.{file_format}')
+    temporary = f'{path}.tmp'
+    db_connection = db.connect(database.db_string)
+    # Leading digits instead of comparisons, which depend on the collation of the database
+    rows = database.access(f'{query} WHERE left({column}, 1) = ANY(%s);', (digits, ),
+                           db_connection,
+                           name=f'export_{dataset}_{part}',
+                           fetch_size=row_group)
+    if file_format == 'parquet':
+        written = write_parquet(rows, columns, temporary, row_group)
+    else:
+        written = write_csv(rows, columns, temporary)
+    db_connection.close()
+    os.replace(temporary, path)
+    return dataset, part, written, time.time() - start
+
+
+def write_parquet(rows, columns, path, row_group):
+    """Writes rows in row groups of up to row_group rows, holding only one of them in memory."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(name, parquet_type(column_type))
+                        for name, column_type in columns])
+    written = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == row_group:
+                writer.write_table(to_table(batch, schema))
+                written += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(to_table(batch, schema))
+            written += len(batch)
+    return written
+
+
+def to_table(rows, schema):
+    import pyarrow as pa
+    return pa.Table.from_arrays([
+        pa.array(values, type=field.type)
+        for values, field in zip(zip(*rows), schema)
+    ], schema=schema)
+
+
+def write_csv(rows, columns, path):
+    written = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    return written
+
+
+def run(directory, tables, file_format, processes, range_count, row_group):
+    """Exports tables in parallel, one task per flattened dataset and range of sha256.
+
+    Every task streams its rows through a server-side cursor into a file of its own,
+    <directory>/<dataset>/part-<range>.<file_format>.
+    """
+    if file_format == 'parquet':
+        # Fails early if pyarrow is missing, rather than in every task
+        import pyarrow
+    tasks = []
+    for table in tables:
+        for dataset in DATASETS[table]:
+            os.makedirs(os.path.join(directory, dataset), exist_ok=True)
+            for part, digits in enumerate(ranges(range_count)):
+                tasks.append((table, dataset, part, digits, directory, file_format,
+                              row_group))
+    start = time.time()
+    total = 0
+    with Pool(processes) as pool:
+        for dataset, part, rows, seconds in pool.imap_unordered(export_range, tasks):
+            total += rows
+            logger.log(
+                STATUS, f'Exported {rows} rows of {dataset} part {part} in'
+                f' {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s).')
+    elapsed = time.time() - start
+    logger.info(f'Exported {total} rows of {len(tasks)} parts in {elapsed:.1f}s'
+                f' ({total / max(elapsed, 1e-9):.0f} rows/s).')
@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+
+class BloomFilter:
+    """Compact probabilistic set of sha256 identifiers.
+
+    As the identifiers are uniformly distributed hashes already, the bit positions are
+    derived from their digits directly instead of hashing them again.
+    Lookups never yield false negatives, but may yield false positives at roughly error_rate
+    as long as no more than capacity identifiers were added.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.size = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2)**2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, sha256):
+        digest = int(sha256, 16)
+        first = digest & 0xFFFFFFFFFFFFFFFF
+        second = (digest >> 64) & 0xFFFFFFFFFFFFFFFF | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, sha256):
+        for position in self.positions(sha256):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, sha256):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(sha256))
+
+    def __len__(self):
+        return self.count
+
+
+class DigestSet:
+    """Exact set of sha256 identifiers, stored as a sorted array of raw 32 byte digests.
+
+    Needs 32 bytes per entry instead of well over 100 for a set of hex strings, and lookups
+    are binary searches.
+    """
+
+    def __init__(self, digests):
+        self.digests = digests
+
+    @classmethod
+    def from_rows(cls, rows, chunk_size=100000):
+        """Builds the set from rows holding hex encoded sha256 identifiers in their first column.
+
+        Rows are converted in chunks of chunk_size, so the identifiers never exist as
+        Python strings all at once when rows is a stream, e.g. from database.access.
+        """
+        chunks = []
+        chunk = []
+        for row in rows:
+            try:
+                chunk.append(bytes.fromhex(row[0]))
+            except (TypeError, ValueError):
+                continue
+            if len(chunk) == chunk_size:
+                chunks.append(np.array(chunk, dtype='S32'))
+                chunk = []
+        chunks.append(np.array(chunk, dtype='S32'))
+        return cls(np.unique(np.concatenate(chunks)))
+
+    def contains(self, hashes):
+        """Vectorized membership test for a sequence of hex encoded sha256 identifiers.
+
+        Returns
+        -------
+        np.ndarray
+            Boolean mask, True for every identifier contained in the set.
+        """
+        keys = np.array([bytes.fromhex(h) for h in hashes], dtype='S32')
+        if len(self.digests) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.digests, keys),
+                               len(self.digests) - 1)
+        return self.digests[positions] == keys
+
+    def __contains__(self, sha256):
+        return bool(self.contains([sha256])[0])
+
+    def __len__(self):
+        return len(self.digests)
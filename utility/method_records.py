@@ -0,0 +1,177 @@
+import json
+import os
+
+import numpy as np
+
+INDEX = 'index.tsv'
+METHODS = 'methods.txt'
+META_FILE = 'segment.json'
+# Files of the per-method arrays and their types
+ARRAYS = {'scores': np.float16, 'sizes': np.int32, 'names': np.int32}
+
+
+class MethodRecords:
+    """Anomaly scores, code sizes and names of all methods of each analyzed apk.
+
+    The records of an apk are aligned, the i-th score, size and name belong to the same
+    method. Every worker appends to a segment of its own: one raw file per array, a
+    table of the method names it has seen, which the name arrays index into, and an index
+    of where the records of each apk start. Apks are only added to the index once their
+    records are complete, so readers never see partial records, and records or names behind
+    the last index entry are dropped when the segment is opened again.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of all segments.
+    segment : str
+        Name of the segment to append to.
+    params : dict
+        Identifier of the model and cutoff the scores were computed with, and the cutoff
+        of the cascade, if any. Must match those of the existing records when resuming.
+    """
+
+    def __init__(self, directory, segment, params):
+        self.path = os.path.join(directory, segment)
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, META_FILE)
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                existing = json.load(f)
+            if existing != params:
+                raise ValueError(f'Method records at {self.path} were scored with'
+                                 f' {existing}, not {params}.')
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(params, f)
+        # Drop the records and new names of an apk whose index entry was never written
+        _, length, name_count = read_index(self.path)
+        with open(os.path.join(self.path, INDEX), 'a+b') as f:
+            f.seek(0)
+            data = f.read()
+            f.truncate(data.rfind(b'\n') + 1)
+        self.names = {}
+        methods_path = os.path.join(self.path, METHODS)
+        with open(methods_path, 'a+b') as f:
+            f.seek(0)
+            end = 0
+            for line in f:
+                if len(self.names) == name_count or not line.endswith(b'\n'):
+                    break
+                self.names[line[:-1].decode()] = len(self.names)
+                end += len(line)
+            f.truncate(end)
+        for array, dtype in ARRAYS.items():
+            path = os.path.join(self.path, array)
+            with open(path, 'ab') as f:
+                f.truncate(length * np.dtype(dtype).itemsize)
+        self.length = length
+
+    def append(self, sha256, scores, sizes, methods):
+        """Appends the records of an apk.
+
+        Parameters
+        ----------
+        sha256 : str
+        scores : numpy.ndarray
+            Anomaly score of each method, 1.0 for skipped and NaN for unsampled ones.
+        sizes : numpy.ndarray
+            Code size of each method.
+        methods : list
+            Name of each method.
+        """
+        new_names = []
+        for method in methods:
+            if method not in self.names:
+                self.names[method] = len(self.names)
+                new_names.append(method)
+        if new_names:
+            with open(os.path.join(self.path, METHODS), 'a') as f:
+                f.write(''.join(f'{name}\n' for name in new_names))
+        arrays = {
+            'scores': scores,
+            'sizes': sizes,
+            'names': [self.names[method] for method in methods]
+        }
+        for array, dtype in ARRAYS.items():
+            with open(os.path.join(self.path, array), 'ab') as f:
+                f.write(np.asarray(arrays[array], dtype=dtype).tobytes())
+        with open(os.path.join(self.path, INDEX), 'a') as f:
+            f.write(f'{sha256}\t{self.length}\t{len(methods)}\t{len(self.names)}\n')
+        self.length += len(methods)
+
+
+def read_index(path):
+    """Returns the apks of a segment with the start and count of their records, the total
+    count of records and the number of method names they refer to."""
+    index = {}
+    length = 0
+    names = 0
+    index_path = os.path.join(path, INDEX)
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # A line cut off by an interrupted worker
+                if len(fields) != 4:
+                    continue
+                start, count = int(fields[1]), int(fields[2])
+                index[fields[0]] = (start, count)
+                length = max(length, start + count)
+                names = max(names, int(fields[3]))
+    return index, length, names
+
+
+class Segment:
+    """Read-only, memory-mapped view of the records of one segment."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.params = json.load(f)
+        self.index, self.length, _ = read_index(path)
+        self.arrays = {}
+        for array, dtype in ARRAYS.items():
+            self.arrays[array] = (np.memmap(os.path.join(path, array),
+                                            dtype=dtype,
+                                            mode='r',
+                                            shape=(self.length, ))
+                                  if self.length else np.empty(0, dtype=dtype))
+        self.methods = None
+
+    def method_names(self):
+        if self.methods is None:
+            with open(os.path.join(self.path, METHODS)) as f:
+                self.methods = [line.rstrip('\n') for line in f]
+        return self.methods
+
+    def records(self, sha256):
+        """Returns the scores, sizes and method names of an apk."""
+        start, count = self.index[sha256]
+        names = self.method_names()
+        return (self.arrays['scores'][start:start + count],
+                self.arrays['sizes'][start:start + count],
+                [names[idx] for idx in self.arrays['names'][start:start + count]])
+
+    def anomaly_counts(self, cutoff, chunk_size=1 << 24):
+        """Returns the apks of the segment and how many of their methods score below cutoff."""
+        apks = sorted(self.index.items(), key=lambda entry: entry[1][0])
+        starts = np.array([start for _, (start, _) in apks], dtype=np.int64)
+        ends = np.array([start + count for _, (start, count) in apks],
+                        dtype=np.int64)
+        # Counts of anomalies before each record, so the counts of apks are differences
+        cumulative = np.zeros(self.length + 1, dtype=np.int64)
+        scores = self.arrays['scores']
+        for chunk in range(0, self.length, chunk_size):
+            below = scores[chunk:chunk + chunk_size].astype(np.float64) < cutoff
+            cumulative[chunk + 1:chunk + 1 + len(below)] = (
+                cumulative[chunk] + np.cumsum(below))
+        return [sha256 for sha256, _ in apks], cumulative[ends] - cumulative[starts]
+
+
+def segments(directory):
+    """Yields all segments of the records in directory."""
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(os.path.join(path, INDEX)):
+            yield Segment(path)
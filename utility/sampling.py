@@ -0,0 +1,81 @@
+import math
+from collections import defaultdict
+
+import numpy as np
+from scipy.stats import norm
+
+
+class StratifiedSample:
+    """Stratified random sample of the methods of an apk, for estimating their anomaly count.
+
+    Every stratum gets a share of sample_size proportional to its population, but at least
+    one method, so the sample may exceed sample_size by up to one method per stratum.
+
+    Parameters
+    ----------
+    strata : list
+        Stratum of each member of the population, e.g., the bin_name of its code size.
+    sample_size : int
+    seed : int
+        Seed of the random choice, so reruns on the same apk pick the same methods.
+    """
+
+    def __init__(self, strata, sample_size, seed=None):
+        rng = np.random.default_rng(seed)
+        members = defaultdict(list)
+        for idx, stratum in enumerate(strata):
+            members[stratum].append(idx)
+        self.population = {
+            stratum: len(indices)
+            for stratum, indices in members.items()
+        }
+        self.size = {}
+        indices = []
+        total = max(1, len(strata))
+        for stratum, stratum_members in members.items():
+            n = min(len(stratum_members),
+                    max(1, math.ceil(sample_size * len(stratum_members) / total)))
+            self.size[stratum] = n
+            indices.extend(rng.choice(stratum_members, n, replace=False).tolist())
+        self.indices = sorted(indices)
+        self.strata = [strata[idx] for idx in self.indices]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def estimate(self, hits, confidence=0.95):
+        """Estimates how many members of the population are hits.
+
+        Parameters
+        ----------
+        hits : Iterable of bool
+            Whether each sampled member, in the order of indices, is a hit.
+        confidence : float
+            Confidence of the two-sided interval around the estimate.
+
+        Returns
+        -------
+        tuple
+            The estimate and the lower and upper bound of its confidence interval.
+        """
+        found = defaultdict(int)
+        for stratum, hit in zip(self.strata, hits):
+            found[stratum] += bool(hit)
+        estimate = 0.0
+        variance = 0.0
+        for stratum, population in self.population.items():
+            n = self.size[stratum]
+            estimate += population * found[stratum] / n
+            if n < population:
+                # Hits are rare, so strata without any would claim to be known exactly.
+                # Their variance is based on the add-one estimate of the hit rate instead
+                rate = (found[stratum] + 1) / (n + 2)
+                variance += (population**2 * (1 - n / population) * rate *
+                             (1 - rate) / n)
+        deviation = norm.ppf(1 - (1 - confidence) / 2) * math.sqrt(variance)
+        # Hits in the sample are certain, members outside of it might all be hits
+        observed = sum(found.values())
+        unsampled = sum(self.population.values()) - len(self)
+        low = max(observed, estimate - deviation)
+        high = min(observed + unsampled, estimate + deviation)
+        return estimate, low, high
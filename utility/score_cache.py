@@ -0,0 +1,73 @@
+import logging
+from collections import OrderedDict
+
+import database
+from utility.convenience import log_psycopg2_exception
+from utility.exceptions import DatabaseRetry
+
+
+class ScoreCache:
+    """Anomaly scores of methods, keyed by model and the digest of the method's bytecode.
+
+    Libraries like Play Services or the Kotlin standard library ship identical bytecode in
+    a large share of all apks, so their scores are looked up instead of recomputed.
+    Scores are kept in the "cfg_scores" table shared by all workers, which is trimmed to
+    roughly capacity entries by evicting the least recently used ones.
+    In front of it, each process keeps up to local_capacity scores in memory.
+    """
+
+    def __init__(self,
+                 db_connection,
+                 capacity=1000000,
+                 local_capacity=100000,
+                 eviction_interval=100):
+        self.logger = logging.getLogger('ScoreCache')
+        self.db_connection = db_connection
+        self.capacity = capacity
+        self.local_capacity = local_capacity
+        self.eviction_interval = eviction_interval
+        self.local = OrderedDict()
+        self.stores = 0
+
+    def lookup(self, model, digests):
+        """Returns a dict mapping the digests found in the cache to their score."""
+        scores = {}
+        missing = []
+        for digest in set(digests):
+            key = (model, digest)
+            if key in self.local:
+                self.local.move_to_end(key)
+                scores[digest] = self.local[key]
+            else:
+                missing.append(digest)
+        if missing:
+            try:
+                shared = database.lookup_cfg_scores(model, missing,
+                                                    self.db_connection)
+            except DatabaseRetry as error:
+                log_psycopg2_exception(error.error, self.logger)
+                shared = {}
+            self.remember(model, shared)
+            scores.update(shared)
+        return scores
+
+    def store(self, model, scores):
+        if not scores:
+            return
+        self.remember(model, scores)
+        try:
+            database.store_cfg_scores(model, scores, self.db_connection)
+            self.stores += 1
+            if self.stores % self.eviction_interval == 0:
+                removed = database.evict_cfg_scores(self.capacity,
+                                                    self.db_connection)
+                self.logger.debug(f'Evicted {removed} cached scores.')
+        except DatabaseRetry as error:
+            log_psycopg2_exception(error.error, self.logger)
+
+    def remember(self, model, scores):
+        for digest, score in scores.items():
+            self.local[(model, digest)] = score
+            self.local.move_to_end((model, digest))
+        while len(self.local) > self.local_capacity:
+            self.local.popitem(last=False)
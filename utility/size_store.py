@@ -0,0 +1,181 @@
+import gzip
+import mmap
+import os
+import zlib
+
+import numpy as np
+from numpy.lib.format import read_array
+
+DATA = '.seg'
+INDEX = '.idx'
+DTYPE = np.dtype(np.int32)
+RAW = 'raw'
+ZLIB = 'zlib'
+# Fast rather than small, as arrays are compressed on the hot path of the workers
+COMPRESSION_LEVEL = 1
+
+
+class SizeStore:
+    """Method size arrays of all analyzed apks, appended to one segment per worker.
+
+    A segment is a data file of the arrays back to back and an index of the sha256,
+    offset, stored length, number of sizes and codec of each array. Arrays are compressed
+    with zlib at its fastest level, or stored raw if that does not make them smaller, and
+    raw arrays are aligned so that reading them is a view of the memory-mapped data file.
+    Arrays are only added to the index once they are written, and bytes behind the last
+    indexed array are dropped when the segment is opened again.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of all segments.
+    segment : str
+        Name of the segment to append to.
+    """
+
+    def __init__(self, directory, segment):
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, segment + DATA)
+        self.index_path = os.path.join(directory, segment + INDEX)
+        index = read_index(self.index_path)
+        self.offset = max((offset + length
+                           for offset, length, _, _ in index.values()),
+                          default=0)
+        with open(self.data_path, 'ab') as f:
+            f.truncate(self.offset)
+        self.stored = set(index)
+
+    def append(self, sha256, sizes):
+        """Appends the method sizes of an apk."""
+        raw = np.asarray(sizes, dtype=DTYPE).tobytes()
+        data = zlib.compress(raw, COMPRESSION_LEVEL)
+        codec = ZLIB
+        if len(data) >= len(raw):
+            # Raw arrays start at aligned offsets
+            self.offset += -self.offset % DTYPE.itemsize
+            data = raw
+            codec = RAW
+        with open(self.data_path, 'r+b') as f:
+            f.seek(self.offset)
+            f.write(data)
+        with open(self.index_path, 'a') as f:
+            f.write(f'{sha256}\t{self.offset}\t{len(data)}\t{len(raw) // DTYPE.itemsize}'
+                    f'\t{codec}\n')
+        self.offset += len(data)
+        self.stored.add(sha256)
+
+    def __contains__(self, sha256):
+        return sha256 in self.stored
+
+
+def read_index(path):
+    """Maps the sha256 of each array in a segment index to its offset, stored length, size count and codec."""
+    index = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # A line cut off by an interrupted worker
+                if len(fields) != 5:
+                    continue
+                offset, length, count = map(int, fields[1:4])
+                index[fields[0]] = (offset, length, count, fields[4])
+    return index
+
+
+def decode(data, offset, length, count, codec):
+    """Returns the method sizes of an index entry from the (memory-mapped) data of its segment."""
+    if not count:
+        return np.empty(0, dtype=DTYPE)
+    if codec == RAW:
+        return np.frombuffer(data, dtype=DTYPE, count=count, offset=offset)
+    return np.frombuffer(zlib.decompress(data[offset:offset + length]),
+                         dtype=DTYPE)
+
+
+def open_segment(path):
+    """Memory-maps the data file of a segment, returns None if it is empty."""
+    if not os.path.getsize(path):
+        return None
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def segment_names(directory):
+    return sorted(name[:-len(INDEX)] for name in os.listdir(directory)
+                  if name.endswith(INDEX))
+
+
+class SizeReader:
+    """Read access to all segments of a size store, through memory maps of their data files."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = {}
+        self.index = {}
+        for segment in segment_names(directory):
+            # Indexed arrays are complete, even if workers are still appending
+            index = read_index(os.path.join(directory, segment + INDEX))
+            data = open_segment(os.path.join(directory, segment + DATA))
+            if data is not None:
+                self.segments[segment] = data
+            for sha256, entry in index.items():
+                self.index[sha256] = (segment, *entry)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, sha256):
+        return sha256 in self.index
+
+    def get(self, sha256):
+        """Returns the method sizes of an apk, a read-only view into the data file if stored raw."""
+        segment, *entry = self.index[sha256]
+        return decode(self.segments.get(segment), *entry)
+
+    def items(self):
+        """Yields the sha256 and method sizes of every apk, reading each segment front to back."""
+        entries = sorted(self.index.items(),
+                         key=lambda entry: (entry[1][0], entry[1][1]))
+        for sha256, _ in entries:
+            yield sha256, self.get(sha256)
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+
+def convert(directory, segment='converted', remove=False):
+    """Moves the method sizes of the .npy.gz files in directory into a size store within it.
+
+    Files already in the store are skipped, so an interrupted conversion can be resumed.
+
+    Parameters
+    ----------
+    directory : str
+        Output directory of an analysis.
+    segment : str
+        Name of the segment the sizes are appended to.
+    remove : bool
+        If set, files are deleted once their sizes are stored.
+
+    Returns
+    -------
+    int
+        Number of files converted.
+    """
+    store = SizeStore(os.path.join(directory, 'sizes'), segment)
+    converted = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.npy.gz') or not entry.is_file():
+                continue
+            sha256 = entry.name[:-len('.npy.gz')]
+            if sha256 not in store:
+                with gzip.open(entry.path, 'rb') as f:
+                    store.append(sha256, read_array(f))
+                converted += 1
+            if remove:
+                os.remove(entry.path)
+    return converted
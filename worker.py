@@ -1,12 +1,10 @@
 import fnmatch
-import gzip
 import logging
 import os
-import pickle
 import psycopg2 as db
 import signal
+import sys
 import time
-from importlib.resources import files, as_file
 from multiprocessing import Process
 from resource import getrlimit, RLIMIT_AS, setrlimit
 from subprocess import SubprocessError, check_output, CalledProcessError, DEVNULL
@@ -14,15 +12,20 @@ from subprocess import SubprocessError, check_output, CalledProcessError, DEVNUL
 import numpy as np
 from androguard.decompiler.dad.decompile import DvMethod
 from androguard.misc import AnalyzeAPK
-from numpy.lib.format import write_array
 
-import cfganomaly
 import database
-from cfganomaly.cfganomaly import CfgAnomaly
+from cfganomaly.cfganomaly import CfgAnomaly, code_size, size_bin
+from cfganomaly.corpus import Corpus
+from cfganomaly.forest import CascadedForest
 from method_parser import MethodParser, ParserError
+from scoring import RemoteModel, load_model
 from utility.convenience import timeout_handler, extract, file_info, VERBOSE, TIMEOUT, filter_type, MAX_MEM, \
-    convert_small_time, MAX_RETRIES, log_psycopg2_exception
+    convert_small_time, MAX_RETRIES, log_psycopg2_exception, CUTOFF_SCORE, bin_name
 from utility.exceptions import DatabaseRetry, CfgAnomalyError
+from utility.method_records import MethodRecords
+from utility.sampling import StratifiedSample
+from utility.size_store import SizeStore
+from utility.score_cache import ScoreCache
 
 
 class Worker(Process):
@@ -40,13 +43,18 @@ class Worker(Process):
         self.current_sha256 = None
         self.manager = manager
         self.anomaly_detector = None
-        self.model = files(cfganomaly).joinpath('cfganomaly-model.pickle.gz')
-        self.db_connection = db.connect(database.db_string)
+        self.feature_sink = None
+        self.method_records = None
+        self.size_store = None
+        self.db_connection = (db.connect(database.db_string)
+                              if database.backend is None else None)
         self.out_dir = out_dir
 
     def run(self):
         signal.signal(signal.SIGALRM, timeout_handler)
         signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if database.backend is not None:
+            signal.signal(signal.SIGTERM, self.handle_termination)
         soft, hard = getrlimit(RLIMIT_AS)
         self.logger.log(
             VERBOSE,
@@ -95,6 +103,10 @@ class Worker(Process):
                         f'Failed to store memory error for {self.current_sha256}.'
                     )
                     self.retry(error)
+                self.manager.report_finished(sha256)
+                # The manager terminates this worker once it is closed
+                database.apk_finished(sha256)
+                self.close_results()
                 self.manager.close(self.name)
                 break
             except Exception as error:
@@ -112,11 +124,31 @@ class Worker(Process):
                         f'Failed to store unexpected error for {self.current_sha256}.'
                     )
                     self.retry(error)
+            self.manager.report_finished(sha256)
+            # Writing a batch must not be cut short by the termination handler
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+            database.apk_finished(sha256)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
             if post:
                 post(sha256, directory)
-        self.db_connection.close()
+        self.close_results()
+        if self.db_connection is not None:
+            self.db_connection.close()
         self.logger.info('Finished.')
 
+    def close_results(self):
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        database.close_results()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
+    def handle_termination(self, *_):
+        """Writes the results buffered by a local backend before exiting, as the manager
+        terminates workers on shutdown."""
+        self.logger.info('Received termination signal, writing buffered results.')
+        self.close_results()
+        sys.exit(0)
+
     def reset(self, sha256):
         self.current_sha256 = sha256
         self.method_invocations = dict()
@@ -397,24 +429,76 @@ class Worker(Process):
         ]
         sizes = [method.get_method().get_length() for method in methods]
         arr = np.array(sizes, dtype=np.int32)
-        filename = self.current_sha256 + '.npy.gz'
-        with gzip.open(os.path.join(self.out_dir, filename), 'wb') as f:
-            write_array(f, arr)
-        self.detect_anomalies(methods)
+        if self.size_store is None:
+            self.size_store = SizeStore(os.path.join(self.out_dir, 'sizes'),
+                                        self.segment_name())
+        self.size_store.append(self.current_sha256, arr)
+        scores = self.detect_anomalies(methods)
+        if scores is not None:
+            if self.method_records is None:
+                self.method_records = MethodRecords(
+                    os.path.join(self.out_dir, 'records'), self.segment_name(), {
+                        'model_id': self.anomaly_detector.model_id,
+                        'cutoff': CUTOFF_SCORE,
+                        # Methods stopping early are scored approximately, but never
+                        # below the cutoff of the cascade
+                        'cascade_cutoff':
+                        CUTOFF_SCORE if self.manager.cascade else None
+                    })
+            self.method_records.append(
+                self.current_sha256, scores, arr,
+                [str(method.full_name) for method in methods])
+
+    def segment_name(self):
+        """Name of the segments this worker appends to, restarted workers continue them."""
+        return self.name.lower().replace(' ', '-')
 
-    def detect_anomalies(self, method_analyses, cutoff_score=-0.30):
+    def init_anomaly_detector(self):
+        if self.manager.scoring_requests is not None:
+            model = RemoteModel(self.name, self.manager.scoring_requests,
+                                self.manager.scoring_responses[self.name])
+            model_id = model.describe()
+        else:
+            model, model_id = load_model(self.logger, self.manager.cascade)
+        cache = None
+        if self.manager.score_cache:
+            cache = ScoreCache(self.db_connection, self.manager.score_cache)
+        self.anomaly_detector = CfgAnomaly(
+            model,
+            model_id=model_id,
+            cache=cache,
+            keep_features=self.manager.feature_sink is not None)
+        if self.manager.feature_sink is not None:
+            detector = self.anomaly_detector
+            self.feature_sink = Corpus(
+                self.manager.feature_sink, {
+                    'max_n': detector.max_n,
+                    'min_size': detector.min_size,
+                    'min_bbs': detector.min_bb_count
+                })
+
+    def detect_anomalies(self, method_analyses, cutoff_score=CUTOFF_SCORE):
         if self.anomaly_detector is None:
             # Initialize anomaly detector, only needs to be done once in practice
-            with as_file(self.model) as model_path:
-                model_path = os.path.abspath(model_path)
-                if not os.path.isfile(model_path):
-                    self.logger.error(
-                        f'Model was not found at path {model_path}.')
-                with gzip.open(self.model, 'rb') as f:
-                    model = pickle.load(f)
-            self.anomaly_detector = CfgAnomaly(model)
+            self.init_anomaly_detector()
+        sample = None
+        scored = method_analyses
+        positions = None
+        if self.manager.sampling and len(
+                method_analyses) > self.manager.sampling[0]:
+            # Only score a sample of the eligible methods, stratified by code size
+            sizes = [code_size(method) for method in method_analyses]
+            eligible = [
+                idx for idx, size in enumerate(sizes)
+                if self.anomaly_detector.is_eligible(size)
+            ]
+            sample = StratifiedSample([bin_name(sizes[idx]) for idx in eligible],
+                                      self.manager.sampling[1],
+                                      int(self.current_sha256[:16], 16))
+            positions = [eligible[idx] for idx in sample.indices]
+            scored = [method_analyses[idx] for idx in positions]
         try:
-            scores = self.anomaly_detector.get_anomaly_scores(method_analyses)
+            scores = self.anomaly_detector.get_anomaly_scores(scored)
         except CfgAnomalyError as error:
             try:
                 database.partial_error(self.current_sha256, repr(error.error),
@@ -424,13 +508,13 @@ class Worker(Process):
                     f'Failed to store CfgAnomalyError for {self.current_sha256}.'
                 )
                 self.retry(db_error)
-            return
+            return None
         # Store methods whose anomaly scores fall under the threshold
         # (i.e., the most anomalous methods)
         indices = np.flatnonzero(scores < cutoff_score)
         anomalies = {}
         for i in indices:
-            anomalies[str(method_analyses[i].full_name)] = scores[i]
+            anomalies[str(scored[i].full_name)] = scores[i]
         try:
             database.store_anomalies(self.current_sha256, anomalies,
                                      self.db_connection)
@@ -438,22 +522,70 @@ class Worker(Process):
             self.logger.error(
                 f'Failed to store anomalies for {self.current_sha256}.')
             self.retry(error)
-        skipped = sum(1 if score == 1.0 else 0 for score in scores)
+        if self.feature_sink is not None:
+            self.store_features(scored)
         analyzed = sum(1 if score != 1.0 else 0 for score in scores)
-        self.logger.log(
-            VERBOSE,
-            f'Analyzed {analyzed} of {len(method_analyses)}, skipped {skipped}. Found'
-            f' {len(indices)} anomalies. Check: {analyzed + skipped == len(method_analyses)}'
-        )
+        estimate = None
+        if sample is None:
+            skipped = sum(1 if score == 1.0 else 0 for score in scores)
+            self.logger.log(
+                VERBOSE,
+                f'Analyzed {analyzed} of {len(method_analyses)}, skipped {skipped}. Found'
+                f' {len(indices)} anomalies. Check: {analyzed + skipped == len(method_analyses)}'
+            )
+        else:
+            # Methods outside of the sample count as neither analyzed nor skipped
+            skipped = len(method_analyses) - len(eligible) + len(scored) - analyzed
+            estimate = sample.estimate(scores < cutoff_score)
+            self.logger.log(
+                VERBOSE,
+                f'Sampled {len(sample)} of {len(eligible)} eligible methods of'
+                f' {len(method_analyses)}, analyzed {analyzed}. Found {len(indices)}'
+                f' anomalies, an estimated {estimate[0]:.1f} ({estimate[1]:.1f} to'
+                f' {estimate[2]:.1f}) among all methods.')
+        cached = self.anomaly_detector.hits
+        if self.anomaly_detector.cache:
+            lookups = self.anomaly_detector.lookups
+            self.logger.log(
+                VERBOSE,
+                f'Took {cached} of {lookups} scores from the cache'
+                f' ({cached / max(1, lookups) * 100:.2f}% hit rate).')
+        model = self.anomaly_detector.model
+        if isinstance(model, CascadedForest):
+            self.logger.log(
+                VERBOSE, f'Cascade stopped early for {model.exits} of'
+                f' {model.samples} methods, saving'
+                f' {model.saved_evaluations() * 100:.2f}% of tree evaluations.')
+            model.reset_statistics()
         try:
             database.store_anomaly_overview(self.current_sha256, analyzed,
-                                            len(anomalies), skipped,
-                                            self.db_connection)
+                                            len(anomalies), skipped, cached,
+                                            estimate, self.db_connection)
         except DatabaseRetry as error:
             self.logger.error(
                 f'Failed to store the anomaly overview for {self.current_sha256}.'
             )
             self.retry(error)
+        if sample is None:
+            return scores
+        # Methods outside of the sample are unknown, ineligible ones skipped
+        all_scores = np.ones(len(method_analyses))
+        all_scores[eligible] = np.nan
+        all_scores[positions] = scores
+        return all_scores
+
+    def store_features(self, method_analyses):
+        features = self.anomaly_detector.features
+        rows = len(features)
+        if rows:
+            methods = [method_analyses[idx] for idx in features.positions]
+            self.feature_sink.write_shard(
+                self.current_sha256,
+                features.matrix(self.anomaly_detector.full_vectorizer.width),
+                [size_bin(code_size(method)) for method in methods],
+                [str(method.full_name) for method in methods])
+        self.feature_sink.commit(self.current_sha256, rows,
+                                 len(method_analyses) - rows)
 
     def extract_invocations(self, method):
         method_invocations = self.method_invocations.get(method, {})